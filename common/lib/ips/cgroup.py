@@ -0,0 +1,200 @@
+# Copyright (c) 2013, Masato Taruishi <taru0216@gmail.com>
+
+"""Readers for resource usage of containers in cgroups.
+
+This module reads the statistics of LXC containers directly from the
+cgroup filesystem without spawning any external command. Both the
+legacy hierarchies (cgroup v1), which have a directory for each
+controller such as /sys/fs/cgroup/blkio/lxc/<name>, and the unified
+hierarchy (cgroup v2), which has one directory for each container such
+as /sys/fs/cgroup/lxc.payload.<name>, are supported.
+
+ # Gets the statistics of all running containers.
+ import ips.cgroup
+ ips.cgroup.GetContainerStatistics()
+
+The statistics of a container are a dict which has some of the
+following keys, depending on the enabled controllers:
+
+ blkio-requests: number of I/O requests to disks.
+ blkio-bytes: bytes transferred from / to disks.
+ cpu-microseconds: CPU time consumed.
+ memory-bytes: memory currently used, including caches.
+ pids: number of tasks.
+"""
+
+__author__    = 'Masato Taruishi'
+__copyright__ = 'Copyright (c) 2013, Masato Taruishi <taru0216@gmail.com>'
+
+
+import errno
+import os
+
+
+ROOT = '/sys/fs/cgroup'
+
+# Majors of the block devices counted for blkio statistics. Only SCSI
+# disks are counted so that I/O to devices stacked on them, such as
+# device-mapper, isn't counted twice.
+DISK_MAJORS = frozenset(['8'])
+
+# v1 files read for the statistics: (controller, file, statistic)
+_V1_FILES = [
+    ('blkio', 'blkio.throttle.io_serviced', 'blkio-requests'),
+    ('blkio', 'blkio.throttle.io_service_bytes', 'blkio-bytes'),
+    ('cpuacct', 'cpuacct.usage', 'cpu-microseconds'),
+    ('memory', 'memory.usage_in_bytes', 'memory-bytes'),
+    ('pids', 'pids.current', 'pids'),
+]
+
+# prefix of the cgroups of containers created by LXC 4 or later, which
+# are <parent>/<name> for older ones.
+_PAYLOAD_PREFIX = 'lxc.payload.'
+
+
+def IsUnified(root=ROOT):
+  """Returns True if the cgroup filesystem is the v2 unified hierarchy."""
+  return os.path.exists(os.path.join(root, 'cgroup.controllers'))
+
+
+def ParseBlkioStat(data, majors=DISK_MAJORS):
+  """Returns the total of a v1 blkio.throttle.* file.
+
+  >>> ParseBlkioStat('''8:0 Read 10
+  ... 8:0 Write 5
+  ... 8:0 Total 15
+  ... 253:0 Total 15
+  ... Total 30''')
+  15
+  """
+  total = 0
+  for line in data.splitlines():
+    fields = line.split()
+    if (len(fields) == 3 and fields[1] == 'Total' and
+        fields[0].split(':')[0] in majors):
+      total += int(fields[2])
+  return total
+
+
+def ParseIoStat(data, majors=DISK_MAJORS):
+  """Returns (requests, bytes) of a v2 io.stat file.
+
+  >>> ParseIoStat('8:0 rbytes=100 wbytes=50 rios=3 wios=2 dbytes=0 dios=0')
+  (5, 150)
+  """
+  requests = 0
+  bytes = 0
+  for line in data.splitlines():
+    fields = line.split()
+    if not fields or not fields[0].split(':')[0] in majors:
+      continue
+    for field in fields[1:]:
+      key, unused_sep, value = field.partition('=')
+      if key in ('rios', 'wios'):
+        requests += int(value)
+      elif key in ('rbytes', 'wbytes'):
+        bytes += int(value)
+  return requests, bytes
+
+
+def ParseKeyValues(data):
+  """Parses lines of a key and an integer value, e.g. cpu.stat.
+
+  >>> sorted(ParseKeyValues('usage_usec 100\\nuser_usec 60').items())
+  [('usage_usec', 100), ('user_usec', 60)]
+  """
+  values = {}
+  for line in data.splitlines():
+    fields = line.split()
+    if len(fields) == 2:
+      try:
+        values[fields[0]] = int(fields[1])
+      except ValueError:
+        pass
+  return values
+
+
+def _Read(path):
+  try:
+    with open(path) as f:
+      return f.read()
+  except IOError, e:
+    # the controller isn't enabled, or the container has just stopped.
+    if e.errno in (errno.ENOENT, errno.ENODEV, errno.EINVAL):
+      return None
+    raise
+
+
+def _ListDir(path):
+  try:
+    return [name for name in os.listdir(path)
+            if os.path.isdir(os.path.join(path, name))]
+  except OSError:
+    return []
+
+
+def _GetV1Statistics(root, parent):
+  stats = {}
+  for controller, filename, stat in _V1_FILES:
+    directory = os.path.join(root, controller, parent)
+    for name in _ListDir(directory):
+      data = _Read(os.path.join(directory, name, filename))
+      if data is None:
+        continue
+      if controller == 'blkio':
+        value = ParseBlkioStat(data)
+      elif controller == 'cpuacct':
+        value = int(data) / 1000
+      else:
+        value = int(data)
+      stats.setdefault(name, {})[stat] = value
+  return stats
+
+
+def _GetV2Directories(root, parent):
+  directories = {}
+  base = os.path.join(root, parent)
+  for name in _ListDir(base):
+    directories[name] = os.path.join(base, name)
+  for name in _ListDir(root):
+    if name.startswith(_PAYLOAD_PREFIX):
+      directories[name[len(_PAYLOAD_PREFIX):]] = os.path.join(root, name)
+  return directories
+
+
+def _GetV2Statistics(root, parent):
+  stats = {}
+  for name, directory in _GetV2Directories(root, parent).iteritems():
+    stat = {}
+    data = _Read(os.path.join(directory, 'io.stat'))
+    if data is not None:
+      stat['blkio-requests'], stat['blkio-bytes'] = ParseIoStat(data)
+    data = _Read(os.path.join(directory, 'cpu.stat'))
+    if data is not None:
+      usage = ParseKeyValues(data).get('usage_usec')
+      if usage is not None:
+        stat['cpu-microseconds'] = usage
+    for filename, key in [('memory.current', 'memory-bytes'),
+                          ('pids.current', 'pids')]:
+      data = _Read(os.path.join(directory, filename))
+      if data is not None and data.strip().isdigit():
+        stat[key] = int(data)
+    stats[name] = stat
+  return stats
+
+
+def GetContainerStatistics(root=ROOT, parent='lxc'):
+  """Returns the statistics of all containers.
+
+  The statistics are read in one pass over the cgroup filesystem, and
+  a dict of the container name to its statistics is returned. parent is
+  the cgroup in which LXC creates the cgroups of containers.
+  """
+  if IsUnified(root):
+    return _GetV2Statistics(root, parent)
+  return _GetV1Statistics(root, parent)
+
+
+if __name__ == '__main__':
+  import doctest
+  doctest.testmod()
@@ -26,14 +26,18 @@ __author__    = 'Masato Taruishi'
 __copyright__ = 'Copyright (c) 2013, Masato Taruishi <taru0216@gmail.com>'
 
 
-from ips.proto.variables_pb2 import Variable
 from tornado.options import options
 
 import ips.sandbox
 import ips.utils
+import ips.varz
 
+import cStringIO
 import google.protobuf.service
 import google.protobuf.text_format
+import gzip
+import hashlib
+import json
 import logging
 import os
 import os.path
@@ -44,6 +48,10 @@ import subprocess
 import tempfile
 import threading
 import time
+import tornado.concurrent
+import tornado.gen
+import tornado.ioloop
+import tornado.iostream
 import tornado.web
 import urllib
 
@@ -88,6 +96,14 @@ class HealthzHandler(tornado.web.RequestHandler):
       self.write('NG')
 
 
+def _GetSnapshot(vars):
+  """Returns the snapshot of the variables, which doesn't change while
+  it's being read."""
+  if hasattr(vars, 'GetSnapshot'):
+    return vars.GetSnapshot()
+  return vars
+
+
 class VarzHandler(tornado.web.RequestHandler):
   """Handles requests for /varz endpoint.
 
@@ -102,78 +118,312 @@ class VarzHandler(tornado.web.RequestHandler):
     cpu-speed: 200000000
     network-rx-bytes: map:interface eth0:11111 eth1:100
 
+  The format is json by default. See ips.varz for the other formats,
+  which can be chosen by the format argument or the Accept header.
+
   Typical way to register this handler is as follows:
 
     (r"/varz", VarzHandler, dict(vars=variables))
+
+  If the variables have a generation like VariableFactory, the rendered
+  output is cached until the generation changes. The cached output is
+  served with an ETag, so that a client sending the same ETag in
+  If-None-Match gets 304 Not Modified, and is gzipped once for clients
+  which accept gzip.
+
+  Variables can be selected by the following arguments:
+
+    prefix: key prefix, can be given multiple times.
+    regex: regular expression which keys must match.
+    column: '<column>=<value>' predicate for map variables, such as
+            'target=<sandbox>'. Only values of map variables which
+            match all the predicates are returned.
+
+  e.g. /varz?prefix=cpu-&column=target=web1
+
+  A client can ask only for the variables changed or removed since a
+  generation by the since argument, e.g. /varz?since=10, in the json
+  or proto format. All variables are returned if the changes since the
+  generation are no longer known. See ips.varz for the format.
   """
 
+  # maximum number of rendered outputs to cache
+  _MAX_CACHE_SIZE = 256
+
+  class _Rendered(object):
+    """Output of /varz rendered for a generation."""
+
+    def __init__(self, generation, body):
+      self.generation = generation
+      self.body = body
+      self.etag = '"%s"' % hashlib.md5(body).hexdigest()
+      self.gzipped = None
+
+    def GetGzipped(self):
+      if self.gzipped is None:
+        buf = cStringIO.StringIO()
+        with gzip.GzipFile(mode='wb', fileobj=buf) as f:
+          f.write(self.body)
+        self.gzipped = buf.getvalue()
+      return self.gzipped
+
+  # (id of variables, format, query) -> _Rendered
+  _Cache = {}
+
   def initialize(self, vars):
     """Initializes with the specified list of variables."""
     self.vars = vars
 
   def get(self):
     """Handles GET requests."""
-    format = self.get_argument('format', 'json')
-    if format == 'raw':
-      self._WritePlain()
-    elif format == 'json':
-      self._WriteJson()
+    format = self.get_argument('format', None)
+    if not format:
+      format = ips.varz.GetFormatForAccept(
+          self.request.headers.get('Accept', '')) or 'json'
+    if not format in ips.varz.FORMATS:
+      return
+    prefixes = self.get_arguments('prefix')
+    regex = self.get_argument('regex', None)
+    columns = self.get_arguments('column')
+    try:
+      query = (tuple(sorted(prefixes)), regex, tuple(sorted(columns)))
+      if regex is not None:
+        regex = re.compile(regex)
+    except re.error, e:
+      raise tornado.web.HTTPError(400, 'bad regex: %s' % e)
+    columns = ips.varz.ParseColumnPredicates(columns)
+    vars = _GetSnapshot(self.vars)
+    since = self.get_argument('since', None)
+    if since is not None:
+      self._WriteDelta(vars, format, since, prefixes, regex, columns)
+      return
+    rendered = self._GetRendered(
+        vars, format, query, prefixes, regex, columns)
+    self.set_header('Content-Type', ips.varz.FORMATS[format])
+    self.set_header('Etag', rendered.etag)
+    self.set_header('Vary', 'Accept, Accept-Encoding')
+    if self._IsNotModified(rendered.etag):
+      self.set_status(304)
+    elif 'gzip' in self.request.headers.get('Accept-Encoding', ''):
+      self.set_header('Content-Encoding', 'gzip')
+      self.write(rendered.GetGzipped())
+    else:
+      self.write(rendered.body)
+
+  def _GetRendered(self, vars, format, query, prefixes, regex, columns):
+    generation = getattr(vars, 'generation', None)
+    key = (id(self.vars), format, query)
+    cache = self.__class__._Cache
+    rendered = cache.get(key)
+    if (generation is None or not rendered or
+        rendered.generation != generation):
+      body = ips.varz.Encode(
+          format, self._Select(vars, prefixes, regex, columns), generation)
+      rendered = self.__class__._Rendered(generation, body)
+      if generation is not None:
+        if len(cache) >= self._MAX_CACHE_SIZE:
+          cache.clear()
+        cache[key] = rendered
+    return rendered
+
+  def _WriteDelta(self, vars, format, since, prefixes, regex, columns):
+    if not format in ('json', 'proto'):
+      raise tornado.web.HTTPError(400, 'since is not supported in %s' % format)
+    try:
+      since = int(since)
+    except ValueError:
+      raise tornado.web.HTTPError(400, 'bad generation: %s' % since)
+    changes = None
+    if hasattr(vars, 'GetChanges'):
+      changes = vars.GetChanges(since)
+    if changes:
+      generation, changed, removed = changes
+      variables = list(ips.varz.SelectVariables(
+          changed, prefixes, regex, columns))
+      removed = [key for key in removed
+                 if (not prefixes or [p for p in prefixes if key.startswith(p)])
+                 and (not regex or regex.search(key))]
+    else:
+      generation = getattr(vars, 'generation', None)
+      variables = self._Select(vars, prefixes, regex, columns)
+      removed = []
+      since = None
+    self.set_header('Content-Type', ips.varz.FORMATS[format])
+    self.set_header('Vary', 'Accept')
+    if generation is not None:
+      self.set_header('X-Varz-Generation', generation)
+    self.write(ips.varz.EncodeDelta(
+        format, variables, removed, generation, since))
+
+  def _Select(self, vars, prefixes, regex, columns):
+    if not prefixes and not regex and not columns:
+      return vars.values()
+    if hasattr(vars, 'Select'):
+      return vars.Select(prefixes, regex, columns)
+    return list(ips.varz.SelectVariables(
+        vars.values(), prefixes, regex, columns))
+
+  def _IsNotModified(self, etag):
+    if_none_match = self.request.headers.get('If-None-Match')
+    if not if_none_match:
+      return False
+    etags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in etags or etag in etags or 'W/' + etag in etags
 
-  def _WritePlain(self):
-    content_type = 'text/plain'
-    self.set_header('Content-Type', content_type)
-    for name, var in self.vars.iteritems():
-      self.write('%s: %s\n' % (name, self._GetValue(var, content_type)))
 
-  def _WriteJson(self):
-    import json
-    content_type = 'application/json'
-    self.set_header('Content-Type', content_type)
-    varz = {}
-    for name, var in self.vars.iteritems():
-      varz[name] = self._GetValue(var, content_type) 
-    self.write(json.dumps(varz, indent=True, sort_keys=True))
-
-  def _AddMapValue(self, root, type, map_value):
-    node = root
-    for column in map_value.column_names:
-      if not column in node:
-        node[column] = {}
-      node = node[column]
-    if type == Variable.Value.Map.GAUGE:
-      node['gauge'] = map_value.gauge
-    elif type == Variable.Value.Map.COUNTER:
-      node['counter'] = map_value.counter
-    elif type == Variable.Value.Map.STRING:
-      node['string'] = map_value.string
-
-  def _GetValue(self, var, content_type):
-    if var.type == Variable.GAUGE:
-      return var.value.gauge
-    elif var.type == Variable.COUNTER:
-      return var.value.counter
-    elif var.type == Variable.STRING:
-      return var.value.string
-    elif var.type == Variable.MAP:
-      if content_type == 'application/json':
-        columns = [column for column in var.value.map.columns]
-        values = {}
-        for map_value in var.value.map.value:
-          self._AddMapValue(values, var.value.map.type, map_value)
-        return {
-            'columns': columns,
-            'values': values}
-      else:
-        columns = 'map:' + ':'.join(var.value.map.columns)
-        type = 'string'
-        if var.value.map.type == Variable.Value.Map.GAUGE:
-          type = 'gauge'
-        if var.value.map.type == Variable.Value.Map.COUNTER:
-          type = 'counter'
-        vals = [
-            ':'.join(val.column_names) +
-            ':%d' % getattr(val, type) for val in var.value.map.value]
-        return columns + ' %s' % ' '.join(vals)
+class VarzWatchHandler(tornado.web.RequestHandler):
+  """Handles requests for /varz/watch endpoint.
+
+  This handler keeps the connection open and pushes the variables every
+  time they are updated. The first message has all variables, or the
+  changes since the generation given by the since argument, and each
+  following message has the changes since the previous one. A message
+  is the JSON delta object described in ips.varz written in a line, or
+  a server-sent event whose id is the generation if the client accepts
+  text/event-stream, so that a reconnecting client resumes from its
+  Last-Event-ID.
+
+  The next message isn't made until the previous one is written to the
+  socket, so a slow client gets the changes of several updates in one
+  message instead of making the server buffer them. At most
+  max_watchers clients are served at once.
+
+  Typical way to register this handler is as follows:
+
+    (r"/varz/watch", VarzWatchHandler, dict(vars=variables))
+  """
+
+  # number of clients being served
+  _Watchers = 0
+
+  def initialize(self, vars, max_watchers=64):
+    """Initializes with the specified VariableFactory."""
+    self.vars = vars
+    self.max_watchers = max_watchers
+    self.io_loop = tornado.ioloop.IOLoop.current()
+    self.waiter = None
+    self.closed = False
+
+  @tornado.gen.coroutine
+  def get(self):
+    """Handles GET requests."""
+    if self.__class__._Watchers >= self.max_watchers:
+      raise tornado.web.HTTPError(503, 'too many watchers')
+    since = (self.request.headers.get('Last-Event-ID') or
+             self.get_argument('since', None))
+    generation = None
+    try:
+      if since:
+        generation = int(since)
+    except ValueError:
+      raise tornado.web.HTTPError(400, 'bad generation: %s' % since)
+    event_stream = 'text/event-stream' in self.request.headers.get(
+        'Accept', '')
+    if event_stream:
+      self.set_header('Content-Type', 'text/event-stream')
+    else:
+      self.set_header('Content-Type', 'application/x-json-stream')
+    self.set_header('Cache-Control', 'no-cache')
+
+    self.__class__._Watchers += 1
+    self.vars.AddListener(self._OnUpdate)
+    try:
+      while not self.closed:
+        generation = self._WriteChanges(generation, event_stream)
+        yield self.flush()
+        yield self._WaitForUpdate(generation)
+    except tornado.iostream.StreamClosedError:
+      pass
+    finally:
+      self.vars.RemoveListener(self._OnUpdate)
+      self.__class__._Watchers -= 1
+
+  def on_connection_close(self):
+    self.closed = True
+    self._Wake()
+
+  def _WriteChanges(self, since, event_stream):
+    """Writes the changes since the generation and returns the generation
+    of the written variables."""
+    snapshot = _GetSnapshot(self.vars)
+    changes = None
+    if since is not None:
+      changes = snapshot.GetChanges(since)
+    if changes:
+      generation, variables, removed = changes
+      if not variables and not removed:
+        return generation
+    else:
+      generation = snapshot.generation
+      variables = snapshot.values()
+      removed = []
+      since = None
+    delta = json.dumps(
+        ips.varz.GetJsonDelta(variables, removed, generation, since),
+        separators=(',', ':'), sort_keys=True)
+    if event_stream:
+      self.write('id: %d\ndata: %s\n\n' % (generation, delta))
+    else:
+      self.write(delta + '\n')
+    return generation
+
+  def _WaitForUpdate(self, generation):
+    self.waiter = tornado.concurrent.Future()
+    if self.closed or self.vars.generation != generation:
+      self.waiter.set_result(None)
+    return self.waiter
+
+  def _OnUpdate(self, unused_generation):
+    # called in the thread which updated the variables.
+    self.io_loop.add_callback(self._Wake)
+
+  def _Wake(self):
+    if self.waiter and not self.waiter.done():
+      self.waiter.set_result(None)
+
+
+class VarzHistoryHandler(tornado.web.RequestHandler):
+  """Handles requests for /varz/history endpoint.
+
+  This handler returns the recent samples of a numeric variable kept by
+  VariableFactory as a JSON object of arrays:
+
+    /varz/history?key=load-average&window=300
+
+    {"key": "load-average", "times": [...], "values": [...]}
+
+  The samples of a map variable are returned for each row, which can be
+  selected by column arguments as /varz:
+
+    /varz/history?key=network-rx-bytes-rate&column=interface=eth0
+
+    {"key": "network-rx-bytes-rate", "columns": ["interface"],
+     "rows": [{"column_names": ["eth0"], "times": [...], "values": [...]}]}
+
+  window is the number of seconds to look back, which is 300 by default.
+
+  Typical way to register this handler is as follows:
+
+    (r"/varz/history", VarzHistoryHandler, dict(vars=variables))
+  """
+
+  def initialize(self, vars):
+    """Initializes with the specified VariableFactory."""
+    self.vars = vars
+
+  def get(self):
+    """Handles GET requests."""
+    key = self.get_argument('key')
+    try:
+      window = float(self.get_argument('window', 300))
+    except ValueError:
+      raise tornado.web.HTTPError(400, 'bad window')
+    columns = ips.varz.ParseColumnPredicates(self.get_arguments('column'))
+    history = self.vars.history.Get(key, time.time() - window, columns)
+    if history is None:
+      raise tornado.web.HTTPError(404, 'no history of %s' % key)
+    self.set_header('Content-Type', 'application/json')
+    self.write(json.dumps(history, separators=(',', ':'), sort_keys=True))
 
 
 class StatuszHandler(tornado.web.RequestHandler):
@@ -199,28 +449,34 @@ class StatuszHandler(tornado.web.RequestHandler):
     """Initializes the handler."""
     self.service = service
 
+  @tornado.gen.coroutine
   def get(self):
     """Handles GET request."""
     self.write('<body style="background: #eeeeee;">')
-    self.WriteCommonStatusHeader()
+    yield self.WriteCommonStatusHeader()
     self.write(self.GenStatusz())
     self.write('</body>')
 
+  @tornado.gen.coroutine
   def WriteCommonStatusHeader(self):
     """Writes your header part of the /statusz endpoint.
 
-    This method writes the header part
+    This method writes the header part. This is a coroutine and
+    runs the commands to get the system information concurrently.
     """
+    lsb_release, free, df = yield [self.__class__._GetLsbRelease(),
+                                   self.__class__._GetFree(),
+                                   self.__class__._GetDF()]
     self.write('<h2>Status of %s</h2>' % self.service)
     start = self.__class__.InitTimestamp
     self.write(
         'Start at %s (%d seconds ago)</pre>' % (time.ctime(start),
                                                 time.time() - start))
-    self.write('<pre>%s</pre>' % self.__class__._GetLsbRelease())
+    self.write('<pre>%s</pre>' % lsb_release)
     self.write('<h3>Memory</h3>')
-    self.write('<pre>%s</pre>' % self.__class__._GetFree())
+    self.write('<pre>%s</pre>' % free)
     self.write('<h3>Disk</h3>')
-    self.write('<pre>%s</pre>' % self.__class__._GetDF())
+    self.write('<pre>%s</pre>' % df)
 
   def GenStatusz(self):
     """Generates main content of your statusz endpoint."""
@@ -228,15 +484,20 @@ class StatuszHandler(tornado.web.RequestHandler):
 
   @classmethod
   def _GetLsbRelease(cls):
-    return ips.utils.CallExternalCommand('lsb_release -a')
+    return ips.utils.CallAsyncExternalCommand(['lsb_release', '-a'])
 
   @classmethod
   def _GetFree(cls):
-    return ips.utils.CallExternalCommand('free')
+    return ips.utils.CallAsyncExternalCommand(['free'])
 
   @classmethod
+  @tornado.gen.coroutine
   def _GetDF(cls):
-    return ips.utils.CallExternalCommand('df || true')
+    try:
+      out = yield ips.utils.CallAsyncExternalCommand(['df'])
+    except ips.utils.CommandExitedWithError, e:
+      out = e.out
+    raise tornado.gen.Return(out)
 
 
 class HelpzHandler(tornado.web.RequestHandler):
@@ -316,6 +577,9 @@ class FormzHandler(tornado.web.RequestHandler):
   to make users call RPCs from their browser.
   """
 
+  # service name -> ips.utils.SerialWorker calling its RPCs
+  _workers = {}
+
   def initialize(self, service_protos):
     """Initializes with the specified service_protos.
 
@@ -387,18 +651,24 @@ class FormzHandler(tornado.web.RequestHandler):
     path = self._GetService(service).GetDescriptor().file.name
     return ips.utils.GetDataFile(path)
 
+  @tornado.gen.coroutine
   def post(self, service, method):
     """Handles HTTP POST requests.
 
     This calls a RPC method with the specified request argument
-    provided by 'text_proto' query.
+    provided by 'text_proto' query. RPC methods block on sandbox
+    operations, so they are called in another thread. Services aren't
+    thread-safe, so the RPCs of a service are called one by one.
     """
     if self._GetService(service) and method in self._GetMethodNames(service):
       try:
         request = self._ParseTextProto(service, method,
                                        self.get_argument('text_proto', ''))
         logging.debug('got request: %s', str(request))
-        response = getattr(self._GetService(service), method)(None, request)
+        worker = FormzHandler._workers.setdefault(service,
+                                                   ips.utils.SerialWorker())
+        response = yield worker.Call(
+            getattr(self._GetService(service), method), None, request)
         self._WriteResponse(response, self.get_argument('format',
                                                         'text/plain'))
         self.finish()
@@ -506,9 +776,10 @@ class Terminal:
     while True:
       with open(self.index_html, 'w') as f:
         f.write(Terminal.HTML % self.name)
+      # runs until it's stopped, so it doesn't take a slot of commands.
       self.cmd = ips.utils.ExternalCommand(
           'exec /usr/bin/ajaxterm -l -p %d -c "%s" -i %s -T 300'
-          % (self.port, self.command, self.index_html))
+          % (self.port, self.command, self.index_html), limited=False)
 
       for line in self.cmd:
         logging.debug('message from ajaxterm: %s', line)
@@ -661,13 +932,14 @@ class Shell(DevMethods):
     /devz/sh?cmd=dpkg -l
   """
 
+  @tornado.gen.coroutine
   def Get(self, handler, unused_match):
     """Handles GET requests."""
     cmd = handler.get_argument('cmd', None)
     if cmd:
       output = None
       try:
-        output = ips.utils.CallExternalCommand(cmd)
+        output = yield ips.utils.CallAsyncExternalCommand(cmd)
       except ips.utils.CommandExitedWithError, e:
         handler.write('<b>%s exited with an error: %d</b><br>' % (e.cmd,
                                                                   e.retval))
@@ -678,14 +950,16 @@ class Shell(DevMethods):
         'id=cmd name=cmd></form>')
     handler.finish()
 
+  @tornado.gen.coroutine
   def Post(self, handler, unused_match):
     """Handles POST requests."""
     cmd = handler.get_argument('cmd', None)
     if not cmd:
       handler.redirect('')
+      return
     output = None
     try:
-      output = ips.utils.CallExternalCommand(cmd)
+      output = yield ips.utils.CallAsyncExternalCommand(cmd)
     except ips.utils.CommandExitedWithError, e:
       handler.write('<b>%s exited with an error: %d</b>' % (e.cmd, e.retval))
       output = e.out
@@ -711,20 +985,22 @@ class File(DevMethods):
     /devz/file?path=/tmp/
   """
 
-  def _IsHumanReadable(self, path):
-    mime_type = ips.utils.CallExternalCommand(
-        'file --mime-type %s | cut -d: -f2' % path).strip()
+  @tornado.gen.coroutine
+  def _GetMimeType(self, path):
+    mime_type = yield ips.utils.CallAsyncExternalCommand(
+        ['file', '--brief', '--mime-type', path])
+    raise tornado.gen.Return(mime_type.strip())
+
+  def _IsHumanReadable(self, mime_type):
     if mime_type:
       return mime_type.find('text/') == 0 or mime_type == 'application/xml'
     return False
 
-  def _ReadRaw(self, handler, path):
-    mime_type = ips.utils.CallExternalCommand(
-        'file --mime-type %s | cut -d: -f2' % path).strip()
+  def _ReadRaw(self, handler, path, mime_type):
     if mime_type:
       handler.set_header('Content-Type', mime_type)
     with open(path) as f:
-      if self._IsHumanReadable(path) and handler.get_argument('q', None):
+      if self._IsHumanReadable(mime_type) and handler.get_argument('q', None):
         pattern = re.compile(handler.get_argument('q'))
         for line in f:
           if pattern.search(line):
@@ -732,10 +1008,12 @@ class File(DevMethods):
       else:
         handler.write(f.read())
 
+  @tornado.gen.coroutine
   def Get(self, handler, unused_match):
     """Handles GET request."""
     path = handler.get_argument('path')
     format = handler.get_argument('format', None)
+    file_mime_type = yield self._GetMimeType(path)
     if format == 'raw':
       if not os.path.exists(path):
         handler.set_status(404)
@@ -745,16 +1023,16 @@ class File(DevMethods):
         handler.set_status(403)
         handler.finish()
         return
-      self._ReadRaw(handler, path)
+      self._ReadRaw(handler, path, file_mime_type)
     else:
       buf = ''
       handler.write('<h1>%s</h1>' % path)
       handler.write('<h2>Attibutes</h2>')
       mime_type = 'text/plain'
       if os.path.exists(path):
-        mime_type = ips.utils.CallExternalCommand(
-            'file --mime-type %s | cut -d: -f2' % path).strip()
-        output = ips.utils.CallExternalCommand('/bin/ls -l %s' % path)
+        mime_type = file_mime_type
+        output = yield ips.utils.CallAsyncExternalCommand(
+            ['/bin/ls', '-l', path])
         if mime_type != 'inode/directory':
           with open(path) as f:
             buf = f.read()
@@ -764,7 +1042,7 @@ class File(DevMethods):
 
       handler.write('<pre>%s</pre>' % mime_type)
 
-      if self._IsHumanReadable(path):
+      if self._IsHumanReadable(file_mime_type):
         handler.write('<form method=post>')
         handler.write(
             '<textarea rows=25 cols=80 name=c>%s</textarea><br>' % buf)
@@ -777,6 +1055,7 @@ class File(DevMethods):
         handler.write('</form>')
     handler.finish()
 
+  @tornado.gen.coroutine
   def Post(self, handler, unused_match):
     """Handles POST request."""
     path = handler.get_argument('path')
@@ -785,7 +1064,7 @@ class File(DevMethods):
 
     if not os.path.isdir(path):
       if os.path.exists(path):
-        ips.utils.CallExternalCommand('/bin/cp %s %s' % (path, tmp))
+        yield ips.utils.CallAsyncExternalCommand(['/bin/cp', path, tmp])
       buf = handler.get_argument('c', '')
     else:
       file1 = handler.request.files['file1'][0]
@@ -958,22 +1237,36 @@ class DevzHandler(tornado.web.RequestHandler):
       'sh': Shell(),
   }
 
+  @tornado.gen.coroutine
   def get(self, method):
-    """Handles GET request."""
+    """Handles GET request.
+
+    Methods may be coroutines, which are waited for.
+    """
     for pattern in DevzHandler._Methods:
       m = re.match(pattern, method)
       if m:
-        return DevzHandler._Methods[pattern].Get(self, m)
+        future = DevzHandler._Methods[pattern].Get(self, m)
+        if future:
+          yield future
+        return
     self.write('not found')
     self.set_status(404) 
     self.finish()
 
+  @tornado.gen.coroutine
   def post(self, method):
-    """Handles POST request."""
+    """Handles POST request.
+
+    Methods may be coroutines, which are waited for.
+    """
     for pattern in DevzHandler._Methods:
       m = re.match(pattern, method)
       if m:
-        return DevzHandler._Methods[pattern].Post(self, m)
+        future = DevzHandler._Methods[pattern].Post(self, m)
+        if future:
+          yield future
+        return
     self.write('not found')
     self.set_status(404) 
     self.finish()
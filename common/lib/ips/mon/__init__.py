@@ -3,10 +3,15 @@
 __author__    = 'Sungho Arai'
 __copyright__ = 'Copyright (c) 2014, Sungho Arai'
 
-import copy
+import collections
 import logging
 import re
 
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
 
 METRICS = re.compile("(.*){(.*)}")
 
@@ -26,17 +31,26 @@ class EvaluationError(Error):
   pass
 
 
-class Metric:
+class DependencyError(Error):
+  """Thrown when rules depend on each other cyclically."""
+  pass
+
+
+class Metric(object):
   """A metric of OpenTSDB.
  
   This class has three instances variable. They represent a metric name,
-  the value and the tags of a data point of OpenTSDB.
+  the value and the tags of a data point of OpenTSDB. Once the metric
+  is added to a MetricRepository, its tags are the sorted tuple of tags
+  interned by the repository.
   
   The typical use case is as follows:
   >>> metric_a = Metric("a", 1, ["job=foo"])   
   >>> metric_b = Metric("b", 2, ["target=hoge"])   
   """
 
+  __slots__ = ("name", "value", "tags")
+
   def __init__(self, metric_name, metric_value, tags=None):
     self.name = metric_name
     self.value = metric_value
@@ -46,12 +60,28 @@ class Metric:
     return "%s{%s}" % (self.name, ",".join(self.tags))
 
 
+def ParseTags(tags):
+  """Returns the sorted tuple of tags in the text like "job=a,host=b".
+
+  >>> ParseTags("job=a,host=b")
+  ('host=b', 'job=a')
+  >>> ParseTags("")
+  ()
+  """
+  return tuple(sorted(tag for tag in tags.split(",") if tag))
+
+
 class MetricRepository:
   """Repository of metrics.
  
   This class is a repository. It has two kinds of usage. It can store
   metrics. You can get a metric by the name of the specified metric. 
   You can also get a list of metrics which have the same metric_name.
+
+  Tags of metrics are kept as sorted tuples which are interned, so that
+  metrics of the same tags share a tuple. Metrics are indexed by the
+  name and the tuple, and also by each tag, so no string is built to
+  look them up.
   
   The typical use case is as follows:
   >>> metrics = MetricRepository()
@@ -65,27 +95,121 @@ class MetricRepository:
   1
   >>> len(metrics.GetMetrics("a"))
   2
+  >>> metrics.GetMetric("a", ("job=bar",)).value
+  3
+  >>> [metric.value for metric in metrics.GetMetricsWithTag("job=foo")]
+  [1]
+
+  If the repository of the previous cycle is given, the tags of
+  metrics which are new or have different values from the previous
+  ones are recorded for each name, so that MetricEvaluator.EvalRules()
+  can re-evaluate only the rules whose inputs have changed.
+
+  >>> current = MetricRepository(metrics)
+  >>> current.AddMetric(Metric("a", 1, ["job=foo"]))
+  >>> current.AddMetric(Metric("a", 4, ["job=bar"]))
+  >>> current.changed
+  {'a': set([('job=bar',)])}
   """
 
-  def __init__(self):
+  def __init__(self, previous=None):
+    self.previous = previous
+    if previous is not None:
+      # only the previous cycle is needed.
+      previous.previous = None
+    # name -> set of tag tuples of metrics changed since the previous
+    self.changed = {}
+    # name -> list of metrics in the order they are added
     self.metric_group = {}
-    self.metrics = {}
+    # name -> {tag tuple: metric}
+    self.index = {}
+    # tag -> list of metrics which have the tag
+    self.tag_index = {}
+    # tag tuple -> the interned tag tuple
+    self.tag_sets = {}
+    # tag -> the interned tag, which may be unicode
+    self.tag_strings = {}
+
+  def InternTags(self, tags):
+    """Returns the interned sorted tuple of the tags."""
+    if type(tags) is tuple:
+      # the tags of a metric in the repository are interned already.
+      tag_set = self.tag_sets.get(tags)
+      if tag_set is not None:
+        return tag_set
+    tag_set = tuple(sorted(
+        self.tag_strings.setdefault(tag, tag) for tag in tags if tag))
+    return self.tag_sets.setdefault(tag_set, tag_set)
 
   def AddMetric(self, metric):
-    self.metrics[str(metric)] = metric
-    if not metric.name in self.metric_group:
-      self.metric_group[metric.name] = []
-    self.metric_group[metric.name].append(metric)
+    metric.tags = self.InternTags(metric.tags)
+    metrics = self.index.setdefault(metric.name, {})
+    previous = metrics.get(metric.tags)
+    metrics[metric.tags] = metric
+    group = self.metric_group.setdefault(metric.name, [])
+    if previous is None:
+      group.append(metric)
+      for tag in metric.tags:
+        self.tag_index.setdefault(tag, []).append(metric)
+    else:
+      group[group.index(previous)] = metric
+      for tag in metric.tags:
+        tagged = self.tag_index[tag]
+        tagged[tagged.index(previous)] = metric
+    if self.previous is not None:
+      last = self.previous.GetMetric(metric.name, metric.tags)
+      if last is None or last.value != metric.value:
+        self.MarkChanged(metric.name, [metric.tags])
+
+  def CarryForward(self, metric, tags):
+    """Adds the value of the metric of the previous cycle, which has
+    the same tags as interned by this repository."""
+    metrics = self.index.setdefault(metric.name, {})
+    current = metrics.get(tags)
+    if current is not None:
+      current.value = metric.value
+      return
+    current = Metric(metric.name, metric.value, tags)
+    metrics[tags] = current
+    self.metric_group.setdefault(metric.name, []).append(current)
+    for tag in tags:
+      self.tag_index.setdefault(tag, []).append(current)
+
+  def MarkChanged(self, metric_name, tag_list):
+    """Records that the metrics of the name and the tag tuples changed."""
+    self.changed.setdefault(metric_name, set()).update(tag_list)
 
   def GetMetrics(self, metric_name):
     return self.metric_group[metric_name]
 
+  def GetMetric(self, metric_name, tags):
+    """Returns the metric of the name and the tag tuple, or None."""
+    metrics = self.index.get(metric_name)
+    if metrics is None:
+      return None
+    return metrics.get(tags)
+
+  def GetMetricsWithTag(self, tag):
+    """Returns a list of metrics which have the tag like "job=foo"."""
+    return self.tag_index.get(tag, [])
+
   def GetMetricFromMetricName(self, metric_text):
-    return self.metrics[metric_text]
+    matched_metric = METRICS.search(metric_text)
+    if not matched_metric:
+      raise KeyError(metric_text)
+    metric = self.GetMetric(
+        matched_metric.group(1), ParseTags(matched_metric.group(2)))
+    if metric is None:
+      raise KeyError(metric_text)
+    return metric
+
+  def __len__(self):
+    return sum(len(metrics) for metrics in self.index.itervalues())
 
   def __iter__(self):
-    for metric in self.metrics.itervalues():
-      yield metric
+    for metrics in self.index.itervalues():
+      for metric in metrics.itervalues():
+        yield metric
 
 
 class SexpListFactory:
@@ -144,33 +268,73 @@ class SexpListFactory:
     (setm (quote $disk-usage_per_disk-size{job=test2}) (/ $disk-usage{job=test2} $disk-size{job=test2}))
     """
     sexp_list = []
-    for sexp_rule in sexp_rules:
-      parsed_sexp_rule = self._ParseRule(sexp_rule)
-      leftmost = self._GetLeftMostMetricName(parsed_sexp_rule)
-
+    for rule in self.Compile(sexp_rules):
       mg = None
       try:
-        mg = metric_repo.GetMetrics(leftmost)
+        mg = metric_repo.GetMetrics(rule.leftmost)
       except KeyError:
-        return []
+        continue
 
       for metric in mg:
-        tags = ",".join(metric.tags)
-        sexp_list.append(
-            self._CreateOpRuleWithTag(tags, copy.deepcopy(parsed_sexp_rule)))
+        sexp_list.append(rule.Bind(metric.tags))
 
     logging.info("%d s-expressions generated", len(sexp_list))
     for sexp in sexp_list:
       logging.debug("sexp: %s", str(sexp))
     return sexp_list
 
-  def _CreateOpRuleWithTag(self, tags, sexp):
-    if isinstance(sexp, SList):
-      for sub_sexp in sexp.list_of_sexp:
-        self._CreateOpRuleWithTag(tags, sub_sexp)
-    elif isinstance(sexp, MetricAtom):
-      sexp.value =  "%s{%s}" % (sexp.value, tags)
-    return sexp
+  def Compile(self, sexp_rules):
+    """Compiles s-expression rules.
+
+    Each rule is parsed only once, and the returned CompiledRule
+    instances are evaluated for every set of tags with
+    MetricEvaluator.EvalRules().
+
+    The rules are returned in the order of their dependencies: a rule
+    which uses a metric set by other rules comes after them.
+    DependencyError is raised if rules depend on each other cyclically.
+
+    >>> rules = SexpListFactory().Compile(['(setm (quote $c) (+ $a $b))'])
+    >>> rules[0].leftmost
+    'a'
+    >>> print rules[0].Bind('job=test')
+    (setm (quote $c{job=test}) (+ $a{job=test} $b{job=test}))
+
+    >>> rules = SexpListFactory().Compile([
+    ...     '(setm (quote $d) (* $c 2))', '(setm (quote $c) (+ $a $b))'])
+    >>> [str(rule) for rule in rules]
+    ['(setm (quote $c) (+ $a $b))', '(setm (quote $d) (* $c 2))']
+    >>> SexpListFactory().Compile([
+    ...     '(setm (quote $d) (* $c 2))', '(setm (quote $c) (+ $d 1))'])
+    Traceback (most recent call last):
+        ...
+    DependencyError: cyclic dependency among rules: (setm (quote $d) (* $c 2)), (setm (quote $c) (+ $d 1))
+    """
+    return self._SortRules([CompiledRule(rule, self._ParseRule(rule), self)
+                            for rule in sexp_rules])
+
+  def _SortRules(self, rules):
+    """Sorts the compiled rules topologically by their dependencies."""
+    setters = {}
+    for i, rule in enumerate(rules):
+      for name in rule.outputs:
+        setters.setdefault(name, set()).add(i)
+    # a rule which uses the metric it sets uses the scraped value.
+    dependencies = [
+        set(j for name in rule.inputs for j in setters.get(name, ())) - set([i])
+        for i, rule in enumerate(rules)]
+
+    order = []
+    done = set()
+    while len(order) < len(rules):
+      ready = [i for i in range(len(rules))
+               if not i in done and dependencies[i] <= done]
+      if not ready:
+        raise DependencyError("cyclic dependency among rules: %s" % ", ".join(
+            rules[i].rule for i in range(len(rules)) if not i in done))
+      order.extend(ready)
+      done.update(ready)
+    return [rules[i] for i in order]
 
   def _ParseRule(self, calc_rule):
     """Parser of s-expression.
@@ -200,17 +364,20 @@ class SexpListFactory:
     return self._Parse(self._Tokenize(calc_rule))
     
   def _Tokenize(self, rule):
-    return rule.replace('(',' ( ').replace(')',' ) ').split()
+    return collections.deque(
+        rule.replace('(',' ( ').replace(')',' ) ').split())
 
   def _Parse(self, tokens):
     if len(tokens) == 0:
       raise SyntaxError('unexpected EOF while reading')
-    token = tokens.pop(0)
+    token = tokens.popleft()
     if '(' == token:
       expression = []
-      while tokens[0] != ')':
+      while tokens and tokens[0] != ')':
           expression.append(self._Parse(tokens))
-      tokens.pop(0) 
+      if not tokens:
+        raise SyntaxError('unexpected EOF while reading')
+      tokens.popleft()
       return SList(expression)
     elif ')' == token:
       raise SyntaxError('unexpected )')
@@ -258,6 +425,209 @@ class SexpListFactory:
       return None
 
 
+class CompiledRule:
+  """S-expression rule compiled into functions.
+
+  A rule is compiled into a pair of functions for each node of the
+  parsed s-expression: one evaluates the node for a set of tags, and
+  the other binds the node to a set of tags without evaluating it, for
+  quote. Metric names are bound to tags while they are evaluated, so
+  neither the parse tree nor a copy of it is needed for each tag set.
+
+  >>> metrics = MetricRepository()
+  >>> metrics.AddMetric(Metric("a", 3, ["job=test"]))
+  >>> metrics.AddMetric(Metric("b", 4, ["job=test"]))
+  >>> env = {"metrics": metrics, "symtable": MetricEvaluator.SYMTABLE}
+  >>> rule = SexpListFactory().Compile(['(setm (quote $c) (+ $a $b))'])[0]
+  >>> rule.Eval(env, 'job=test').value
+  7
+  >>> metrics.GetMetricFromMetricName("c{job=test}").value
+  7
+  """
+
+  def __init__(self, rule, sexp, factory):
+    self.rule = rule
+    self.sexp = sexp
+    self.leftmost = factory._GetLeftMostMetricName(sexp)
+    # names of metrics which the rule uses and sets
+    self.inputs = set()
+    self.outputs = set()
+    # True if a metric in the rule is written with tags
+    self._tagged = False
+    self._CollectMetricNames(sexp)
+    self._eval, self._bind = self._Compile(sexp)
+    # (metric name, function) for EvalColumns(), or None
+    self._columns = self._CompileSetmColumns(sexp)
+
+  def Eval(self, env, tags=None):
+    """Evaluates the rule with metrics of the tags.
+
+    tags is a sorted tuple of tags, or a text like "job=a,host=b".
+    """
+    if isinstance(tags, basestring):
+      tags = ParseTags(tags)
+    return self._eval(env, tags)
+
+  def Bind(self, tags=None):
+    """Returns the s-expression whose metrics have the tags."""
+    if isinstance(tags, basestring):
+      tags = ParseTags(tags)
+    return self._bind(tags)
+
+  def CanCarryForward(self):
+    """Returns True if the results for a tag set depend only on the
+    metrics of the tag set, so they can be carried forward from the
+    previous cycle while the metrics are unchanged."""
+    return bool(self.outputs) and not self._tagged
+
+  def CanEvalColumns(self):
+    """Returns True if the rule can be evaluated by EvalColumns()."""
+    return self._columns is not None
+
+  def EvalColumns(self, metrics, tag_list):
+    """Evaluates the rule for all the tag sets at once.
+
+    The values of each metric in the rule are gathered into a column
+    which has a value for each tag set, and each operator is applied
+    once to the whole columns, with NumPy if it's available. This is
+    possible only for rules like (setm (quote $x) <arithmetic>) whose
+    arithmetic consists of numbers, metrics, +, -, * and /. Tag sets
+    for which a metric is missing or not a number are skipped. tag_list
+    is a list of sorted tuples of tags, as the tags of added metrics.
+
+    >>> metrics = MetricRepository()
+    >>> for job, usage, size in [('a', 1, 10), ('b', 3, 0), ('c', 5, None)]:
+    ...   metrics.AddMetric(Metric("disk-usage", usage, ["job=" + job]))
+    ...   if size is not None:
+    ...     metrics.AddMetric(Metric("disk-size", size, ["job=" + job]))
+    >>> rule = SexpListFactory().Compile(
+    ...     ['(setm (quote $disk-ratio) (/ $disk-usage $disk-size))'])[0]
+    >>> rule.EvalColumns(metrics, [('job=a',), ('job=b',), ('job=c',)])
+    >>> sorted((str(m), m.value) for m in metrics.GetMetrics("disk-ratio"))
+    [('disk-ratio{job=a}', 0.1), ('disk-ratio{job=b}', 3.0)]
+    """
+    name, evaluate = self._columns
+    columns = _GetColumnOps()(metrics, tag_list)
+    values = columns.ToList(evaluate(columns))
+    for tags, value, valid in zip(tag_list, values, columns.GetValid()):
+      if not valid:
+        continue
+      metric = metrics.GetMetric(name, tags)
+      if metric:
+        metric.value = value
+      else:
+        metrics.AddMetric(Metric(name, value, tags))
+
+  def __str__(self):
+    return self.rule
+
+  def _CollectMetricNames(self, sexp):
+    if isinstance(sexp, MetricAtom):
+      self.inputs.add(sexp.value.split("{")[0])
+      self._tagged = self._tagged or "{" in sexp.value
+    elif isinstance(sexp, SList):
+      items = sexp.list_of_sexp
+      car = items[0]
+      if isinstance(car, Symbol) and car.value == "quote":
+        return
+      if (isinstance(car, Symbol) and car.value == "setm" and
+          len(items) == 3 and isinstance(items[1], SList) and
+          len(items[1].list_of_sexp) == 2 and
+          isinstance(items[1].list_of_sexp[1], MetricAtom)):
+        output = items[1].list_of_sexp[1].value
+        self.outputs.add(output.split("{")[0])
+        self._tagged = self._tagged or "{" in output
+        items = items[2:]
+      for item in items:
+        self._CollectMetricNames(item)
+
+  def _Compile(self, sexp):
+    if isinstance(sexp, MetricAtom):
+      return self._CompileMetric(sexp.value)
+    elif isinstance(sexp, Symbol):
+      return lambda env, tags: sexp.Eval(env), lambda tags: sexp
+    elif isinstance(sexp, SList):
+      return self._CompileList(sexp.list_of_sexp)
+    return lambda env, tags: sexp, lambda tags: sexp
+
+  def _CompileMetric(self, name):
+    def GetName(tags):
+      if tags is None:
+        return name
+      return "%s{%s}" % (name, ",".join(tags))
+
+    def Eval(env, tags):
+      metric = None
+      if tags is not None:
+        metric = env["metrics"].GetMetric(name, tags)
+      if metric is None:
+        return MetricAtom(GetName(tags))
+      return Atom(metric.value)
+
+    return Eval, lambda tags: MetricAtom(GetName(tags))
+
+  def _CompileList(self, list_of_sexp):
+    compiled = [self._Compile(sexp) for sexp in list_of_sexp]
+    car_eval = compiled[0][0]
+    cdr_evals = [eval for eval, unused_bind in compiled[1:]]
+    binds = [bind for unused_eval, bind in compiled]
+
+    def Eval(env, tags):
+      car = car_eval(env, tags)
+      if isinstance(car, Func):
+        return car.Call([eval(env, tags) for eval in cdr_evals], env)
+      elif isinstance(car, Quote):
+        if len(binds) == 2:
+          return binds[1](tags)
+        return SList([bind(tags) for bind in binds[1:]])
+
+    return Eval, lambda tags: SList([bind(tags) for bind in binds])
+
+  # operators which EvalColumns() can apply
+  _COLUMN_OPERATORS = {
+      "+": "Add",
+      "-": "Subtract",
+      "*": "Multiple",
+      "/": "Divide",
+  }
+
+  def _CompileSetmColumns(self, sexp):
+    if not (isinstance(sexp, SList) and len(sexp.list_of_sexp) == 3):
+      return None
+    car, quoted, expression = sexp.list_of_sexp
+    if not (isinstance(car, Symbol) and car.value == "setm" and
+            isinstance(quoted, SList) and len(quoted.list_of_sexp) == 2 and
+            isinstance(quoted.list_of_sexp[0], Symbol) and
+            quoted.list_of_sexp[0].value == "quote" and
+            isinstance(quoted.list_of_sexp[1], MetricAtom)):
+      return None
+    evaluate = self._CompileColumns(expression)
+    if not evaluate:
+      return None
+    return quoted.list_of_sexp[1].value, evaluate
+
+  def _CompileColumns(self, sexp):
+    if isinstance(sexp, MetricAtom):
+      return lambda columns: columns.Gather(sexp.value)
+    elif isinstance(sexp, Symbol):
+      return None
+    elif isinstance(sexp, Atom):
+      if not isinstance(sexp.value, float):
+        return None
+      return lambda columns: sexp.value
+    elif isinstance(sexp, SList) and len(sexp.list_of_sexp) > 1:
+      car = sexp.list_of_sexp[0]
+      if not (isinstance(car, Symbol) and car.value in self._COLUMN_OPERATORS):
+        return None
+      operator = self._COLUMN_OPERATORS[car.value]
+      args = [self._CompileColumns(arg) for arg in sexp.list_of_sexp[1:]]
+      if None in args:
+        return None
+      return lambda columns: getattr(columns, operator)(
+          [arg(columns) for arg in args])
+    return None
+
+
 class Sexp:
   """S-Expression
 
@@ -381,23 +751,27 @@ class Quote(Sexp):
   pass
   
 
+def _SetMetric(metrics, metric_text, value):
+  try:
+    metrics.GetMetricFromMetricName(metric_text).value = value
+  except KeyError:
+    matched_metric = METRICS.search(metric_text)
+    metric_name = matched_metric.group(1)
+    tags = matched_metric.group(2)
+    metrics.AddMetric(Metric(
+        metric_name,
+        value,
+        tags.split(",")))
+    logging.debug(
+        "Metric is created at Setm: new metric:%s tags:%s",
+         metric_name,
+         tags.split(","))
+
+
 class Setm(Func):
 
   def Call(self, args, env):
-    try:
-      env["metrics"].GetMetricFromMetricName(args[0].value).value = args[1].value
-    except KeyError:
-      matched_metric = METRICS.search(args[0].value)
-      metric_name = matched_metric.group(1)
-      tags = matched_metric.group(2)
-      env["metrics"].AddMetric(Metric(
-          metric_name,
-          args[1].value, 
-          tags.split(",")))
-      logging.debug(
-          "Metric is created at Setm: new metric:%s tags:%s",
-           metric_name,
-           tags.split(","))
+    _SetMetric(env["metrics"], args[0].value, args[1].value)
     return args[1]
 
 
@@ -426,6 +800,129 @@ class MetricAtom(Atom):
     return "$%s" % self.value  
 
 
+class _ListColumns:
+  """Columns of metric values for tag sets in lists.
+
+  The operators follow Add, Subtract, Multiple and Divide.
+  """
+
+  def __init__(self, metrics, tag_list):
+    self.metrics = metrics
+    self.tag_list = tag_list
+    self.valid = [True] * len(tag_list)
+
+  def Gather(self, name):
+    """Returns the column of the values of the metric for the tag sets."""
+    values = []
+    metrics = self.metrics.index.get(name, {})
+    for i, tags in enumerate(self.tag_list):
+      metric = metrics.get(tags)
+      if metric is None or not type(metric.value) in _NUMBER_TYPES:
+        self.valid[i] = False
+        values.append(0)
+      else:
+        values.append(metric.value)
+    return self.MakeColumn(values)
+
+  def GetValid(self):
+    return self.valid
+
+  def MakeColumn(self, values):
+    return values
+
+  def ToList(self, column):
+    if isinstance(column, list):
+      return column
+    return [column] * len(self.tag_list)
+
+  def Add(self, args):
+    result = 0
+    for arg in args:
+      result = self._Apply(lambda x, y: x + y, result, arg)
+    return result
+
+  def Subtract(self, args):
+    result = args[0]
+    for arg in args[1:]:
+      result = self._Apply(lambda x, y: x - y, result, arg)
+    return result
+
+  def Multiple(self, args):
+    result = 1
+    for arg in args:
+      result = self._Apply(lambda x, y: x * y, result, arg)
+    return result
+
+  def Divide(self, args):
+    # As Divide, the division stops at the first zero for each tag set.
+    scalar = not [arg for arg in args if isinstance(arg, list)]
+    if scalar:
+      rows = [args]
+    else:
+      rows = zip(*[self.ToList(arg) for arg in args])
+    result = []
+    zero = False
+    for values in rows:
+      value = float(values[0])
+      for divisor in values[1:]:
+        if not divisor:
+          zero = True
+          break
+        value /= divisor
+      result.append(value)
+    if zero:
+      logging.warning("Division by Zero")
+    if scalar:
+      return result[0]
+    return result
+
+  def _Apply(self, op, x, y):
+    if not isinstance(x, list) and not isinstance(y, list):
+      return op(x, y)
+    return [op(a, b) for a, b in zip(self.ToList(x), self.ToList(y))]
+
+
+class _NumpyColumns(_ListColumns):
+  """Columns of metric values for tag sets in NumPy arrays."""
+
+  def MakeColumn(self, values):
+    return numpy.array(values)
+
+  def ToList(self, column):
+    if isinstance(column, numpy.ndarray):
+      return column.tolist()
+    return [column] * len(self.tag_list)
+
+  def Divide(self, args):
+    result = numpy.asarray(args[0], dtype=float)
+    # tag sets whose division has stopped at zero
+    stopped = numpy.zeros(result.shape, dtype=bool)
+    for arg in args[1:]:
+      divisor = numpy.asarray(arg)
+      zero = divisor == 0
+      if zero.any():
+        logging.warning("Division by Zero")
+      stopped = stopped | zero
+      with numpy.errstate(divide="ignore", invalid="ignore"):
+        result = numpy.where(
+            stopped, result, result / numpy.where(stopped, 1, divisor))
+    if result.ndim == 0:
+      return float(result)
+    return result
+
+  def _Apply(self, op, x, y):
+    return op(x, y)
+
+
+_NUMBER_TYPES = frozenset([int, long, float])
+
+
+def _GetColumnOps():
+  if numpy is not None:
+    return _NumpyColumns
+  return _ListColumns
+
+
 class MetricEvaluator:
   """Metric Evaluator
 
@@ -434,6 +931,9 @@ class MetricEvaluator:
   metrics under the one-time environment.
 
   A list of s-expressions is list of instances of Sexp class.
+  Compiled rules are evaluated with EvalRules() in the order of their
+  dependencies, so metrics set by rules can be used by other rules in
+  the same evaluation.
 
   >>> sexp1 = SList([
   ...     Symbol("setm"), 
@@ -505,6 +1005,121 @@ class MetricEvaluator:
       except EvaluationError, e:
         logging.warning("Failed to evaluate s-expression: %s", e)
 
+  def EvalRules(self, compiled_rules, metrics):
+    """Evaluates the compiled rules for the metrics.
+
+    Each rule is evaluated for the tags of every metric which has its
+    leftmost metric name, as the s-expressions of
+    SexpListFactory.GenSexpList(). The rules are evaluated in the order
+    of SexpListFactory.Compile(), so the metrics set by a rule are
+    available to the rules which depend on it in a single pass.
+
+    >>> metrics = MetricRepository()
+    >>> metrics.AddMetric(Metric("disk-usage", 1, ["job=test1"]))
+    >>> metrics.AddMetric(Metric("disk-usage", 2, ["job=test2"]))
+    >>> metrics.AddMetric(Metric("disk-size", 10, ["job=test1"]))
+    >>> metrics.AddMetric(Metric("disk-size", 20, ["job=test2"]))
+    >>> rules = SexpListFactory().Compile([
+    ...     '(setm (quote $disk-ratio) (/ $disk-usage $disk-size))'])
+    >>> MetricEvaluator().EvalRules(rules, metrics)
+    >>> [metric.value for metric in metrics.GetMetrics("disk-ratio")]
+    [0.1, 0.1]
+    >>> rules = SexpListFactory().Compile([
+    ...     '(setm (quote $disk-percent) (* $disk-ratio 100))',
+    ...     '(setm (quote $disk-ratio) (/ $disk-usage $disk-size))'])
+    >>> metrics = MetricRepository()
+    >>> metrics.AddMetric(Metric("disk-usage", 1, ["job=test1"]))
+    >>> metrics.AddMetric(Metric("disk-size", 10, ["job=test1"]))
+    >>> MetricEvaluator().EvalRules(rules, metrics)
+    >>> metrics.GetMetricFromMetricName("disk-percent{job=test1}").value
+    10.0
+
+    If the metrics have the repository of the previous cycle, a rule is
+    re-evaluated only for the tag sets whose input metrics have changed,
+    with columns or not, and the results for the other tag sets are
+    carried forward. Only the re-evaluated results are compared with the
+    previous ones to find changes for the rules depending on them.
+
+    >>> current = MetricRepository(metrics)
+    >>> current.AddMetric(Metric("disk-usage", 1, ["job=test1"]))
+    >>> current.AddMetric(Metric("disk-size", 10, ["job=test1"]))
+    >>> current.AddMetric(Metric("disk-usage", 4, ["job=test2"]))
+    >>> current.AddMetric(Metric("disk-size", 20, ["job=test2"]))
+    >>> MetricEvaluator().EvalRules(rules, current)
+    >>> sorted(current.changed["disk-percent"])
+    [('job=test2',)]
+    >>> [m.value for m in current.GetMetrics("disk-percent")]
+    [10.0, 20.0]
+    """
+    env = {
+        "metrics": metrics,
+        "symtable": MetricEvaluator.SYMTABLE }
+
+    count = 0
+    for rule in compiled_rules:
+      try:
+        group = metrics.GetMetrics(rule.leftmost)
+      except KeyError:
+        continue
+      # The tags are collected before evaluating the rule, which may add
+      # metrics to the group.
+      tag_list = [metric.tags for metric in group]
+      if metrics.previous is not None and rule.CanCarryForward():
+        tag_list = self._CarryForward(rule, metrics, tag_list)
+      count += len(tag_list)
+      if rule.CanEvalColumns():
+        rule.EvalColumns(metrics, tag_list)
+      else:
+        for tags in tag_list:
+          try:
+            rule.Eval(env, tags)
+          except EvaluationError, e:
+            logging.warning("Failed to evaluate s-expression: %s", e)
+      if metrics.previous is not None:
+        self._MarkChanged(rule, metrics, tag_list)
+    logging.info("%d s-expressions evaluated", count)
+
+  def _MarkChanged(self, rule, metrics, tag_list):
+    """Marks the results of the rule which differ from the previous."""
+    for name in rule.outputs:
+      values = metrics.index.get(name, {})
+      previous = metrics.previous.index.get(name, {})
+      metrics.MarkChanged(name, [
+          tags for tags in tag_list if tags in values and
+          (not tags in previous or
+           values[tags].value != previous[tags].value)])
+
+  def _CarryForward(self, rule, metrics, tag_list):
+    """Copies the previous results of the rule for the tag sets whose
+    inputs are unchanged, and returns the other tag sets."""
+    changed = set()
+    for name in rule.inputs:
+      changed.update(metrics.changed.get(name, ()))
+    inputs = [metrics.index.get(name, {}) for name in rule.inputs]
+    outputs = [(name, metrics.previous.index.get(name, {}))
+               for name in rule.outputs]
+    evaluated = []
+    for tags in tag_list:
+      if tags in changed:
+        evaluated.append(tags)
+        continue
+      for values in inputs:
+        if not tags in values:
+          break
+      else:
+        results = []
+        for name, values in outputs:
+          result = values.get(tags)
+          if result is None:
+            break
+          results.append(result)
+        else:
+          for result in results:
+            metrics.CarryForward(result, tags)
+          continue
+      evaluated.append(tags)
+    return evaluated
+
 
 if __name__ == "__main__":
   import doctest
@@ -0,0 +1,529 @@
+# Copyright (c) 2013, Masato Taruishi <taru0216@gmail.com>
+
+"""Readers for /proc and /sys.
+
+This module reads and parses kernel statistics directly from /proc and
+/sys without spawning any external command, so that they can be used to
+refresh variables frequently even on a loaded host.
+
+Files which are read repeatedly, such as /proc/loadavg, are kept opened
+and rewound for every read:
+
+ # Gets the current 1-minute load average.
+ import ips.procfs
+ ips.procfs.GetLoadAverage()
+"""
+
+__author__    = 'Masato Taruishi'
+__copyright__ = 'Copyright (c) 2013, Masato Taruishi <taru0216@gmail.com>'
+
+
+import os
+import re
+import socket
+import struct
+import threading
+
+
+class ProcFile(object):
+  """Reusable file handle for a file in /proc or /sys.
+
+  The file is opened at the first Read() and rewound for the subsequent
+  reads, so reading it again costs neither open(2) nor close(2).
+
+  >>> f = ProcFile('/proc/uptime')
+  >>> len(f.Read().split())
+  2
+  >>> len(f.Read().split())
+  2
+  >>> f.Close()
+  """
+
+  BUFSIZE = 65536
+
+  def __init__(self, path):
+    self.path = path
+    self.fd = None
+    self.lock = threading.Lock()
+
+  def Read(self):
+    """Returns the whole contents of the file."""
+    with self.lock:
+      try:
+        if self.fd is None:
+          self.fd = os.open(self.path, os.O_RDONLY)
+        os.lseek(self.fd, 0, os.SEEK_SET)
+        chunks = []
+        while True:
+          chunk = os.read(self.fd, self.__class__.BUFSIZE)
+          if not chunk:
+            break
+          chunks.append(chunk)
+        return ''.join(chunks)
+      except OSError:
+        self._Close()
+        raise
+
+  def Close(self):
+    """Closes the file handle if it's opened."""
+    with self.lock:
+      self._Close()
+
+  def _Close(self):
+    if self.fd is not None:
+      os.close(self.fd)
+      self.fd = None
+
+
+_files = {}
+_files_lock = threading.Lock()
+
+
+def GetProcFile(path):
+  """Returns the shared ProcFile instance for the specified path.
+
+  >>> GetProcFile('/proc/loadavg') is GetProcFile('/proc/loadavg')
+  True
+  """
+  with _files_lock:
+    if not path in _files:
+      _files[path] = ProcFile(path)
+    return _files[path]
+
+
+def ReadFile(path):
+  """Reads the specified file with a shared handle."""
+  return GetProcFile(path).Read()
+
+
+def _ReadOnce(path):
+  fd = os.open(path, os.O_RDONLY)
+  try:
+    chunks = []
+    while True:
+      chunk = os.read(fd, ProcFile.BUFSIZE)
+      if not chunk:
+        break
+      chunks.append(chunk)
+    return ''.join(chunks)
+  finally:
+    os.close(fd)
+
+
+def _GetPidPath(pid, name):
+  # Handles for /proc/self are reusable, but the ones for other processes
+  # become stale once they exit, so they are opened for every read instead.
+  if pid is None or int(pid) == os.getpid():
+    return '/proc/self/%s' % name, True
+  return '/proc/%d/%s' % (int(pid), name), False
+
+
+def _ReadPidFile(pid, name):
+  path, reusable = _GetPidPath(pid, name)
+  if reusable:
+    return ReadFile(path)
+  return _ReadOnce(path)
+
+
+def GetClockTicks():
+  """Returns the number of clock ticks per second."""
+  return int(os.sysconf('SC_CLK_TCK'))
+
+
+def GetNumCpus():
+  """Returns the number of processors listed in /proc/cpuinfo.
+
+  >>> GetNumCpus() > 0
+  True
+  """
+  num = 0
+  for line in ReadFile('/proc/cpuinfo').split('\n'):
+    if line.startswith('processor'):
+      num += 1
+  return num
+
+
+def GetCpuSpeed():
+  """Returns the clock speed of the first processor in Hz.
+
+  The speed is taken from /proc/cpuinfo, or from cpufreq in /sys
+  for architectures whose cpuinfo doesn't have it.
+
+  >>> GetCpuSpeed() >= 0
+  True
+  """
+  for line in ReadFile('/proc/cpuinfo').split('\n'):
+    if line.startswith('cpu MHz'):
+      return int(float(line.split(':', 1)[1]) * 1000000)
+  try:
+    khz = ReadFile('/sys/devices/system/cpu/cpu0/cpufreq/scaling_cur_freq')
+    return int(khz) * 1000
+  except (OSError, ValueError):
+    return 0
+
+
+def GetUptime():
+  """Returns the system uptime in seconds.
+
+  >>> GetUptime() > 0
+  True
+  """
+  return float(ReadFile('/proc/uptime').split(' ', 1)[0])
+
+
+def GetLoadAverage():
+  """Returns the 1-minute load average.
+
+  >>> GetLoadAverage() >= 0
+  True
+  """
+  return float(ReadFile('/proc/loadavg').split(' ', 1)[0])
+
+
+def GetLoadAverages():
+  """Returns the 1, 5 and 15-minute load averages.
+
+  >>> len(GetLoadAverages())
+  3
+  """
+  return tuple(float(load) for load in ReadFile('/proc/loadavg').split()[:3])
+
+
+CPU_STATES = ['user', 'nice', 'system', 'idle',
+              'iowait', 'irq', 'softirq', 'steal']
+
+
+def GetCpuTimes():
+  """Returns the time spent in each CPU state in jiffies.
+
+  The result is a dict whose key is 'cpu' for the aggregate of all CPUs
+  or 'cpu<N>' for each CPU, and whose value is a list of jiffies in the
+  order of CPU_STATES. guest time is already counted in user and nice.
+
+  >>> times = GetCpuTimes()
+  >>> len(times['cpu']) == len(CPU_STATES)
+  True
+  >>> 'cpu0' in times
+  True
+  """
+  times = {}
+  for line in ReadFile('/proc/stat').split('\n'):
+    if not line.startswith('cpu'):
+      continue
+    fields = line.split()
+    jiffies = [int(val) for val in fields[1:len(CPU_STATES) + 1]]
+    jiffies.extend([0] * (len(CPU_STATES) - len(jiffies)))
+    times[fields[0]] = jiffies
+  return times
+
+def GetProcessStat(pid=None):
+  """Returns the fields of /proc/<pid>/stat.
+
+  The returned list is indexed in the same way as proc(5), that is,
+  stat[0] is pid, stat[1] is comm and stat[21] is starttime. comm
+  can contain spaces and parentheses, so the fields are split after
+  the last ')'.
+
+  >>> stat = GetProcessStat()
+  >>> int(stat[0]) == os.getpid()
+  True
+  >>> stat[2] in 'RS'
+  True
+  """
+  stat = _ReadPidFile(pid, 'stat')
+  start = stat.index('(')
+  end = stat.rindex(')')
+  return ([stat[:start].strip(), stat[start + 1:end]] +
+          stat[end + 2:].split())
+
+
+def GetStartTime(pid=None):
+  """Returns the time the process started after boot in seconds.
+
+  >>> 0 < GetStartTime() <= GetUptime()
+  True
+  """
+  return float(GetProcessStat(pid)[21]) / GetClockTicks()
+
+
+def GetProcessCpuJiffies(pid=None):
+  """Returns utime + stime + cutime + cstime of the process in jiffies.
+
+  >>> GetProcessCpuJiffies() >= 0
+  True
+  """
+  stat = GetProcessStat(pid)
+  return sum([int(stat[i]) for i in range(13, 17)])
+
+
+def GetCmdline(pid=None):
+  """Returns the command line arguments of the process.
+
+  >>> import sys
+  >>> GetCmdline()[0].endswith(os.path.basename(sys.executable))
+  True
+  """
+  cmdline = _ReadPidFile(pid, 'cmdline')
+  if cmdline.endswith('\0'):
+    cmdline = cmdline[:-1]
+  return cmdline.split('\0')
+
+
+def GetChildrenPids(pid=None):
+  """Returns the specified pid followed by the pids of its children.
+
+  /proc/<pid>/task/<tid>/children is used if the kernel provides it,
+  otherwise the parent pid of every process in /proc is checked.
+
+  >>> GetChildrenPids()[0] == os.getpid()
+  True
+  """
+  pid = int(pid or os.getpid())
+  pids = [pid]
+  task_dir = '/proc/%d/task' % pid
+  children_path = '%s/%d/children' % (task_dir, pid)
+  if os.path.exists(children_path):
+    for tid in os.listdir(task_dir):
+      try:
+        children = _ReadOnce('%s/%s/children' % (task_dir, tid))
+      except OSError:
+        continue
+      pids.extend([int(child) for child in children.split()])
+    return pids
+
+  for entry in os.listdir('/proc'):
+    if not entry.isdigit():
+      continue
+    try:
+      if int(GetProcessStat(entry)[3]) == pid:
+        pids.append(int(entry))
+    except (OSError, ValueError):
+      pass
+  return pids
+
+
+def GetNetworkBytes():
+  """Returns received and transmitted bytes for each network interface.
+
+  The result is a dict whose key is the interface name and value is
+  a tuple of (rx_bytes, tx_bytes), taken from /proc/net/dev at once.
+
+  >>> 'lo' in GetNetworkBytes()
+  True
+  """
+  interfaces = {}
+  for line in ReadFile('/proc/net/dev').split('\n')[2:]:
+    if not ':' in line:
+      continue
+    name, stats = line.split(':', 1)
+    stats = stats.split()
+    interfaces[name.strip()] = (int(stats[0]), int(stats[8]))
+  return interfaces
+
+
+_MOUNTINFO_ESCAPE = re.compile(r'\\([0-7]{3})')
+
+
+def _UnescapeMountInfo(field):
+  return _MOUNTINFO_ESCAPE.sub(lambda m: chr(int(m.group(1), 8)), field)
+
+
+def GetMountPoints():
+  """Returns a list of mount points in /proc/self/mountinfo.
+
+  >>> '/' in GetMountPoints()
+  True
+  """
+  return ParseMountInfo(ReadFile('/proc/self/mountinfo'))
+
+
+def ParseMountInfo(data):
+  """Returns a list of mount points in the contents of a mountinfo file."""
+  mount_points = []
+  for line in data.split('\n'):
+    fields = line.split(' ')
+    if len(fields) > 4:
+      mount_points.append(_UnescapeMountInfo(fields[4]))
+  return mount_points
+
+
+def GetDiskStatistics(mount_points=None):
+  """Returns a list of (mount_point, size, used) in bytes.
+
+  Like df, pseudo file systems which don't have any block are omitted,
+  and a mount point which is mounted more than once is listed only once.
+  mount_points are the ones of GetMountPoints() by default.
+
+  >>> [mounted for mounted, size, used in GetDiskStatistics()].count('/')
+  1
+  """
+  if mount_points is None:
+    mount_points = GetMountPoints()
+  stats = []
+  seen = set()
+  for mounted in reversed(mount_points):
+    if mounted in seen:
+      continue
+    seen.add(mounted)
+    try:
+      st = os.statvfs(mounted)
+    except OSError:
+      continue
+    if st.f_blocks == 0:
+      continue
+    stats.append((mounted,
+                  st.f_blocks * st.f_frsize,
+                  (st.f_blocks - st.f_bfree) * st.f_frsize))
+  stats.reverse()
+  return stats
+
+
+def GetMemoryInfo():
+  """Returns the contents of /proc/meminfo in bytes.
+
+  >>> info = GetMemoryInfo()
+  >>> info['MemTotal'] >= info['MemFree']
+  True
+  """
+  return ParseMemoryInfo(ReadFile('/proc/meminfo'))
+
+
+def ParseMemoryInfo(data):
+  """Returns the values in the contents of a meminfo file in bytes."""
+  info = {}
+  for line in data.split('\n'):
+    fields = line.split()
+    if len(fields) < 2:
+      continue
+    value = int(fields[1])
+    if len(fields) > 2 and fields[2] == 'kB':
+      value *= 1024
+    info[fields[0].rstrip(':')] = value
+  return info
+
+
+
+TCP_STATES = {
+    1: 'ESTABLISHED',
+    2: 'SYN_SENT',
+    3: 'SYN_RECV',
+    4: 'FIN_WAIT1',
+    5: 'FIN_WAIT2',
+    6: 'TIME_WAIT',
+    7: 'CLOSE',
+    8: 'CLOSE_WAIT',
+    9: 'LAST_ACK',
+    10: 'LISTEN',
+    11: 'CLOSING',
+}
+
+# Matches the remote address and the state of each socket, such as
+# ":0016 00000000:0000 0A " in /proc/net/tcp, without splitting lines.
+_TCP_STATE = re.compile(r':[0-9A-F]{4} [0-9A-F]+:[0-9A-F]{4} ([0-9A-F]{2}) ')
+
+
+def GetTcpStates(version=4):
+  """Returns the number of TCP sockets for each state.
+
+  /proc/net/tcp, or /proc/net/tcp6 for IPv6, is read in large chunks,
+  and the state column is decoded directly from each chunk.
+
+  >>> states = GetTcpStates()
+  >>> set(states) <= set(TCP_STATES.values())
+  True
+  """
+  return CountTcpStates({4: '/proc/net/tcp', 6: '/proc/net/tcp6'}[version])
+
+
+def CountTcpStates(path, chunk_size=1024 * 1024):
+  """Returns the number of TCP sockets for each state in the file of
+  the path, which has the format of /proc/net/tcp."""
+  counts = {}
+  fd = os.open(path, os.O_RDONLY)
+  try:
+    rest = ''
+    while True:
+      chunk = os.read(fd, chunk_size)
+      if not chunk:
+        break
+      buf = rest + chunk
+      end = buf.rfind('\n') + 1
+      for state in _TCP_STATE.findall(buf, 0, end):
+        counts[state] = counts.get(state, 0) + 1
+      rest = buf[end:]
+  finally:
+    os.close(fd)
+
+  states = {}
+  for state, count in counts.iteritems():
+    name = TCP_STATES.get(int(state, 16), state)
+    states[name] = states.get(name, 0) + count
+  return states
+
+
+NETLINK_SOCK_DIAG = 4
+SOCK_DIAG_BY_FAMILY = 20
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+NLMSG_ERROR = 0x2
+NLMSG_DONE = 0x3
+
+_NLMSGHDR = struct.Struct('=IHHII')
+# inet_diag_req_v2 followed by an empty inet_diag_sockid.
+_INET_DIAG_REQ_V2 = struct.Struct('=BBBxI48x')
+
+
+def GetTcpStatesByNetlink(version=4):
+  """Returns the number of TCP sockets for each state by sock_diag(7).
+
+  The kernel sends only the fixed-size inet_diag_msg for each socket,
+  which is cheaper than formatting /proc/net/tcp on hosts with a huge
+  number of sockets.
+  """
+  family = {4: socket.AF_INET, 6: socket.AF_INET6}[version]
+  request = _INET_DIAG_REQ_V2.pack(family, socket.IPPROTO_TCP, 0, 0xffffffff)
+  header = _NLMSGHDR.pack(_NLMSGHDR.size + len(request), SOCK_DIAG_BY_FAMILY,
+                          NLM_F_REQUEST | NLM_F_DUMP, 1, 0)
+
+  counts = {}
+  sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_SOCK_DIAG)
+  try:
+    sock.sendto(header + request, (0, 0))
+    done = False
+    while not done:
+      buf = sock.recv(65536)
+      if not buf:
+        break
+      done = ParseSockDiagMessages(buf, counts)
+  finally:
+    sock.close()
+
+  states = {}
+  for state, count in counts.iteritems():
+    name = TCP_STATES.get(state, str(state))
+    states[name] = states.get(name, 0) + count
+  return states
+
+
+def ParseSockDiagMessages(buf, counts):
+  """Counts the states of the inet_diag_msg messages in buf.
+
+  counts is a dict of a state number to the number of sockets, which is
+  updated. True is returned when the end of the dump is reached.
+  """
+  offset = 0
+  while offset + _NLMSGHDR.size <= len(buf):
+    length, type = _NLMSGHDR.unpack_from(buf, offset)[:2]
+    if type == NLMSG_DONE or length < _NLMSGHDR.size:
+      return True
+    if type == NLMSG_ERROR:
+      raise OSError('sock_diag request failed')
+    # inet_diag_msg starts with idiag_family and idiag_state.
+    state = ord(buf[offset + _NLMSGHDR.size + 1])
+    counts[state] = counts.get(state, 0) + 1
+    offset += (length + 3) & ~3
+  return False
+
+if __name__ == '__main__':
+  import doctest
+  doctest.testmod()
@@ -65,6 +65,17 @@ define('shared_dir',
     help="Directory for sandbox's shared disk.",
     metavar='DIR')
 
+define('sandbox_command_timeout',
+    default=120,
+    type=float,
+    help='default timeout of commands to control sandboxes in seconds',
+    metavar='SEC')
+
+# Timeouts of commands which should return quickly in seconds.
+_LXC_INFO_TIMEOUT = 10
+_IPTABLES_TIMEOUT = 30
+_PING_TIMEOUT = 5
+
 
 class Error(Exception):
   """General exception of this module."""
@@ -106,6 +117,42 @@ def GetSandboxProto(path):
   return sandbox
 
 
+def _ParseAlternativesQuery(out):
+  """Parses the output of 'update-alternatives --query'.
+
+  Returns a tuple of the status fields of the link group and a list of
+  (path, priority) of the alternatives.
+
+  >>> status, alternatives = _ParseAlternativesQuery(
+  ...     'Name: ips-sandbox_web.example\\n'
+  ...     'Status: auto\\n'
+  ...     'Value: /var/lib/lxc/web2\\n'
+  ...     '\\n'
+  ...     'Alternative: /var/lib/lxc/web1\\n'
+  ...     'Priority: 1\\n'
+  ...     '\\n'
+  ...     'Alternative: /var/lib/lxc/web2\\n'
+  ...     'Priority: 2\\n')
+  >>> status['Status'], status['Value']
+  ('auto', '/var/lib/lxc/web2')
+  >>> alternatives
+  [('/var/lib/lxc/web1', 1), ('/var/lib/lxc/web2', 2)]
+  """
+  status = {}
+  alternatives = []
+  fields = status
+  for line in out.split('\n'):
+    if not line.strip():
+      fields = {}
+    elif not line[0].isspace() and ':' in line:
+      name, value = line.split(':', 1)
+      fields[name] = value.strip()
+      if name == 'Alternative':
+        alternatives.append(fields)
+  return status, [(str(fields['Alternative']), int(fields.get('Priority', 0)))
+                  for fields in alternatives]
+
+
 def GetAlternatives(role, owner):
   """Gets Alternatives instance for the specified role and owner."""
   generic_name = ips.proto.sandbox_pb2.GenericName()
@@ -170,34 +217,25 @@ class Alternatives(object):
     """Gets a list of alternatives."""
     response = ips.proto.sandbox_pb2.GetAlternativesResponse()
     name = self._GetInternalGenericName()
-    cmd = (
-        'update-alternatives --query %s 2 > /dev/null | grep Status: | '
-        'cut -d" " -f2' % name)
-    if 'auto' == ips.utils.CallExternalCommand(cmd).strip():
-      response.mode = ips.proto.sandbox_pb2.GetAlternativesResponse.AUTO
-    else:
-      response.mode = ips.proto.sandbox_pb2.GetAlternativesResponse.MANUAL
-
-    cmd = (
-        'basename $(LANG=C update-alternatives --display %s | grep points | '
-        "awk -F' ' '{print $5;}')" % name)
+    response.mode = ips.proto.sandbox_pb2.GetAlternativesResponse.MANUAL
     try:
-      response.current_sandbox_id = ips.utils.CallExternalCommand(cmd).strip()
+      out = ips.utils.CallCommand(['update-alternatives', '--query', name],
+                                  env={'LANG': 'C'})
     except ips.utils.CommandExitedWithError:
       # No such alnatives found.
       return response
 
-    cmd = (
-        'LANG=C update-alternatives --display %s | grep priority' % name)
-    try:
-      for line in ips.utils.ExternalCommand(cmd):
-        if line.find('/') == 0:
-          alternative = response.alternatives.add()
-          alternative.sandbox.CopyFrom(
-              GetSandboxProto('%s/sandbox.proto' % line.split(' ')[0]))
-          alternative.priority = int(line.split(' ')[3])
-    except ips.utils.CommandExitedWithError:
-      pass
+    status, alternatives = _ParseAlternativesQuery(out)
+    if status.get('Status') == 'auto':
+      response.mode = ips.proto.sandbox_pb2.GetAlternativesResponse.AUTO
+    if 'Value' in status:
+      response.current_sandbox_id = os.path.basename(status['Value'])
+
+    for path, priority in alternatives:
+      alternative = response.alternatives.add()
+      alternative.sandbox.CopyFrom(
+          GetSandboxProto('%s/sandbox.proto' % path))
+      alternative.priority = priority
     return response
 
   def SetAlternative(self, sandbox_id=None):
@@ -214,10 +252,9 @@ class Alternatives(object):
     try:
       if sandbox_id:
         path = '/var/lib/lxc/%s' % sandbox_id
-        cmd = 'update-alternatives --set %s %s' % (name, path)
-        ips.utils.CallExternalCommand(cmd)
+        ips.utils.CallCommand(['update-alternatives', '--set', name, path])
       else:
-        ips.utils.CallExternalCommand('update-alternatives --auto %s' % name)
+        ips.utils.CallCommand(['update-alternatives', '--auto', name])
       response.status = ips.proto.sandbox_pb2.SetAlternativeResponse.SUCCESS
     except ips.utils.CommandExitedWithError, e:
       response.status = ips.proto.sandbox_pb2.SetAlternativeResponse.FAILED
@@ -233,13 +270,18 @@ class Alternatives(object):
     ...   s = Alternatives(res.generic_names[0])
     """
     response = ips.proto.sandbox_pb2.GetGenericNamesResponse()
-    cmd = (
-        'update-alternatives --get-selections | grep ips-sandbox_ | '
-        'cut -d" " -f1 | cut -d_ -f2-')
-    for line in ips.utils.ExternalCommand(cmd):
+    try:
+      selections = ips.utils.CallCommand(
+          ['update-alternatives', '--get-selections'])
+    except ips.utils.CommandExitedWithError:
+      return response
+    for line in selections.split('\n'):
+      if not line.startswith('ips-sandbox_'):
+        continue
+      name = line.split(' ')[0].split('_', 1)[1]
       generic_name = response.generic_names.add()
-      generic_name.role = line.split('.')[0].replace('-', '.')
-      generic_name.owner = line.strip().split('.')[1].replace('-', '.')
+      generic_name.role = name.split('.')[0].replace('-', '.')
+      generic_name.owner = name.split('.')[1].replace('-', '.')
     return response
 
 
@@ -364,7 +406,9 @@ class Sandbox(object):
     to replace with fake stub when you want to test Sandbox class.
 
     >>> class FakeStubExample:
-    ...   def ExecCommand(self, cmd):
+    ...   def ExecCommand(self, cmd, timeout=None):
+    ...     return 'hogehoge'
+    ...   def Exec(self, argv, timeout=None):
     ...     return 'hogehoge'
 
     >>> s = Sandbox('mock', stub=FakeStubExample())
@@ -377,9 +421,23 @@ class Sandbox(object):
           return f.read()
       return ''
 
-    def ExecCommand(self, cmd):
-      """Executes the specified cmd with a shell."""
-      return ips.utils.CallExternalCommand(cmd)
+    def ExecCommand(self, cmd, timeout=None):
+      """Executes the specified cmd with a shell.
+
+      The command is killed after timeout seconds, which is
+      --sandbox_command_timeout by default.
+      """
+      return ips.utils.CallExternalCommand(
+          cmd, timeout=timeout or options.sandbox_command_timeout)
+
+    def Exec(self, argv, timeout=None):
+      """Executes the specified argv directly without a shell.
+
+      The command is killed after timeout seconds, which is
+      --sandbox_command_timeout by default.
+      """
+      return ips.utils.CallCommand(
+          argv, timeout=timeout or options.sandbox_command_timeout)
 
     def Exists(self, path):
       """Returns true if the specified path exists."""
@@ -507,7 +565,7 @@ class Sandbox(object):
           '(ping6 -c 1 -I %s ff02::1 && ip -6 neigh show) | '
           'grep %s | cut -d" " -f1' % (
               self.GetNetworkLinkInterface(),
-              self.GetNetworkHwAddress()))
+              self.GetNetworkHwAddress()), timeout=_PING_TIMEOUT)
       if output.find('connect: ') == 0:
         return None
       return output.strip()
@@ -535,7 +593,8 @@ class Sandbox(object):
     return ''
 
   def _GetLxcInfo(self, sandbox_id):
-    return self._stub.ExecCommand('lxc-info -n %s' % sandbox_id)
+    return self._stub.Exec(['lxc-info', '-n', sandbox_id],
+                           timeout=_LXC_INFO_TIMEOUT)
 
   def GetInfo(self):
     """Gets human readable information of this sandbox.
@@ -585,7 +644,7 @@ class Sandbox(object):
     'started'
     """
     self._SetAcceptRa()
-    out = self._stub.ExecCommand('lxc-start -d -n %s' % self.sandbox_id)
+    out = self._stub.Exec(['lxc-start', '-d', '-n', self.sandbox_id])
     statusz_port = self.GetStatuszPort()
     if statusz_port:
       self._OpenNetwork([statusz_port])
@@ -598,7 +657,7 @@ class Sandbox(object):
     >>> s._Reboot()
     ''
     """
-    return self._stub.ExecCommand('lxc-stop -r -n %s' % self.sandbox_id)
+    return self._stub.Exec(['lxc-stop', '-r', '-n', self.sandbox_id])
 
   def _Shutdown(self):
     """Shutdowns this sandbox.
@@ -607,7 +666,7 @@ class Sandbox(object):
     >>> s._Shutdown()
     ''
     """
-    out = self._stub.ExecCommand('lxc-stop -n %s' % self.sandbox_id)
+    out = self._stub.Exec(['lxc-stop', '-n', self.sandbox_id])
     out += self._LameduckNetwork(reject_statusz=True)
     return out
 
@@ -618,7 +677,7 @@ class Sandbox(object):
     >>> s._Stop()
     ''
     """
-    out = self._stub.ExecCommand('lxc-stop -k -n %s' % self.sandbox_id)
+    out = self._stub.Exec(['lxc-stop', '-k', '-n', self.sandbox_id])
     out += self._LameduckNetwork(reject_statusz=True)
     return out
 
@@ -630,7 +689,7 @@ class Sandbox(object):
     ''
     """
     out = self._UnregisterAlternative()
-    out += self._stub.ExecCommand('lxc-destroy -n %s' % self.sandbox_id)
+    out += self._stub.Exec(['lxc-destroy', '-n', self.sandbox_id])
     return out
 
   def _UnregisterAlternative(self):
@@ -646,22 +705,15 @@ class Sandbox(object):
     name = 'ips-sandbox_%s.%s' % (proto.role, owner)
     path = '/var/lib/lxc/%s' % self.sandbox_id
 
-    cmd = 'update-alternatives --remove %s %s' % (name, path)
-    return self._stub.ExecCommand(cmd) 
+    return self._stub.Exec(['update-alternatives', '--remove', name, path])
 
   def _GenDNATRules(self, sandbox_address, port):
     host_address = self._stub.HostAddress()
     rules = []
-    rules.append(
-        'PREROUTING -t nat -p tcp -d %s --dport %s '
-        '-jDNAT --to-destination %s' % (host_address,
-                                        port,
-                                        sandbox_address))
-    rules.append(
-        'OUTPUT -t nat -p tcp -d %s --dport %s '
-        '-jDNAT --to-destination %s' % (host_address,
-                                        port,
-                                        sandbox_address))
+    for chain in ['PREROUTING', 'OUTPUT']:
+      rules.append([chain, '-t', 'nat', '-p', 'tcp', '-d', host_address,
+                    '--dport', str(port),
+                    '-jDNAT', '--to-destination', sandbox_address])
     return rules
 
   def _OpenNetwork(self, ports=None):
@@ -683,10 +735,10 @@ class Sandbox(object):
     for port in ports:
       if not port in enabled_ports:
         for rule in self._GenDNATRules(sandbox_address, port):
-          cmd = '/sbin/iptables -I %s' % rule
           results.append('Opened %s: %s' % (
-              rule,
-              self._stub.ExecCommand(cmd)))
+              ' '.join(rule),
+              self._stub.Exec(['/sbin/iptables', '-I'] + rule,
+                              timeout=_IPTABLES_TIMEOUT)))
     return '\n'.join(results)
 
   def GetEnabledPorts(self):
@@ -706,10 +758,10 @@ class Sandbox(object):
         re.escape(host_address),
         re.escape(sandbox_address)))
     rule_re = re.compile(pattern)
-    cmd = '/sbin/iptables -L PREROUTING -t nat -n'
+    argv = ['/sbin/iptables', '-L', 'PREROUTING', '-t', 'nat', '-n']
 
     ports = []
-    for line in self._stub.ExecCommand(cmd).split('\n'):
+    for line in self._stub.Exec(argv, timeout=_IPTABLES_TIMEOUT).split('\n'):
       logging.debug('matching %s with rule: %s', line, pattern)
       m = rule_re.match(line)
       if m:
@@ -733,10 +785,10 @@ class Sandbox(object):
     for port in self.GetEnabledPorts():
       if reject_statusz or statusz_port != port:
         for rule in self._GenDNATRules(sandbox_address, port):
-          cmd = '/sbin/iptables -D %s' % rule
           results.append('Closed %s: %s' % (
-              rule,
-              self._stub.ExecCommand(cmd)))
+              ' '.join(rule),
+              self._stub.Exec(['/sbin/iptables', '-D'] + rule,
+                              timeout=_IPTABLES_TIMEOUT)))
     return '\n'.join(results)
 
   def _Provisioning(self, request):
@@ -807,9 +859,15 @@ class Sandbox(object):
     return False
 
   def _IsLxcRunning(self):
-    info = self._stub.ExecCommand(
-        'lxc-info -n %s | grep -i state: || true' % self.sandbox_id)
-    return len(info.split(':')) == 2 and info.split(':')[1].strip() == 'RUNNING'
+    try:
+      info = self._GetLxcInfo(self.sandbox_id)
+    except ips.utils.CommandExitedWithError:
+      return False
+    for line in info.split('\n'):
+      fields = line.split(':')
+      if len(fields) == 2 and fields[0].strip().lower() == 'state':
+        return fields[1].strip() == 'RUNNING'
+    return False
 
   def IsReady(self):
     """Returns true if the sandbox is ready to server requests.
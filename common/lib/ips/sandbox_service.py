@@ -37,16 +37,16 @@ class LxcSandboxService(ips.proto.sandbox_pb2.SandboxService):
     candidates = {}
 
     # gets candidates from lxc-ls result
-    cmd = 'lxc-ls | grep -v RUNNING | grep -v FROZEN | grep -v STOPPED'
-    cmd += '| grep -v "^$"'
     try:
-      for candidate in ips.utils.ExternalCommand(cmd):
-        candidates[candidate.strip()] = True
+      for line in ips.utils.ExternalCommand(['lxc-ls']):
+        if not [s for s in ['RUNNING', 'FROZEN', 'STOPPED'] if s in line]:
+          for candidate in line.split():
+            candidates[candidate] = True
     except ips.utils.CommandExitedWithError:
       pass
 
-    cmd = "find /var/lib/ips-cell/sandbox/archive/ -name '*.tar.bz2'"
-    for archive in ips.utils.ExternalCommand(cmd):
+    argv = ['find', '/var/lib/ips-cell/sandbox/archive/', '-name', '*.tar.bz2']
+    for archive in ips.utils.ExternalCommand(argv):
       sandbox = '.'.join(os.path.basename(archive).split('.')[:-2])
       candidates[sandbox] = True
 
@@ -91,7 +91,7 @@ class LxcSandboxService(ips.proto.sandbox_pb2.SandboxService):
       return response
 
   def _GetStatus(self):
-    return ips.utils.CallExternalCommand('lxc-list')
+    return ips.utils.CallCommand(['lxc-list'])
 
   def getStatus(self, controller, request, done=None):
     response = ips.proto.sandbox_pb2.GetStatusResponse()
@@ -50,6 +50,13 @@ define(
     metavar='true|false',
     help='Adds netstat varz')
 
+define(
+    'varz_max_watchers',
+    default=64,
+    type=int,
+    metavar='NUM',
+    help='Maximum number of clients watching /varz/watch at once')
+
 define(
     'enable_devz',
     default='false',
@@ -64,33 +71,15 @@ def InitVariables():
 
   # timestamp
   timestamp = ReadTimestamp()
-  for name, var in f.CreateBuildTimestampVariables(timestamp).iteritems():
-    f[name] = var
-
-  # network
-  if options.varz_network:
-    for var in f.CreateNetworkBytesVariables():
-      f[var.key] = var
-
-  # disk
-  if options.varz_disk:
-    for var in f.CreateDiskStatisticsVariables():
-      f[var.key] = var
-
-  # memory
-  if options.varz_memory:
-    for var in f.CreateMemoryStatisticsVariables():
-      f[var.key] = var
-
-  # packages
-  if options.varz_packages:
-    var = f.CreatePackagesStatisticsVariable()
-    f[var.key] = var
-
-  # netstat
-  if options.varz_netstat:
-    var = f.CreateNetstatVariable()
-    f[var.key] = var
+  f.Update(f.CreateBuildTimestampVariables(timestamp).values())
+
+  for name, enabled in [('network', options.varz_network),
+                        ('disk', options.varz_disk),
+                        ('memory', options.varz_memory),
+                        ('packages', options.varz_packages),
+                        ('netstat', options.varz_netstat)]:
+    if enabled:
+      f.EnableCollector(name)
 
   f.Start()
   return f
@@ -113,6 +102,9 @@ def InitWebHandlers(service, variables=None, statusz=None):
   handlers = [
     (r"/healthz", ips.handlers.HealthzHandler, dict(service=service)),
     (r"/varz", ips.handlers.VarzHandler, dict(vars=variables)),
+    (r"/varz/watch", ips.handlers.VarzWatchHandler,
+     dict(vars=variables, max_watchers=options.varz_max_watchers)),
+    (r"/varz/history", ips.handlers.VarzHistoryHandler, dict(vars=variables)),
     (r"/quitquitquit", ips.handlers.QuitHandler),
   ]
   if statusz:
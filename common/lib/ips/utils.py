@@ -5,13 +5,60 @@ __author__ = 'Masato Taruishi'
 __copyright__ = 'Copyright (c) 2013, Masato Taruishi <taru0216@gmail.com>'
 
 
+import collections
+import errno
 import logging
+import os
 import os.path
+import pipes
+import Queue
+import select
+import signal
 import socket
-import subprocess
 import sys
+import threading
+import time
+import tornado.concurrent
+import tornado.gen
+import tornado.ioloop
+import tornado.iostream
 import tornado.options
 
+# subprocess32 forks and execs in C and closes only the open fds listed
+# in /proc/self/fd instead of walking the whole fd table. It also starts
+# a new session without preexec_fn, which may deadlock in the child of a
+# multi-threaded process.
+import subprocess32 as subprocess
+
+
+tornado.options.define(
+    'max_external_commands',
+    default=64,
+    type=int,
+    help='maximum number of external commands run at once',
+    metavar='NUM')
+
+tornado.options.define(
+    'max_external_commands_per_name',
+    default=16,
+    type=int,
+    help='maximum number of external commands of the same name run at once',
+    metavar='NUM')
+
+tornado.options.define(
+    'max_async_commands',
+    default=16,
+    type=int,
+    help='maximum number of external commands run on the IOLoop at once',
+    metavar='NUM')
+
+tornado.options.define(
+    'async_command_timeout',
+    default=60,
+    type=float,
+    help='timeout of external commands run on the IOLoop in seconds',
+    metavar='SEC')
+
 
 class Error(Exception):
   """Base error class of this module."""
@@ -37,44 +84,317 @@ class CommandExitedWithError(Error):
                                                           self.out)
 
 
-def CallExternalCommand(cmd):
+class CommandTimedOut(CommandExitedWithError):
+  """Thrown when the specified command is killed by its timeout."""
+
+  def __str__(self):
+    return 'command "%s" timed out: %d: %s' % (self.cmd, self.retval, self.out)
+
+
+def CallExternalCommand(cmd, timeout=None):
   """Calls the specified external command.
 
+  The command is killed with its children after timeout seconds.
+
   >>> CallExternalCommand('echo hello')
   u'hello\\n'
+  >>> CallExternalCommand('sleep 10', timeout=0.1)
+  Traceback (most recent call last):
+    ...
+  CommandTimedOut: command "sleep 10" timed out: -9: 
+
+  """
+  return unicode(''.join(ExternalCommand(cmd, timeout=timeout).Chunks()),
+                 'utf-8')
+
+
+def CallCommand(argv, env=None, cwd=None, timeout=None):
+  """Calls the specified argv directly without a shell.
+
+  env is a dict of environment variables added to the current
+  environment and cwd is the working directory of the command.
+  The command is killed with its children after timeout seconds.
+
+  >>> CallCommand(['echo', 'hello world'])
+  u'hello world\\n'
+  >>> CallCommand(['sh', '-c', 'echo $LANG'], env={'LANG': 'C'})
+  u'C\\n'
+  >>> CallCommand(['pwd'], cwd='/')
+  u'/\\n'
+  >>> CallCommand(['/nonexistent', 'a b'])
+  Traceback (most recent call last):
+    ...
+  CommandExitedWithError: command "/nonexistent 'a b'" exited with an error: 127: [Errno 2] No such file or directory: '/nonexistent'
+  """
+  cmd = ExternalCommand(argv, env=env, cwd=cwd, timeout=timeout)
+  return unicode(''.join(cmd.Chunks()), 'utf-8')
+
 
+def FormatCommand(cmd):
+  """Formats the specified command string or argv for messages.
+
+  >>> FormatCommand(['iptables', '-t', 'nat', '-L'])
+  'iptables -t nat -L'
+  >>> FormatCommand(['sh', '-c', 'echo $HOME'])
+  "sh -c 'echo $HOME'"
+  """
+  if isinstance(cmd, basestring):
+    return cmd
+  return ' '.join(pipes.quote(arg) for arg in cmd)
+
+
+# commands which run another command, named after the latter.
+_WRAPPER_COMMANDS = frozenset(['exec', 'ionice', 'nice', 'nohup'])
+
+
+def GetCommandName(cmd):
+  """Returns the name of the specified command string or argv.
+
+  >>> GetCommandName(['/sbin/iptables', '-L'])
+  'iptables'
+  >>> GetCommandName('(ping6 -c 1 ff02::1 && ip -6 neigh show) | grep 00')
+  'ping6'
+  >>> GetCommandName('exec /usr/bin/ajaxterm -p 10000')
+  'ajaxterm'
+  >>> GetCommandName('nice ionice -c 3 tar -jcf a.tar.bz2 a')
+  'tar'
+  """
+  if isinstance(cmd, basestring):
+    cmd = cmd.lstrip('( ').split()
+  # skips commands which run the command with their options.
+  while cmd and os.path.basename(cmd[0]) in _WRAPPER_COMMANDS:
+    cmd = cmd[1:]
+    while cmd and (cmd[0].startswith('-') or cmd[0].isdigit()):
+      cmd = cmd[1:]
+  if not cmd:
+    return ''
+  return os.path.basename(cmd[0])
+
+
+class CommandMonitor(object):
+  """Limits and counts running external commands.
+
+  At most max_commands commands run at once, and at most
+  max_commands_per_name commands of the same name. Acquire() blocks
+  until the command can run.
+
+  >>> monitor = CommandMonitor(2, 1)
+  >>> monitor.Acquire('lxc-info')
+  >>> monitor.Started('lxc-info')
+  >>> monitor.GetStatistics()
+  [('lxc-info', 1, 0, 1)]
+  >>> monitor.Exited('lxc-info', timed_out=True)
+  >>> monitor.Release('lxc-info')
+  >>> monitor.GetStatistics()
+  [('lxc-info', 1, 1, 0)]
+  """
+
+  def __init__(self, max_commands, max_commands_per_name):
+    self.max_commands_per_name = max_commands_per_name
+    self.semaphore = threading.BoundedSemaphore(max_commands)
+    self.semaphores = {}
+    self.lock = threading.Lock()
+    self.spawned = collections.defaultdict(int)
+    self.timed_out = collections.defaultdict(int)
+    self.in_flight = collections.defaultdict(int)
+
+  def Acquire(self, name):
+    """Waits until a command of the name can run."""
+    with self.lock:
+      if not name in self.semaphores:
+        self.semaphores[name] = threading.BoundedSemaphore(
+            self.max_commands_per_name)
+      semaphore = self.semaphores[name]
+    if not semaphore.acquire(False):
+      logging.debug('waiting for running commands of %s', name)
+      semaphore.acquire()
+    if not self.semaphore.acquire(False):
+      logging.debug('waiting for running commands')
+      self.semaphore.acquire()
+
+  def Release(self, name):
+    """Releases what Acquire() has acquired."""
+    self.semaphore.release()
+    self.semaphores[name].release()
+
+  def Started(self, name):
+    """Counts a command of the name which is spawned."""
+    with self.lock:
+      self.spawned[name] += 1
+      self.in_flight[name] += 1
+
+  def Exited(self, name, timed_out=False):
+    """Counts a command of the name which exited or is killed."""
+    with self.lock:
+      self.in_flight[name] -= 1
+      if timed_out:
+        self.timed_out[name] += 1
+
+  def GetStatistics(self):
+    """Returns a list of (name, spawned, timed out, in flight)."""
+    with self.lock:
+      return [(name, self.spawned[name], self.timed_out[name],
+               self.in_flight[name]) for name in sorted(self.spawned)]
+
+
+_command_monitor = None
+_command_monitor_lock = threading.Lock()
+
+
+def GetCommandMonitor():
+  """Returns the CommandMonitor shared in this process."""
+  global _command_monitor
+  with _command_monitor_lock:
+    if not _command_monitor:
+      _command_monitor = CommandMonitor(
+          tornado.options.options.max_external_commands,
+          tornado.options.options.max_external_commands_per_name)
+    return _command_monitor
+
+
+def _KillProcessGroup(pid):
+  try:
+    os.killpg(pid, signal.SIGKILL)
+  except OSError:
+    # already exited.
+    pass
+
+
+class TailBuffer(object):
+  """Ring buffer which keeps only the last max_size bytes of data.
+
+  >>> buf = TailBuffer(5)
+  >>> buf.Append('abc')
+  >>> buf.Append('defg')
+  >>> buf.GetValue()
+  'cdefg'
   """
-  buf = ''
-  for line in ExternalCommand(cmd):
-    buf += line
-  return buf
 
+  def __init__(self, max_size):
+    self.max_size = max_size
+    self.chunks = collections.deque()
+    self.size = 0
+
+  def Append(self, data):
+    """Appends data, dropping the oldest data beyond max_size."""
+    self.chunks.append(data)
+    self.size += len(data)
+    while self.size - len(self.chunks[0]) >= self.max_size:
+      self.size -= len(self.chunks.popleft())
+    if self.size > self.max_size:
+      self.chunks[0] = self.chunks[0][self.size - self.max_size:]
+      self.size = self.max_size
+
+  def GetValue(self):
+    """Returns the kept data."""
+    return ''.join(self.chunks)
 
-class ExternalCommand():
+
+class ExternalCommand(object):
   """Eexternal command.
 
+  cmd is either a command line string executed with a shell or a list
+  of arguments executed directly, which saves forking a shell.
+  Iterating an instance yields the output of the command line by line
+  as unicode. Chunks() and Lines() stream the output as bytes instead,
+  which is much cheaper for a large output. In any case, only the last
+  tail_size bytes of the output are kept to report errors.
+
+  The command runs in its own process group. If timeout is given, the
+  whole process group is killed when the output isn't read to the end
+  within timeout seconds, and CommandTimedOut is raised. The number of
+  running commands is limited by the CommandMonitor; a command holds
+  its slot until the output is read to the end or it is killed. If the
+  reading stops early, e.g. by break or an error, the command is killed
+  when the iterator is closed. A daemon which runs as long as the
+  server, such as a terminal, should be run with limited=False not to
+  hold a slot; it's still counted in the statistics.
+
   >>> cmd = ExternalCommand('echo hello && echo world')
   >>> for line in cmd:
   ...   print line.strip()
   hello
   world
 
+  >>> cmd = ExternalCommand(['seq', '2'])
+  >>> list(cmd.Lines())
+  ['1\\n', '2\\n']
+
+  >>> cmd = ExternalCommand(['seq', '1000000'])
+  >>> for line in cmd:
+  ...   break
+  >>> cmd.retval
+  -9
+  >>> cmd = ExternalCommand(['printf', '\\377'])
+  >>> list(cmd)
+  Traceback (most recent call last):
+    ...
+  UnicodeDecodeError: 'utf8' codec can't decode byte 0xff in position 0: invalid start byte
+  >>> cmd.finished
+  True
+
+  >>> cmd = ExternalCommand('seq 3; exit 2', tail_size=4)
+  >>> list(cmd.Lines())
+  Traceback (most recent call last):
+    ...
+  CommandExitedWithError: command "seq 3; exit 2" exited with an error: 2: 2
+  3
+  <BLANKLINE>
+
   """
 
+  CHUNK_SIZE = 65536
+  TAIL_SIZE = 256 * 1024
+
   def __iter__(self):
-    return self
+    return self._UnicodeLines()
 
-  def __init__(self, cmd):
+  def __init__(self, cmd, chunk_size=None, tail_size=None, env=None,
+               cwd=None, timeout=None, limited=True):
     """Instantiates an external command object for the specified cmd."""
-    logging.debug('executing %s', cmd)
-    self.cmd = cmd
-    self.p = subprocess.Popen(cmd, shell=True, close_fds=True,
-                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    self.out = ''
+    self.cmd = FormatCommand(cmd)
+    self.name = GetCommandName(cmd)
+    self.limited = limited
+    logging.debug('executing %s', self.cmd)
+    self.chunk_size = chunk_size or self.__class__.CHUNK_SIZE
+    self.tail = TailBuffer(tail_size or self.__class__.TAIL_SIZE)
     self.retval = None
+    self.lines = None
+    self.timed_out = False
+    self.finished = False
+    if env:
+      env = dict(os.environ, **env)
+    self.monitor = GetCommandMonitor()
+    if limited:
+      self.monitor.Acquire(self.name)
+    try:
+      self.p = subprocess.Popen(cmd, shell=isinstance(cmd, basestring),
+                                close_fds=True, env=env, cwd=cwd,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT,
+                                start_new_session=True)
+    except OSError, e:
+      # Reports a failure to exec in the same way as a shell does.
+      if limited:
+        self.monitor.Release(self.name)
+      self.p = None
+      self.retval = 127
+      raise CommandExitedWithError(self.cmd, self.retval, str(e))
+    self.monitor.Started(self.name)
+    self.deadline = None
+    if timeout:
+      self.deadline = time.time() + timeout
+      self.poller = select.poll()
+      self.poller.register(self.p.stdout.fileno(),
+                           select.POLLIN | select.POLLPRI)
+
+  @property
+  def out(self):
+    """The last part of the output as unicode."""
+    return unicode(self.tail.GetValue(), 'utf-8', 'replace')
 
   def Kill(self):
-    """Kills the external command.
+    """Kills the external command with its children.
 
     >>> cmd = ExternalCommand('while true; do echo hello; sleep 1; done')
     >>> for line in cmd:
@@ -85,29 +405,380 @@ class ExternalCommand():
     <BLANKLINE>
 
     """
-    logging.debug('sending term signal to %s', self.p)
-    self.p.kill()
-    self.retval = self.p.wait()
+    p = self.p
+    if not p:
+      return
+    logging.debug('sending kill signal to %s', p)
+    _KillProcessGroup(p.pid)
+    self.retval = p.wait()
     logging.debug('cmd "%s" exited: %d', self.cmd, self.retval)
+    self._Finish()
+
+  def Chunks(self):
+    """Yields the output of the command as chunks of bytes."""
+    try:
+      while self.p:
+        if self.deadline and not self._WaitForOutput():
+          logging.warning('cmd "%s" timed out', self.cmd)
+          self.timed_out = True
+          _KillProcessGroup(self.p.pid)
+          self._Wait()
+        chunk = os.read(self.p.stdout.fileno(), self.chunk_size)
+        if not chunk:
+          self._Wait()
+          return
+        self.tail.Append(chunk)
+        yield chunk
+    finally:
+      if self.p:
+        # The output isn't read to the end, so nobody waits for the
+        # command any more.
+        logging.debug('cmd "%s" is no longer read', self.cmd)
+        _KillProcessGroup(self.p.pid)
+        self.retval = self.p.wait()
+        self.p.stdout.close()
+        self.p = None
+        self._Finish()
+
+  def Lines(self):
+    """Yields the output of the command line by line as bytes."""
+    pending = []
+    try:
+      for chunk in self.Chunks():
+        start = 0
+        end = chunk.find('\n')
+        while end != -1:
+          pending.append(chunk[start:end + 1])
+          yield ''.join(pending)
+          pending = []
+          start = end + 1
+          end = chunk.find('\n', start)
+        if start < len(chunk):
+          pending.append(chunk[start:])
+    except CommandExitedWithError:
+      if pending:
+        yield ''.join(pending)
+      raise
+    if pending:
+      yield ''.join(pending)
 
   def next(self):
     """Returns the next line generated by the external command."""
-    if not self.p:
-      raise StopIteration
+    if self.lines is None:
+      self.lines = iter(self)
+    return next(self.lines)
+
+  def _UnicodeLines(self):
+    lines = self.Lines()
+    try:
+      for line in lines:
+        line = unicode(line, 'utf-8')
+        logging.debug('got a line from "%s": %s', self.cmd, line)
+        yield line
+    finally:
+      # kills the command if the output isn't read to the end.
+      lines.close()
+
+  def _WaitForOutput(self):
+    while True:
+      timeout = max(0, self.deadline - time.time())
+      try:
+        return bool(self.poller.poll(timeout * 1000))
+      except select.error, e:
+        if e.args[0] != errno.EINTR:
+          raise
+
+  def _Finish(self):
+    with self.monitor.lock:
+      if self.finished:
+        return
+      self.finished = True
+    self.monitor.Exited(self.name, self.timed_out)
+    if self.limited:
+      self.monitor.Release(self.name)
+
+  def _Wait(self):
+    self.retval = self.p.wait()
+    self.p.stdout.close()
+    logging.debug('cmd "%s" exited: %d', self.cmd, self.retval)
+    self.p = None
+    self._Finish()
+    if self.timed_out:
+      raise CommandTimedOut(self.cmd, self.retval, self.out)
+    if self.retval:
+      raise CommandExitedWithError(self.cmd, self.retval, self.out)
+
+
+class AsyncSemaphore(object):
+  """Semaphore for coroutines running on the IOLoop.
+
+  >>> sem = AsyncSemaphore(1)
+  >>> sem.Acquire().done()
+  True
+  >>> waiting = sem.Acquire()
+  >>> waiting.done()
+  False
+  >>> sem.Release()
+  >>> waiting.done()
+  True
+  """
+
+  def __init__(self, value):
+    self.value = value
+    self.waiters = collections.deque()
+
+  def Acquire(self):
+    """Returns a future which is resolved when the semaphore is acquired."""
+    future = tornado.concurrent.TracebackFuture()
+    if self.value > 0:
+      self.value -= 1
+      future.set_result(None)
+    else:
+      self.waiters.append(future)
+    return future
+
+  def Release(self):
+    """Releases the semaphore and wakes up the first waiter if any."""
+    if self.waiters:
+      self.waiters.popleft().set_result(None)
+    else:
+      self.value += 1
+
+
+class AsyncExternalCommand(object):
+  """External command driven by the IOLoop.
+
+  This is the asynchronous counterpart of ExternalCommand. Run() is a
+  coroutine which spawns the command, reads its output from a
+  non-blocking pipe on the IOLoop and returns the output as unicode,
+  so that a slow command doesn't block other requests. At most
+  --max_async_commands commands run at once and the others wait for
+  their turn. A command is killed when it runs longer than timeout
+  seconds (--async_command_timeout by default, 0 for no timeout) or
+  when Kill() is called, with its children in its process group.
+
+  >>> io_loop = tornado.ioloop.IOLoop.current()
+  >>> io_loop.run_sync(AsyncExternalCommand(['echo', 'hello']).Run)
+  u'hello\\n'
+
+  >>> cmd = AsyncExternalCommand('echo hello; sleep 10; echo world',
+  ...                            timeout=0.1)
+  >>> io_loop.run_sync(cmd.Run)
+  Traceback (most recent call last):
+    ...
+  CommandTimedOut: command "echo hello; sleep 10; echo world" timed out: -9: hello
+  <BLANKLINE>
+  """
+
+  CHUNK_SIZE = ExternalCommand.CHUNK_SIZE
+  TAIL_SIZE = ExternalCommand.TAIL_SIZE
 
-    line = self.p.stdout.readline()
-    if line == '':
-      self.retval = self.p.wait()
+  _semaphore = None
+
+  def __init__(self, cmd, env=None, cwd=None, timeout=None, tail_size=None):
+    """Instantiates an asynchronous external command for the specified cmd.
+
+    cmd, env and cwd are the same as the ones of ExternalCommand.
+    """
+    self.args = cmd
+    self.cmd = FormatCommand(cmd)
+    self.name = GetCommandName(cmd)
+    self.env = env
+    self.cwd = cwd
+    if timeout is None:
+      timeout = tornado.options.options.async_command_timeout
+    self.timeout = timeout
+    self.tail = TailBuffer(tail_size or self.__class__.TAIL_SIZE)
+    self.process = None
+    self.stdout = None
+    self.retval = None
+    self.killed = False
+    self.timed_out = False
+
+  @property
+  def out(self):
+    """The last part of the output as unicode."""
+    return unicode(self.tail.GetValue(), 'utf-8', 'replace')
+
+  @classmethod
+  def _GetSemaphore(cls):
+    if not AsyncExternalCommand._semaphore:
+      AsyncExternalCommand._semaphore = AsyncSemaphore(
+          tornado.options.options.max_async_commands)
+    return AsyncExternalCommand._semaphore
+
+  def Kill(self):
+    """Kills the command, or cancels it if it hasn't started yet."""
+    self.killed = True
+    if self.process and self.retval is None:
+      logging.debug('sending kill signal to "%s"', self.cmd)
+      _KillProcessGroup(self.process.pid)
+      # Stops reading even if a child of the command still holds the pipe.
+      self.stdout.close()
+
+  def _Timeout(self):
+    self.timed_out = True
+    self.Kill()
+
+  @tornado.gen.coroutine
+  def Run(self, streaming_callback=None):
+    """Runs the command and returns its output.
+
+    If streaming_callback is given, it is called with each chunk of the
+    output as bytes and the output is not returned.
+    """
+    semaphore = self.__class__._GetSemaphore()
+    monitor = GetCommandMonitor()
+    yield semaphore.Acquire()
+    io_loop = tornado.ioloop.IOLoop.current()
+    timeout = None
+    try:
+      if self.killed:
+        raise CommandExitedWithError(self.cmd, -9, '')
+      chunks = []
+      def OnChunk(chunk):
+        self.tail.Append(chunk)
+        if streaming_callback:
+          streaming_callback(chunk)
+        else:
+          chunks.append(chunk)
+
+      logging.debug('executing %s asynchronously', self.cmd)
+      env = self.env and dict(os.environ, **self.env)
+      # tornado.process.Subprocess can't start a new session without
+      # preexec_fn, so the output is read from a pipe of its own.
+      read_fd, write_fd = os.pipe()
+      try:
+        self.process = subprocess.Popen(
+            self.args, shell=isinstance(self.args, basestring),
+            close_fds=True, env=env, cwd=self.cwd, stdout=write_fd,
+            stderr=subprocess.STDOUT, start_new_session=True)
+      except OSError, e:
+        os.close(read_fd)
+        raise CommandExitedWithError(self.cmd, 127, str(e))
+      finally:
+        os.close(write_fd)
+      self.stdout = tornado.iostream.PipeIOStream(read_fd)
+      monitor.Started(self.name)
+      if self.timeout:
+        timeout = io_loop.add_timeout(time.time() + self.timeout,
+                                      self._Timeout)
+
+      yield tornado.gen.Task(self.stdout.read_until_close,
+                             streaming_callback=OnChunk)
+      self.retval = yield self._WaitForExit()
       logging.debug('cmd "%s" exited: %d', self.cmd, self.retval)
-      self.p = None
+      if self.timed_out:
+        raise CommandTimedOut(self.cmd, self.retval, self.out)
       if self.retval:
         raise CommandExitedWithError(self.cmd, self.retval, self.out)
-      raise StopIteration
+      if not streaming_callback:
+        raise tornado.gen.Return(unicode(''.join(chunks), 'utf-8'))
+    finally:
+      if timeout:
+        io_loop.remove_timeout(timeout)
+      if self.process:
+        monitor.Exited(self.name, self.timed_out)
+      semaphore.Release()
+
+  def _WaitForExit(self):
+    # The command usually exits right after closing its output. Polls
+    # instead of handling SIGCHLD, which would interrupt blocking system
+    # calls in other threads.
+    future = tornado.concurrent.TracebackFuture()
+    io_loop = tornado.ioloop.IOLoop.current()
+    def Poll(delay):
+      retval = self.process.poll()
+      if retval is None:
+        io_loop.add_timeout(time.time() + delay,
+                            lambda: Poll(min(delay * 2, 0.1)))
+      else:
+        future.set_result(retval)
+    Poll(0.001)
+    return future
+
+
+def CallAsyncExternalCommand(cmd, **kwargs):
+  """Calls the specified external command on the IOLoop.
+
+  Returns a future of the output. kwargs are passed to
+  AsyncExternalCommand.
+
+  >>> @tornado.gen.coroutine
+  ... def Example():
+  ...   try:
+  ...     yield CallAsyncExternalCommand('echo error; exit 3')
+  ...   except CommandExitedWithError, e:
+  ...     print e
+  >>> tornado.ioloop.IOLoop.current().run_sync(Example)
+  command "echo error; exit 3" exited with an error: 3: error
+  <BLANKLINE>
+  """
+  return AsyncExternalCommand(cmd, **kwargs).Run()
+
+
+def CallInThread(func, *args, **kwargs):
+  """Calls func in a new thread and returns a future of its result.
+
+  This is for blocking code such as sandbox RPCs which can't be
+  rewritten as coroutines. The future is resolved on the IOLoop.
+
+  >>> tornado.ioloop.IOLoop.current().run_sync(
+  ...     lambda: CallInThread(sum, [1, 2, 3]))
+  6
+  """
+  future = tornado.concurrent.TracebackFuture()
+  io_loop = tornado.ioloop.IOLoop.current()
+  def Run():
+    try:
+      result = func(*args, **kwargs)
+    except Exception:
+      io_loop.add_callback(future.set_exc_info, sys.exc_info())
+    else:
+      io_loop.add_callback(future.set_result, result)
+  thread = threading.Thread(target=Run)
+  thread.daemon = True
+  thread.start()
+  return future
+
+
+class SerialWorker(object):
+  """Calls functions one by one in a thread of its own.
+
+  This is for blocking code which isn't thread-safe, such as sandbox
+  RPCs mutating the state of a service. Call() returns a future of the
+  result, which is resolved on the IOLoop.
+
+  >>> worker = SerialWorker()
+  >>> tornado.ioloop.IOLoop.current().run_sync(
+  ...     lambda: worker.Call(sum, [1, 2, 3]))
+  6
+  """
 
-    line = unicode(line, 'utf-8')
-    logging.debug('got a line from "%s": %s', self.cmd, line)
-    self.out += line
-    return line
+  def __init__(self):
+    self.queue = Queue.Queue()
+    self.thread = None
+
+  def Call(self, func, *args, **kwargs):
+    """Queues func and returns a future of its result."""
+    future = tornado.concurrent.TracebackFuture()
+    io_loop = tornado.ioloop.IOLoop.current()
+    if not self.thread:
+      self.thread = threading.Thread(target=self._Run)
+      self.thread.daemon = True
+      self.thread.start()
+    self.queue.put((func, args, kwargs, future, io_loop))
+    return future
+
+  def _Run(self):
+    while True:
+      func, args, kwargs, future, io_loop = self.queue.get()
+      try:
+        result = func(*args, **kwargs)
+      except Exception:
+        io_loop.add_callback(future.set_exc_info, sys.exc_info())
+      else:
+        io_loop.add_callback(future.set_result, result)
 
 
 def GetDataDir():
@@ -6,11 +6,20 @@ __copyright__ = 'Copyright (c) 2013, Masato Taruishi <taru0216@gmail.com>'
 from ips.proto import variables_pb2
 from tornado.options import options, define
 
+import ips.procfs
 import ips.utils
+import ips.varz
 
+import array
+import bisect
+import collections
+import heapq
+import itertools
 import logging
 import os
+import Queue
 import re
+import socket
 import subprocess
 import threading
 import time
@@ -21,156 +30,1168 @@ define(
     help='interval time to update varz in seconds',
     metavar='SEC')
 
+define(
+    'varz_cpu_interval',
+    default=None,
+    type=float,
+    help='interval time to sample cpu utilization in seconds'
+         ' (default: half of --varz_interval)',
+    metavar='SEC')
+
+define(
+    'varz_netstat_netlink',
+    default=False,
+    type=bool,
+    help='counts sockets for netstat varz with sock_diag netlink',
+    metavar='true|false')
+
+define(
+    'varz_history_size',
+    default=120,
+    type=int,
+    help='number of samples kept for each numeric variable and map row',
+    metavar='NUM')
+
+define(
+    'varz_history_max_series',
+    default=10000,
+    type=int,
+    help='maximum number of variables and map rows to keep samples of',
+    metavar='NUM')
+
+define(
+    'varz_workers',
+    default=2,
+    type=int,
+    help='number of threads to run varz collectors',
+    metavar='NUM')
+
 
 def _GetCpuSpeed():
-  cmd = 'cat /proc/cpuinfo | grep "MHz" | head -1 | cut -d: -f2'
-  return int(float(ips.utils.CallExternalCommand(cmd)) * 1000000)
+  return ips.procfs.GetCpuSpeed()
 
 
 def _GetNumCpus():
-  cmd = 'cat /proc/cpuinfo | grep "processor" | wc -l'
-  return int(ips.utils.CallExternalCommand(cmd))
+  return ips.procfs.GetNumCpus()
 
 
 def _GetUptime():
-  cmd = 'cat /proc/uptime | cut -d" " -f1'
-  return float(ips.utils.CallExternalCommand(cmd))
+  return ips.procfs.GetUptime()
 
 
 def _GetStartTime(pid=None):
-  cmd = 'cat /proc/%d/stat | cut -d" " -f22' % (pid or os.getpid())
-  starttime = float(ips.utils.CallExternalCommand(cmd))
-  return starttime / int(os.sysconf('SC_CLK_TCK'))
+  return ips.procfs.GetStartTime(pid)
 
 
 def _GetProcessUptime(pid=None):
   return _GetUptime() - _GetStartTime(pid)
 
 
+def _FormatUptime(uptime, load_averages, now=None):
+  """Formats the uptime and the load averages as uptime(1) does.
+
+  >>> _FormatUptime(93900, (0.39, 0.21, 0.2)).split(' up ')[1]
+  '1 day,  2:05,  load average: 0.39, 0.21, 0.20'
+  >>> _FormatUptime(300, (1, 0, 0)).split(' up ')[1]
+  '5 min,  load average: 1.00, 0.00, 0.00'
+  """
+  uptime = int(uptime)
+  days = uptime / 86400
+  hours = uptime / 3600 % 24
+  minutes = uptime / 60 % 60
+  text = time.strftime('%H:%M:%S', time.localtime(now)) + ' up '
+  if days:
+    text += '%d day%s, ' % (days, days > 1 and 's' or '')
+  if hours:
+    text += '%2d:%02d, ' % (hours, minutes)
+  else:
+    text += '%d min, ' % minutes
+  return text + ' load average: %.2f, %.2f, %.2f' % tuple(load_averages)
+
+
 def _GetUptimeAsString():
-  cmd = 'uptime'
-  return str(ips.utils.CallExternalCommand(cmd)).strip()
+  return _FormatUptime(_GetUptime(), ips.procfs.GetLoadAverages())
 
 
 def _GetLoadAverage():
-  cmd = 'cat /proc/loadavg | cut -d" " -f1'
-  return float(ips.utils.CallExternalCommand(cmd))
+  return ips.procfs.GetLoadAverage()
 
 
 def _GetUname():
-  cmd = 'uname -a'
-  return str(ips.utils.CallExternalCommand(cmd)).strip()
+  return ' '.join(os.uname())
 
 
 def _GetChildrenPids():
-  cmd = "ps --ppid %d %d | awk -F' ' '{print $1;}' | grep -v PID" % (
-      os.getpid(), os.getpid())
-  return ips.utils.CallExternalCommand(cmd).strip().split('\n')
+  return ips.procfs.GetChildrenPids()
 
 
 def _GetProcessCpuSeconds(pids=None):
   pids = pids or _GetChildrenPids()
   jiffies = 0
   for pid in pids:
-    path = '/proc/%d/stat' % int(pid)
-    if os.path.exists(path):
-      cmd = 'cat %s | cut -d" " -f14-17' % path
-      stat = ips.utils.CallExternalCommand(cmd).split(' ')
-      for time in stat:
-        jiffies += int(time)
-  return jiffies / int(os.sysconf('SC_CLK_TCK'))
+    try:
+      jiffies += ips.procfs.GetProcessCpuJiffies(pid)
+    except OSError:
+      # the process has already exited.
+      pass
+  return jiffies / ips.procfs.GetClockTicks()
+
+
+class Collector(object):
+  """Periodic task to create a set of variables.
+
+  A collector calls its function every interval seconds and stores the
+  variables returned by the function into VariableFactory.
+
+  If a run takes longer than budget seconds, the next run is postponed
+  in proportion, so that the collector spends at most budget seconds per
+  interval on average. A run which doesn't finish within timeout seconds
+  is abandoned and its result is discarded.
+
+  >>> c = Collector('test', list, 10, budget=1)
+  >>> c.GetNextDelay()
+  10
+  >>> c.last_duration = 3
+  >>> c.GetNextDelay()
+  30.0
+  """
+
+  def __init__(self, name, func, interval, budget=None, timeout=None):
+    self.name = name
+    self.func = func
+    self.interval = interval
+    self.budget = budget or interval
+    self.timeout = timeout or interval * 2
+
+    self.last_duration = 0.0
+    self.errors = 0
+    self.timeouts = 0
+
+    # start time of the running collection, or None if it's not running.
+    self.started = None
+    self.abandoned = False
+
+  def GetNextDelay(self):
+    """Returns seconds to wait for the next run after the last one."""
+    if self.last_duration > self.budget:
+      return self.interval * float(self.last_duration) / self.budget
+    return self.interval
+
+  def Collect(self):
+    """Calls the function and returns a list of variables."""
+    return self.func() or []
+
+
+class CollectorScheduler(object):
+  """Runs collectors on a small pool of worker threads.
+
+  Collectors are kept in a priority queue ordered by the time of their
+  next run. A dispatcher thread pops collectors when they are due and
+  hands them to the workers. When a collector exceeds its timeout, the
+  worker running it is replaced with a new one, so that a stuck
+  collector doesn't stall the others.
+  """
+
+  def __init__(self, factory, num_workers):
+    self.factory = factory
+    self.num_workers = num_workers
+    self.collectors = []
+    self.queue = []
+    self.seq = itertools.count()
+    self.cond = threading.Condition()
+    self.work = Queue.Queue()
+
+  def Add(self, collector, delay=0):
+    """Schedules the collector to run after delay seconds."""
+    with self.cond:
+      if not collector in self.collectors:
+        self.collectors.append(collector)
+      self._Schedule(collector, delay)
+
+  def Start(self):
+    """Starts the dispatcher and the workers."""
+    for i in range(self.num_workers):
+      self._StartWorker()
+    thread = threading.Thread(target=self._Dispatch)
+    thread.daemon = True
+    thread.start()
+
+  def _Schedule(self, collector, delay):
+    heapq.heappush(self.queue, (time.time() + delay, next(self.seq), collector))
+    self.cond.notify()
+
+  def _StartWorker(self):
+    thread = threading.Thread(target=self._Work)
+    thread.daemon = True
+    thread.start()
+
+  def _Dispatch(self):
+    while True:
+      with self.cond:
+        now = time.time()
+        self._CheckTimeouts(now)
+        if self.queue and self.queue[0][0] <= now:
+          unused_time, unused_seq, collector = heapq.heappop(self.queue)
+          self.work.put(collector)
+          continue
+        wait = 1.0
+        if self.queue:
+          wait = min(wait, self.queue[0][0] - now)
+        self.cond.wait(wait)
+
+  def _CheckTimeouts(self, now):
+    for collector in self.collectors:
+      if (collector.started is not None and not collector.abandoned and
+          now - collector.started > collector.timeout):
+        logging.warning('Collector %s timed out after %d seconds',
+                        collector.name, now - collector.started)
+        collector.abandoned = True
+        collector.timeouts += 1
+        self._StartWorker()
+
+  def _Work(self):
+    while True:
+      collector = self.work.get()
+      start = time.time()
+      # The time waiting for a worker doesn't count against the timeout.
+      with self.cond:
+        collector.started = start
+      variables = []
+      try:
+        variables = collector.Collect()
+      except Exception, e:
+        logging.warning('Error when running collector %s: %s',
+                        collector.name, str(e))
+        collector.errors += 1
+
+      with self.cond:
+        abandoned = collector.abandoned
+        collector.abandoned = False
+        collector.started = None
+        collector.last_duration = time.time() - start
+        self._Schedule(collector, collector.GetNextDelay())
+
+      if abandoned:
+        variables = []
+      duration, errors, timeouts = self.factory.CreateCollectorVariables()
+      # The durations change on every run, so they are stored only with
+      # other changes not to make a new generation by themselves.
+      self.factory.Update(list(variables) + [errors, timeouts],
+                          companions=[duration])
+
+      # the replacement has been started when this worker was abandoned.
+      if abandoned:
+        return
+
+
+class PackageInventory(object):
+  """Inventory of installed deb and rpm packages.
+
+  The package databases are parsed only when their files are modified,
+  so checking a stable host costs just a stat(2) for each database.
+
+  >>> import tempfile
+  >>> status = tempfile.NamedTemporaryFile()
+  >>> status.write(
+  ...     'Package: foo\\n'
+  ...     'Status: install ok installed\\n'
+  ...     'Architecture: all\\n'
+  ...     'Version: 1.0\\n'
+  ...     'Description: foo\\n'
+  ...     ' long description\\n'
+  ...     '\\n'
+  ...     'Package: bar\\n'
+  ...     'Status: deinstall ok config-files\\n'
+  ...     'Architecture: amd64\\n'
+  ...     'Version: 2.0\\n')
+  >>> status.flush()
+  >>> inventory = PackageInventory(dpkg_status=status.name, rpm_databases=[])
+  >>> inventory.Update()
+  True
+  >>> inventory.packages
+  [('deb', 'foo', '1.0', 'all')]
+  >>> inventory.Update()
+  False
+  """
+
+  DPKG_STATUS = '/var/lib/dpkg/status'
+  RPM_DATABASES = ['/var/lib/rpm/Packages', '/var/lib/rpm/rpmdb.sqlite']
+  RPM_QUERY_FORMAT = '%{NAME} %{VERSION}-%{RELEASE} %{ARCH}\\n'
+
+  def __init__(self, dpkg_status=None, rpm_databases=None):
+    self.dpkg_status = dpkg_status or self.__class__.DPKG_STATUS
+    if rpm_databases is None:
+      rpm_databases = self.__class__.RPM_DATABASES
+    self.rpm_databases = rpm_databases
+    self.deb = []
+    self.rpm = []
+    self.packages = []
+    self.signatures = {}
+
+  def Update(self):
+    """Updates the inventory and returns True if it's changed."""
+    changed = False
+    if self._IsModified('deb', [self.dpkg_status]):
+      self.deb = self._ReadDpkgStatus()
+      changed = True
+    if self._IsModified('rpm', self.rpm_databases):
+      self.rpm = self._QueryRpm()
+      changed = True
+    if changed:
+      self.packages = self.deb + self.rpm
+    return changed
+
+  def _IsModified(self, format, paths):
+    signature = []
+    for path in paths:
+      try:
+        st = os.stat(path)
+        signature.append((path, st.st_ino, st.st_size, st.st_mtime))
+      except OSError:
+        pass
+    if self.signatures.get(format) == signature:
+      return False
+    self.signatures[format] = signature
+    return True
+
+  def _ReadDpkgStatus(self):
+    packages = []
+    if not os.path.exists(self.dpkg_status):
+      return packages
+    with open(self.dpkg_status) as f:
+      fields = {}
+      for line in itertools.chain(f, ['\n']):
+        if line == '\n':
+          if fields.get('Status', '').split(' ')[::2] == ['install',
+                                                          'installed']:
+            packages.append(('deb',
+                             fields.get('Package'),
+                             fields.get('Version'),
+                             fields.get('Architecture')))
+          fields = {}
+        elif not line[0].isspace() and ':' in line:
+          name, value = line.split(':', 1)
+          fields[name] = value.strip()
+    return packages
+
+  def _QueryRpm(self):
+    packages = []
+    if not self.signatures.get('rpm'):
+      return packages
+    try:
+      argv = ['rpm', '-qa', '--queryformat', self.__class__.RPM_QUERY_FORMAT]
+      for line in ips.utils.ExternalCommand(argv):
+        query = line.strip().split(' ')
+        if len(query) == 3:
+          packages.append(('rpm', query[0], query[1], query[2]))
+    except ips.utils.CommandExitedWithError:
+      pass
+    return packages
+
+
+class KeyIndex(object):
+  """Index of variable keys for selective queries.
+
+  Keys are kept sorted to look up keys by prefix, and keys of map
+  variables are indexed by their columns.
+
+  >>> index = KeyIndex()
+  >>> index.Add('cpu-speed')
+  >>> index.Add('cpu-utilization-per-cpu', ['cpu'])
+  >>> index.Add('uptime')
+  >>> index.Select(prefixes=['cpu-'])
+  ['cpu-speed', 'cpu-utilization-per-cpu']
+  >>> index.Select(columns=['cpu'])
+  ['cpu-utilization-per-cpu']
+  >>> index.Remove('cpu-speed')
+  >>> index.Select(prefixes=['cpu-', 'up'])
+  ['cpu-utilization-per-cpu', 'uptime']
+  """
+
+  def __init__(self):
+    self.keys = []
+    # column -> set of keys
+    self.columns = {}
+    # key -> columns of the key
+    self.key_columns = {}
+
+  def Add(self, key, columns=()):
+    """Adds the key of a variable which has the columns."""
+    i = bisect.bisect_left(self.keys, key)
+    if i == len(self.keys) or self.keys[i] != key:
+      self.keys.insert(i, key)
+    columns = tuple(columns)
+    if self.key_columns.get(key, ()) != columns:
+      self._RemoveColumns(key)
+      self.key_columns[key] = columns
+      for column in columns:
+        self.columns.setdefault(column, set()).add(key)
+
+  def Remove(self, key):
+    """Removes the key."""
+    i = bisect.bisect_left(self.keys, key)
+    if i < len(self.keys) and self.keys[i] == key:
+      del self.keys[i]
+    self._RemoveColumns(key)
+    self.key_columns.pop(key, None)
+
+  def Select(self, prefixes=None, columns=None):
+    """Returns sorted keys which start with one of the prefixes and
+    have all the columns."""
+    if prefixes:
+      keys = set()
+      for prefix in prefixes:
+        i = bisect.bisect_left(self.keys, prefix)
+        while i < len(self.keys) and self.keys[i].startswith(prefix):
+          keys.add(self.keys[i])
+          i += 1
+      keys = sorted(keys)
+    else:
+      keys = list(self.keys)
+    for column in columns or []:
+      keys_with_column = self.columns.get(column, ())
+      keys = [key for key in keys if key in keys_with_column]
+    return keys
+
+  def Copy(self):
+    """Returns a copy of this index."""
+    index = self.__class__()
+    index.keys = list(self.keys)
+    index.columns = dict(
+        (column, set(keys)) for column, keys in self.columns.iteritems())
+    index.key_columns = dict(self.key_columns)
+    return index
+
+  def _RemoveColumns(self, key):
+    for column in self.key_columns.get(key, ()):
+      self.columns[column].discard(key)
+
+
+class RingBuffer(object):
+  """Fixed-size buffer of the last (time, value) samples.
+
+  The arrays are allocated at once, so the memory used doesn't change.
+
+  >>> buf = RingBuffer(2)
+  >>> for t in range(3):
+  ...   buf.Append(t, t * 10)
+  >>> buf.Get()
+  ([1.0, 2.0], [10.0, 20.0])
+  >>> buf.Get(since=2)
+  ([2.0], [20.0])
+  """
+
+  def __init__(self, size):
+    self.times = array.array('d', [0.0]) * size
+    self.values = array.array('d', [0.0]) * size
+    self.size = size
+    # index of the next sample and the number of samples
+    self.next = 0
+    self.count = 0
+
+  def Append(self, time, value):
+    self.times[self.next] = time
+    self.values[self.next] = value
+    self.next = (self.next + 1) % self.size
+    self.count = min(self.count + 1, self.size)
+
+  def Get(self, since=None):
+    """Returns lists of times and values of the samples since the time,
+    oldest first."""
+    start = (self.next - self.count) % self.size
+    indexes = [(start + i) % self.size for i in xrange(self.count)]
+    if since is not None:
+      indexes = [i for i in indexes if self.times[i] >= since]
+    return ([self.times[i] for i in indexes],
+            [self.values[i] for i in indexes])
+
+
+class VariableHistory(object):
+  """History of numeric variables and map rows.
+
+  Each series has a RingBuffer of size samples, and at most max_series
+  series are kept, so the memory used is bounded.
+
+  >>> history = VariableHistory(10, 100)
+  >>> var = variables_pb2.Variable()
+  >>> var.key = 'load'
+  >>> var.type = variables_pb2.Variable.GAUGE
+  >>> for t in range(3):
+  ...   var.value.gauge = t
+  ...   history.Record([var], t)
+  >>> sorted(history.Get('load', since=1).items())
+  [('key', 'load'), ('times', [1.0, 2.0]), ('values', [1.0, 2.0])]
+  """
+
+  def __init__(self, size, max_series):
+    self.size = size
+    self.max_series = max_series
+    # key -> RingBuffer, or {column names: RingBuffer} for maps
+    self.series = {}
+    # key -> columns of maps
+    self.columns = {}
+    self.num_series = 0
+    self.lock = threading.Lock()
+
+  def Record(self, variables, now):
+    """Appends samples of the numeric variables."""
+    with self.lock:
+      for var in variables:
+        if var.type == variables_pb2.Variable.GAUGE:
+          self._GetBuffer(var.key).Append(now, var.value.gauge)
+        elif var.type == variables_pb2.Variable.COUNTER:
+          self._GetBuffer(var.key).Append(now, var.value.counter)
+        elif (var.type == variables_pb2.Variable.MAP and
+              _GetMapType(var) != variables_pb2.Variable.Value.Map.STRING):
+          self.columns[var.key] = _GetColumns(var)
+          rows = self.series.setdefault(var.key, {})
+          for column_names, value in ips.varz.GetMapRows(var):
+            buf = rows.get(column_names)
+            if buf is None:
+              buf = rows[column_names] = self._NewBuffer()
+            if buf:
+              buf.Append(now, value)
+
+  def Remove(self, key):
+    """Removes the history of the variable."""
+    with self.lock:
+      series = self.series.pop(key, None)
+      self.columns.pop(key, None)
+      if isinstance(series, dict):
+        self.num_series -= len([buf for buf in series.values() if buf])
+      elif series:
+        self.num_series -= 1
+
+  def Get(self, key, since=None, columns=None):
+    """Returns the samples of the variable since the time.
+
+    The samples of a map are returned for each row, which can be
+    filtered by a dict of column to acceptable values. None is returned
+    if the variable has no history.
+    """
+    with self.lock:
+      series = self.series.get(key)
+      if not series:
+        return None
+      if not isinstance(series, dict):
+        times, values = series.Get(since)
+        return {'key': key, 'times': times, 'values': values}
+      map_columns = self.columns[key]
+      indexes = []
+      for column, acceptable in (columns or {}).iteritems():
+        if not column in map_columns:
+          return None
+        indexes.append((map_columns.index(column), acceptable))
+      rows = []
+      for column_names, buf in sorted(series.iteritems()):
+        if not buf or [i for i, acceptable in indexes
+                       if not column_names[i] in acceptable]:
+          continue
+        times, values = buf.Get(since)
+        rows.append({'column_names': list(column_names),
+                     'times': times,
+                     'values': values})
+      return {'key': key, 'columns': list(map_columns), 'rows': rows}
+
+  def _GetBuffer(self, key):
+    buf = self.series.get(key)
+    if buf is None:
+      buf = self.series[key] = self._NewBuffer()
+    return buf or _NULL_BUFFER
+
+  def _NewBuffer(self):
+    # False is kept for series over max_series not to look them up again.
+    if self.num_series >= self.max_series:
+      return False
+    self.num_series += 1
+    return RingBuffer(self.size)
+
+
+class _NullBuffer(object):
+
+  def Append(self, time, value):
+    pass
+
+
+_NULL_BUFFER = _NullBuffer()
+
+
+def _GetMapType(var):
+  if isinstance(var, ips.varz.CompactMapVariable):
+    return var.map_type
+  return var.value.map.type
+
+
+def _GetColumns(var):
+  if isinstance(var, ips.varz.CompactMapVariable):
+    return var.columns
+  if var.type == variables_pb2.Variable.MAP:
+    return tuple(var.value.map.columns)
+  return ()
+
+
+class Snapshot(collections.Mapping):
+  """Immutable generation of variables.
+
+  VariableFactory publishes a new snapshot for every update and never
+  modifies a published one, so readers can use a snapshot without any
+  lock and always see all variables of the same generation.
+  """
+
+  def __init__(self, generation, variables=None, modified=None, removed=None,
+               oldest_generation=None, key_index=None):
+    self.generation = generation
+    # key -> variable
+    self.variables = variables or {}
+    # key -> generation in which the variable was changed last.
+    self.modified = modified or {}
+    # removed key -> generation in which the key was removed.
+    self.removed = removed or collections.OrderedDict()
+    # the oldest generation GetChanges() can return changes since.
+    if oldest_generation is None:
+      oldest_generation = generation
+    self.oldest_generation = oldest_generation
+    self.key_index = key_index or KeyIndex()
+
+  def __getitem__(self, key):
+    return self.variables[key]
+
+  def __iter__(self):
+    return iter(self.variables)
+
+  def __len__(self):
+    return len(self.variables)
+
+  def keys(self):
+    return self.variables.keys()
+
+  def values(self):
+    return self.variables.values()
+
+  def items(self):
+    return self.variables.items()
+
+  def iterkeys(self):
+    return self.variables.iterkeys()
+
+  def itervalues(self):
+    return self.variables.itervalues()
+
+  def iteritems(self):
+    return self.variables.iteritems()
 
+  def GetChanges(self, since):
+    """Returns the variables changed since the generation.
+
+    See VariableFactory.GetChanges().
+    """
+    if since < self.oldest_generation or since > self.generation:
+      return None
+    changed = [self.variables[key] for key, generation
+               in self.modified.iteritems() if generation > since]
+    removed = [key for key, generation
+               in self.removed.iteritems() if generation > since]
+    return self.generation, changed, removed
+
+  def Select(self, prefixes=None, regex=None, columns=None):
+    """Selects variables by key prefixes, key regex and map column values.
+
+    See VariableFactory.Select().
+    """
+    keys = self.key_index.Select(prefixes, columns and columns.keys())
+    return list(ips.varz.SelectVariables(
+        [self.variables[key] for key in keys], regex=regex, columns=columns))
+
+
+class VariableFactory(collections.Mapping):
+
+  # maximum number of removed keys remembered for GetChanges()
+  MAX_REMOVED_KEYS = 1024
+
+  class CpuSampler(object):
+    """Samples CPU utilization by diffing /proc/stat between ticks.
+
+    >>> f = VariableFactory()
+    >>> sampler = VariableFactory.CpuSampler(f)
+    >>> sampler.Sample()
+    []
+    >>> time.sleep(0.2)
+    >>> variables = dict((var.key, var) for var in sampler.Sample())
+    >>> 0.0 <= variables['cpu-utilization'].value.gauge <= 1.0
+    True
+    >>> 'cpu-time-percentage' in variables
+    True
 
-class VariableFactory(dict):
+    """
 
-  class TopRunner(threading.Thread):
+    STATES = ips.procfs.CPU_STATES
 
     def __init__(self, factory):
-      super(self.__class__, self).__init__()
-      self.setDaemon(True)
-      self.spliter = re.compile('[ %]+')
       self.factory = factory
+      self.previous = None
+
+    def Sample(self):
+      """Returns the cpu variables for the times since the last sample."""
+      current = ips.procfs.GetCpuTimes()
+      previous, self.previous = self.previous, current
+      if previous is None:
+        return []
+
+      percentages = {}
+      for cpu, jiffies in current.iteritems():
+        if not cpu in previous:
+          continue
+        delta = [now - before for now, before in zip(jiffies, previous[cpu])]
+        total = sum(delta)
+        if total <= 0:
+          continue
+        percentages[cpu] = dict(
+            zip(self.__class__.STATES, [float(d) / total for d in delta]))
+
+      if not 'cpu' in percentages:
+        return []
+      all = percentages.pop('cpu')
+
+      variables = [
+          # user + sys + nice
+          self.factory.CreateGaugeVariable(
+              'cpu-utilization', self._GetUtilization(all)),
+          # wait
+          self.factory.CreateGaugeVariable(
+              'synchronization-wait-percentage', all['iowait']),
+          self.factory.CreateGaugeVariable(
+              'cpu-steal-percentage', all['steal']),
+          self.factory.CreateGaugeVariable(
+              'cpu-irq-percentage', all['irq'] + all['softirq']),
+      ]
+
+      utilization = []
+      times = []
+      for cpu, percentage in sorted(percentages.iteritems()):
+        utilization.append((cpu, self._GetUtilization(percentage)))
+        for state in self.__class__.STATES:
+          times.append((cpu, state, percentage[state]))
+      variables.append(self.factory.CreateMapVariable(
+          'cpu-utilization-per-cpu', ['cpu'], values=utilization))
+      variables.append(self.factory.CreateMapVariable(
+          'cpu-time-percentage', ['cpu', 'state'], values=times))
+      return variables
+
+    def _GetUtilization(self, percentage):
+      return percentage['user'] + percentage['system'] + percentage['nice']
+
+  class RateCalculator(object):
+    """Derives '<key>-rate' gauges from counter variables.
+
+    The previous value and time of every counter and map counter are
+    kept to calculate the increase per second. A counter which decreased
+    is regarded as reset to 0.
+
+    >>> f = VariableFactory()
+    >>> calculator = VariableFactory.RateCalculator(f)
+    >>> calculator.Calculate([f.CreateCounterVariable('requests', 10)], 100)
+    []
+    >>> rates = calculator.Calculate(
+    ...     [f.CreateCounterVariable('requests', 30)], 110)
+    >>> print rates[0].key, rates[0].value.gauge
+    requests-rate 2.0
+    >>> rates = calculator.Calculate(
+    ...     [f.CreateCounterVariable('requests', 5)], 115)
+    >>> rates[0].value.gauge
+    1.0
+    """
+
+    SUFFIX = '-rate'
 
-    def run(self):
-      while True:
-        try:
-          self._RunTop()
-        except Exception, e:
-          logging.warning('Failed to run top: %s', str(e))
-        time.sleep(self.factory.interval / 2)
-
-    def _RunTop(self):
-      top = ips.utils.CallExternalCommand(
-          'top -b -n 2 -d %d | grep Cpu | cut -d: -f2- | tail -1' % (
-              self.factory.interval / 2))
-      vals = self.spliter.split(top)
-
-      # user + sys + nice
-      var = self.factory.CreateGaugeVariable(
-        'cpu-utilization',
-        (float(vals[1]) + float(vals[3]) + float(vals[5])) / 100)
-      self.factory[var.key] = var
-
-      # wait
-      var = self.factory.CreateGaugeVariable(
-        'synchronization-wait-percentage', float(vals[9]) / 100)
-      self.factory[var.key] = var
+    def __init__(self, factory):
+      self.factory = factory
+      # key -> (time, value), or (time, {column names: value}) for maps
+      self.previous = {}
+
+    def Calculate(self, variables, now=None):
+      """Returns the rate variables of the counters in the variables."""
+      now = now or time.time()
+      rates = []
+      for var in variables:
+        if var.type == variables_pb2.Variable.COUNTER:
+          rate = self._CalculateCounterRate(var, now)
+        elif (var.type == variables_pb2.Variable.MAP and
+              _GetMapType(var) == variables_pb2.Variable.Value.Map.COUNTER):
+          rate = self._CalculateMapRate(var, now)
+        else:
+          continue
+        if rate:
+          rates.append(rate)
+      return rates
+
+    def Forget(self, key):
+      """Forgets the previous value of the counter."""
+      self.previous.pop(key, None)
+
+    def _CalculateCounterRate(self, var, now):
+      previous = self.previous.get(var.key)
+      self.previous[var.key] = (now, var.value.counter)
+      if not previous or now <= previous[0]:
+        return None
+      return self.factory.CreateGaugeVariable(
+          var.key + self.SUFFIX,
+          self._GetRate(previous[1], var.value.counter, now - previous[0]))
+
+    def _CalculateMapRate(self, var, now):
+      previous = self.previous.get(var.key)
+      values = dict(ips.varz.GetMapRows(var))
+      self.previous[var.key] = (now, values)
+      if not previous or now <= previous[0]:
+        return None
+      elapsed = now - previous[0]
+      rows = []
+      for column_names, value in values.iteritems():
+        if column_names in previous[1]:
+          rows.append(column_names + (
+              self._GetRate(previous[1][column_names], value, elapsed),))
+      return self.factory.CreateCompactMapVariable(
+          var.key + self.SUFFIX, _GetColumns(var), values=sorted(rows))
+
+    def _GetRate(self, previous, value, elapsed):
+      if value < previous:
+        # reset
+        previous = 0
+      return float(value - previous) / elapsed
 
   def __init__(self, interval=None):
     super(self.__class__, self).__init__()
+    # serializes updates. Readers don't need it.
+    self.lock = threading.Lock()
+    # The generation is incremented every time variables are updated. It
+    # starts from the time in milliseconds so that a generation of a
+    # previous process is older than any generation of this process.
+    self.snapshot = Snapshot(int(time.time() * 1000))
+    # the snapshot replaced by the current one.
+    self.previous = None
+    self.rates = self.RateCalculator(self)
+    self.history = VariableHistory(options.varz_history_size,
+                                   options.varz_history_max_series)
+    # functions called with the generation when variables are updated.
+    self.listeners = []
     self.interval = interval or float(options.varz_interval)
 
-    self.thread = threading.Thread(target=self.Run)
-    self.thread.daemon = True
+    self.scheduler = CollectorScheduler(self, options.varz_workers)
+    self.collectors = {}
+
+    self.package_inventory = PackageInventory()
+    self.packages_variable = None
 
     self._GenSystemVariables()
+    self.RegisterCollector('system', self.CreateSystemVariables, self.interval)
+    self.RegisterCollector('commands', self.CreateExternalCommandVariables,
+                           self.interval)
+    self.RegisterCollector('cpu', self.CpuSampler(self).Sample,
+                           options.varz_cpu_interval or self.interval / 2)
+
+  @property
+  def generation(self):
+    return self.snapshot.generation
+
+  def GetSnapshot(self):
+    """Returns the current snapshot of the variables."""
+    return self.snapshot
+
+  # Reads go to the current snapshot.
+
+  def __getitem__(self, key):
+    return self.snapshot[key]
+
+  def __iter__(self):
+    return iter(self.snapshot)
+
+  def __len__(self):
+    return len(self.snapshot)
+
+  def keys(self):
+    return self.snapshot.keys()
+
+  def values(self):
+    return self.snapshot.values()
+
+  def items(self):
+    return self.snapshot.items()
+
+  def iterkeys(self):
+    return self.snapshot.iterkeys()
+
+  def itervalues(self):
+    return self.snapshot.itervalues()
+
+  def iteritems(self):
+    return self.snapshot.iteritems()
+
+  def __setitem__(self, key, var):
+    if key != var.key:
+      raise KeyError('%s is not the key of the variable %s' % (key, var.key))
+    self.Update([var])
+
+  def __delitem__(self, key):
+    self._Publish([], [key])
+
+  def Update(self, variables, companions=()):
+    """Stores the variables as one new generation.
+
+    '<key>-rate' gauges of counters in the variables are stored as well.
+    See RateCalculator. No generation is made if none of the variables
+    changes. companions are variables which are stored only when a new
+    generation is made by the other variables.
+
+    >>> f = VariableFactory()
+    >>> snapshot = f.GetSnapshot()
+    >>> f.Update([f.CreateGaugeVariable('a'), f.CreateGaugeVariable('b')])
+    >>> f.generation - snapshot.generation
+    1
+    >>> 'a' in f, 'a' in snapshot, f.previous is snapshot
+    (True, False, True)
+    >>> f.Update([f.CreateGaugeVariable('a')],
+    ...          companions=[f.CreateGaugeVariable('c')])
+    >>> f.generation - snapshot.generation, 'c' in f
+    (1, False)
+    """
+    self._Publish(variables, [], companions)
+
+  def _Publish(self, variables, removed_keys, companions=()):
+    """Builds a new snapshot with the changes and replaces the current
+    one with it."""
+    with self.lock:
+      current = self.snapshot
+      now = time.time()
+      variables = list(variables)
+      variables.extend(self.rates.Calculate(variables, now))
+      # The same variable object is returned by a collector while its
+      # value doesn't change, e.g. packages, which isn't worth sampling.
+      self.history.Record(
+          [var for var in variables if current.get(var.key) is not var], now)
+      variables = [var for var in variables
+                   if current.variables.get(var.key) != var]
+      if not variables and not removed_keys:
+        return
+      variables.extend(var for var in companions
+                       if current.variables.get(var.key) != var)
+      for key in list(removed_keys):
+        self.rates.Forget(key)
+        self.history.Remove(key)
+        rate_key = key + self.RateCalculator.SUFFIX
+        if rate_key in current and not rate_key in removed_keys:
+          removed_keys.append(rate_key)
+          self.history.Remove(rate_key)
+      generation = current.generation + 1
+      values = dict(current.variables)
+      modified = dict(current.modified)
+      removed = current.removed
+      oldest_generation = current.oldest_generation
+      key_index = current.key_index
+      # The removed keys and the key index are copied only if they change.
+      for var in variables:
+        columns = _GetColumns(var)
+        if (not var.key in values or
+            key_index.key_columns.get(var.key, ()) != columns):
+          if key_index is current.key_index:
+            key_index = key_index.Copy()
+          key_index.Add(var.key, columns)
+        values[var.key] = var
+        modified[var.key] = generation
+        if var.key in removed:
+          if removed is current.removed:
+            removed = collections.OrderedDict(removed)
+          del removed[var.key]
+      for key in removed_keys:
+        del values[key]
+        del modified[key]
+        if key_index is current.key_index:
+          key_index = key_index.Copy()
+        key_index.Remove(key)
+        if removed is current.removed:
+          removed = collections.OrderedDict(removed)
+        removed[key] = generation
+        if len(removed) > self.MAX_REMOVED_KEYS:
+          unused_key, oldest_generation = removed.popitem(last=False)
+      self.previous = current
+      self.snapshot = Snapshot(generation, values, modified, removed,
+                               oldest_generation, key_index)
+    self._Notify()
+
+  def AddListener(self, listener):
+    """Adds a function called with the generation on every update.
+
+    The function is called in the thread which updated the variables.
+
+    >>> f = VariableFactory()
+    >>> generations = []
+    >>> f.AddListener(generations.append)
+    >>> f.Update([f.CreateGaugeVariable('a')])
+    >>> generations == [f.generation]
+    True
+    >>> f.RemoveListener(generations.append)
+    """
+    with self.lock:
+      self.listeners = self.listeners + [listener]
+
+  def RemoveListener(self, listener):
+    """Removes the function added by AddListener()."""
+    with self.lock:
+      listeners = list(self.listeners)
+      listeners.remove(listener)
+      self.listeners = listeners
+
+  def _Notify(self):
+    generation = self.generation
+    for listener in self.listeners:
+      try:
+        listener(generation)
+      except Exception:
+        logging.exception('Failed to notify the update of variables')
+
+  def GetChanges(self, since):
+    """Returns the variables changed since the generation.
+
+    (generation, changed variables, removed keys) is returned, or None
+    if the changes since the generation are no longer known, in which
+    case the caller should fall back to a full snapshot.
+
+    >>> f = VariableFactory()
+    >>> f.Update([f.CreateGaugeVariable('a'), f.CreateGaugeVariable('b')])
+    >>> since = f.generation
+    >>> f.Update([f.CreateGaugeVariable('a', 1), f.CreateGaugeVariable('b')])
+    >>> del f['b']
+    >>> generation, changed, removed = f.GetChanges(since)
+    >>> generation - since, [var.key for var in changed], removed
+    (2, [u'a'], ['b'])
+    >>> f.GetChanges(-1)
+    """
+    return self.snapshot.GetChanges(since)
+
+  def Select(self, prefixes=None, regex=None, columns=None):
+    """Selects variables by key prefixes, key regex and map column values.
+
+    The candidates are looked up in the key index. See
+    ips.varz.SelectVariables for the arguments.
+
+    >>> f = VariableFactory()
+    >>> [var.key for var in f.Select(prefixes=['uptime'])]
+    [u'uptime', u'uptime-as-string']
+    """
+    return self.snapshot.Select(prefixes, regex, columns)
 
   def Start(self):
     if self.interval > 0:
-      self.thread.start()
+      logging.info('Starting system variable updater')
+      self.scheduler.Start()
     else:
       logging.info('Not updating varz periodicallyl since interval is 0')
 
-  def Run(self):
-    logging.info('Starting system variable updater')
-
-    top = self.__class__.TopRunner(self)
-    top.start()
+  def RegisterCollector(self, name, func, interval, budget=None, timeout=None,
+                        delay=None):
+    """Registers a collector which updates variables periodically.
 
-    while True:
-      try:
-        self._UpdateVariable()
-      except Exception, e:
-        logging.warning('Error when getting system variables: %s', str(e))
-      time.sleep(self.interval)
+    func is called every interval seconds and should return a list of
+    variables. The first call happens after delay seconds, which is the
+    same as interval by default. See Collector for budget and timeout.
 
-  def _UpdateVariable(self):
-    self._GenSystemVariables()
+    >>> f = VariableFactory()
+    >>> c = f.RegisterCollector('test', lambda: [], 10)
+    >>> f.collectors['test'].interval
+    10
+    """
+    collector = Collector(name, func, interval, budget, timeout)
+    self.collectors[name] = collector
+    if delay is None:
+      delay = interval
+    self.scheduler.Add(collector, delay)
+    return collector
+
+  # Built-in collectors: name -> (interval, budget, timeout) in units of
+  # the update interval.
+  BUILTIN_COLLECTORS = {
+      'network': (1, 0.1, 1),
+      'disk': (2, 0.1, 2),
+      'memory': (1, 0.1, 1),
+      'netstat': (2, 0.5, 2),
+      'packages': (1, 1, 5),
+  }
+
+  def EnableCollector(self, name):
+    """Creates variables of the built-in collector and keeps them updated.
 
-    # network
-    if 'network-rx-bytes' in self:
-      for var in self.CreateNetworkBytesVariables():
-        self[var.key] = var
+    >>> f = VariableFactory()
+    >>> c = f.EnableCollector('memory')
+    >>> 'memory-total' in f
+    True
+    """
+    func = {
+        'network': self.CreateNetworkBytesVariables,
+        'disk': self.CreateDiskStatisticsVariables,
+        'memory': self.CreateMemoryStatisticsVariables,
+        'netstat': lambda: [self.CreateNetstatVariable()],
+        'packages': lambda: [self.CreatePackagesStatisticsVariable()],
+    }[name]
+    self.Update(func())
+    interval, budget, timeout = self.__class__.BUILTIN_COLLECTORS[name]
+    return self.RegisterCollector(name, func,
+                                  interval * self.interval,
+                                  budget * self.interval,
+                                  timeout * self.interval)
+
+  def CreateCollectorVariables(self):
+    """Creates variables containing statistics of collectors.
 
-    # disk
-    if 'disk-usage' in self:
-      for var in self.CreateDiskStatisticsVariables():
-        self[var.key] = var
+    >>> f = VariableFactory()
+    >>> for var in f.CreateCollectorVariables():
+    ...   print var.key
+    varz-collector-duration
+    varz-collector-errors
+    varz-collector-timeouts
 
-    # memory
-    if 'memory-total' in self:
-      for var in self.CreateMemoryStatisticsVariables():
-        self[var.key] = var
+    """
+    durations = []
+    errors = []
+    timeouts = []
+    for name, collector in sorted(self.collectors.iteritems()):
+      durations.append((name, collector.last_duration))
+      errors.append((name, collector.errors))
+      timeouts.append((name, collector.timeouts))
+    counter = variables_pb2.Variable.Value.Map.COUNTER
+    return [
+        self.CreateMapVariable('varz-collector-duration', ['collector'],
+                               values=durations),
+        self.CreateMapVariable('varz-collector-errors', ['collector'],
+                               type=counter, values=errors),
+        self.CreateMapVariable('varz-collector-timeouts', ['collector'],
+                               type=counter, values=timeouts),
+    ]
+
+  def CreateExternalCommandVariables(self):
+    """Creates variables containing statistics of external commands.
 
-    # packages
-    if 'packages' in self:
-      var = self.CreatePackagesStatisticsVariable()
-      self[var.key] = var
+    >>> f = VariableFactory()
+    >>> for var in f.CreateExternalCommandVariables():
+    ...   print var.key
+    external-commands-spawned
+    external-commands-timed-out
+    external-commands-in-flight
 
-    # netstat
-    if 'netstat' in self:
-      var = self.CreateNetstatVariable()
-      self[var.key] = var
+    """
+    spawned = []
+    timed_out = []
+    in_flight = []
+    for name, s, t, i in ips.utils.GetCommandMonitor().GetStatistics():
+      spawned.append((name, s))
+      timed_out.append((name, t))
+      in_flight.append((name, i))
+    counter = variables_pb2.Variable.Value.Map.COUNTER
+    return [
+        self.CreateMapVariable('external-commands-spawned', ['command'],
+                               type=counter, values=spawned),
+        self.CreateMapVariable('external-commands-timed-out', ['command'],
+                               type=counter, values=timed_out),
+        self.CreateMapVariable('external-commands-in-flight', ['command'],
+                               values=in_flight),
+    ]
 
   def CreateCounterVariable(self, key, value=0):
     """Creates Counter Variable.
@@ -294,6 +1315,32 @@ class VariableFactory(dict):
         value.string = str(val)
     return proto
 
+  def CreateCompactMapVariable(self,
+                               key,
+                               columns,
+                               type=variables_pb2.Variable.Value.Map.GAUGE,
+                               values=None):
+    """Creates map variables stored in arrays.
+
+    This takes the same arguments as CreateMapVariable(), and is
+    preferable for maps which have many rows. See
+    ips.varz.CompactMapVariable.
+
+    >>> f = VariableFactory()
+    >>> var = f.CreateCompactMapVariable(
+    ...     'counter',
+    ...     ['interface', 'type'],
+    ...     variables_pb2.Variable.Value.Map.COUNTER,
+    ...     [('eth0', 'success', 0), ('eth0', 'error', 10)])
+    >>> var == f.CreateMapVariable(
+    ...     'counter',
+    ...     ['interface', 'type'],
+    ...     variables_pb2.Variable.Value.Map.COUNTER,
+    ...     [('eth0', 'success', 0), ('eth0', 'error', 10)])
+    True
+    """
+    return ips.varz.CompactMapVariable(key, columns, type, values)
+
   def CreateBuildTimestampVariables(self, timestamp=None):
     """Creates variables containing build-timestamp and build-timestamp-as-int.
 
@@ -384,8 +1431,7 @@ class VariableFactory(dict):
     'cmdline'
 
     """
-    cmd = 'cat /proc/%d/cmdline' % os.getpid()
-    cmdline = ips.utils.CallExternalCommand(cmd).strip().split('\0')
+    cmdline = ips.procfs.GetCmdline()
     return self.CreateStringVariable('cmdline', ' '.join(cmdline))
 
   def CreateProcessUptime(self):
@@ -452,10 +1498,11 @@ class VariableFactory(dict):
     for target in pids_for_targets:
       cpu = _GetProcessCpuSeconds(pids_for_targets[target])
       values.append((target, cpu))
-    return self.CreateMapVariable('target-process-cpu-seconds',
-                                  ['target'],
-                                  type=variables_pb2.Variable.Value.Map.COUNTER,
-                                  values=values)
+    return self.CreateCompactMapVariable(
+        'target-process-cpu-seconds',
+        ['target'],
+        type=variables_pb2.Variable.Value.Map.COUNTER,
+        values=values)
 
   def CreateUname(self):
     """Creates a variable containing uname.
@@ -468,48 +1515,48 @@ class VariableFactory(dict):
     """
     return self.CreateStringVariable('uname', _GetUname())
 
-  def _GetInterfaces(self):
-    return ips.utils.CallExternalCommand(
-        "ip maddr | grep '^[0-9]' |"
-        " awk -F' ' '{print $2;}'").strip().split('\n')
+  def CreateNetworkBytesVariables(self):
+    """Creates variables containing network-rx/tx-bytes.
 
-  def _CreateNetworkBytesVariable(self, type):
-    column = {'rx': 2, 'tx': 3}[type]
-    values = []
-    for interface in self._GetInterfaces():
-      values.append(
-          (interface,
-           int(ips.utils.CallExternalCommand(
-               'ifconfig "%s" | grep "RX bytes" |'
-               ' cut -d":" -f%d | cut -d" " -f1' % (interface,
-                                                    column)))))
-    val = self.CreateMapVariable(
-        'network-%s-bytes' % type,
-        ['interface'],
-        type=variables_pb2.Variable.Value.Map.COUNTER, values=values)
-    return val
+    >>> f = VariableFactory()
+    >>> for var in f.CreateNetworkBytesVariables():
+    ...   print var.key
+    network-rx-bytes
+    network-tx-bytes
+
+    """
+    values = {'rx': [], 'tx': []}
+    for interface, (rx, tx) in sorted(
+        ips.procfs.GetNetworkBytes().iteritems()):
+      values['rx'].append((interface, rx))
+      values['tx'].append((interface, tx))
 
-  def CreateNetworkBytesVariables(self):
-    """Creates variables containing network-rx/tx-bytes."""
     variables = []
-    variables.append(self._CreateNetworkBytesVariable('rx'))
-    variables.append(self._CreateNetworkBytesVariable('tx'))
+    for type in ['rx', 'tx']:
+      variables.append(self.CreateMapVariable(
+          'network-%s-bytes' % type,
+          ['interface'],
+          type=variables_pb2.Variable.Value.Map.COUNTER,
+          values=values[type]))
     return variables
 
   def CreateDiskStatisticsVariables(self):
-    """Creates variables containing disk usage and size."""
+    """Creates variables containing disk usage and size.
+
+    >>> f = VariableFactory()
+    >>> for key in sorted(v.key for v in f.CreateDiskStatisticsVariables()):
+    ...   print key
+    disk-size
+    disk-usage
+
+    """
     columns = ['mounted']
     variables = []
 
     values = {'disk-usage': [], 'disk-size': []}
-    cmd = "df | grep / | awk -F' ' '{print $6;}'"
-
-    # usage
-    for mounted in ips.utils.CallExternalCommand(cmd).strip().split('\n'):
-      cmd = 'df -T -B 1 %s | tail -1' % mounted
-      usage = re.split(' +', ips.utils.CallExternalCommand(cmd).strip())
-      values['disk-usage'].append((usage[6], int(usage[3])))
-      values['disk-size'].append((usage[6], int(usage[2])))
+    for mounted, size, used in ips.procfs.GetDiskStatistics():
+      values['disk-usage'].append((mounted, used))
+      values['disk-size'].append((mounted, size))
 
     for var, values in values.iteritems():
       val = self.CreateMapVariable(var, columns, values=values)
@@ -518,73 +1565,91 @@ class VariableFactory(dict):
     return variables
 
   def CreateMemoryStatisticsVariables(self):
-    """Creates variables containing disk usage and size."""
-    variables = []
+    """Creates variables containing memory usage.
+
+    The values are the same as the ones shown by free -b.
 
-    mem = re.split(
-        ' +',
-        ips.utils.CallExternalCommand('free -b | grep Mem:').strip())
+    >>> f = VariableFactory()
+    >>> for var in f.CreateMemoryStatisticsVariables():
+    ...   print var.key
+    memory-total
+    memory-used
+    memory-free
+    memory-shared
+    memory-buffers
+    memory-cached
 
-    free_cmd_column = ['total', 'used', 'free', 'shared', 'buffers', 'cached']
-    for i in range(len(free_cmd_column)):
-      val = self.CreateGaugeVariable(
-          'memory-%s' % free_cmd_column[i], int(mem[i+1]))
+    """
+    variables = []
+
+    info = ips.procfs.GetMemoryInfo()
+    mem = [
+        ('total', info['MemTotal']),
+        ('used', info['MemTotal'] - info['MemFree']),
+        ('free', info['MemFree']),
+        ('shared', info.get('Shmem', 0)),
+        ('buffers', info['Buffers']),
+        ('cached', info['Cached']),
+    ]
+    for name, value in mem:
+      val = self.CreateGaugeVariable('memory-%s' % name, value)
       variables.append(val)
 
     return variables
-  
+
   def CreateNetstatVariable(self):
-    columns = ['prot', 'state']
+    """Creates a variable containing the number of sockets for each state.
+
+    >>> f = VariableFactory()
+    >>> var = f.CreateNetstatVariable()
+    >>> print ' '.join(var.value.map.columns)
+    prot state ip-version
+
+    """
+    columns = ['prot', 'state', 'ip-version']
     values = []
 
-    try:
-      cmd = (
-          "netstat -ant |"
-          "grep -v Foreign |"
-          "grep -v 'Active Internet connections' |" 
-          "awk -F' ' '{print $6}'"
-          )
-      states = {}
-      for line in ips.utils.ExternalCommand(cmd):
-        line = line.strip()
-        if not line in states:
-          states[line] = 0
-        states[line] += 1
-
-      for state, val in states.iteritems():
-        values.append(('tcp', state, val))
-    except ips.utils.CommandExitedWithError:
-      pass
+    get_tcp_states = ips.procfs.GetTcpStates
+    if options.varz_netstat_netlink:
+      get_tcp_states = ips.procfs.GetTcpStatesByNetlink
+    for version in [4, 6]:
+      try:
+        states = get_tcp_states(version)
+      except (IOError, OSError, socket.error), e:
+        logging.debug('Failed to get tcp%d states: %s', version, str(e))
+        continue
+      for state, val in sorted(states.iteritems()):
+        values.append(('tcp', state, str(version), val))
 
-    return self.CreateMapVariable('netstat', columns, values=values)
+    return self.CreateCompactMapVariable('netstat', columns, values=values)
 
   def CreatePackagesStatisticsVariable(self):
-    columns = ['format', 'name', 'version', 'arch']
-    values = []
+    """Creates a variable containing installed packages.
 
-    # deb
-    try:
-      cmd = 'dpkg -l 2>&1 | grep "^ii"'
-      for line in ips.utils.ExternalCommand(cmd):
-        info = re.split(' +', line)
-        values.append(('deb', info[1], info[2], info[3], 1))
-    except ips.utils.CommandExitedWithError:
-      pass
+    The variable is created again only when the package databases are
+    modified, and the previous one is returned otherwise.
 
-    # rpm
-    query_format = '%{Name} %{Version}-%{Release} %{Arch}'
-    try:
-      for line in ips.utils.ExternalCommand('rpm -qa'):
-        for query_line in ips.utils.ExternalCommand(
-            'rpm -q --queryformat "%s" %s' % (query_format, line.strip())):
-          query = query_line.split(' ')
-          values.append(('rpm', query[0], query[1], query[2], 1))
-    except ips.utils.CommandExitedWithError:
-      pass
+    >>> f = VariableFactory()
+    >>> var = f.CreatePackagesStatisticsVariable()
+    >>> f.CreatePackagesStatisticsVariable() is var
+    True
 
-    return self.CreateMapVariable('packages', columns, values=values)
+    """
+    if self.package_inventory.Update() or self.packages_variable is None:
+      columns = ['format', 'name', 'version', 'arch']
+      values = [package + (1,) for package in self.package_inventory.packages]
+      self.packages_variable = self.CreateCompactMapVariable(
+          'packages', columns, values=values)
+    return self.packages_variable
 
-  def _GenSystemVariables(self):
+  def CreateSystemVariables(self):
+    """Creates variables containing system information.
+
+    >>> f = VariableFactory()
+    >>> len(f.CreateSystemVariables())
+    10
+    """
+    variables = []
     for f in [self.CreateCpuSpeed,
               self.CreateLoadAverage,
               self.CreateNumCpus,
@@ -596,8 +1661,12 @@ class VariableFactory(dict):
               self.CreateUptime,
               self.CreateUptimeAsString,
              ]:
-      var = f()
-      self[var.key] = var
+      variables.append(f())
+    return variables
+
+  def _GenSystemVariables(self):
+    self.Update(self.CreateSystemVariables() +
+                self.CreateExternalCommandVariables())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,566 @@
+# Copyright (c) 2013, Masato Taruishi <taru0216@gmail.com>
+
+"""
+Encodings of variables exported by /varz.
+
+/varz exports variables in one of the following formats:
+
+ json: JSON object which maps keys to values (application/json).
+ raw: '<key>: <value>' line for each variable (text/plain).
+ compact: '<key> <JSON value>' line for each variable without any spaces
+          in the value (application/x-varz-compact).
+ proto: serialized VariableSet message (application/x-protobuf).
+
+The format is chosen by the 'format' query argument or by the Accept
+header of the request.
+
+A client which has the variables of a generation can ask for the changes
+since the generation. The changes are exported as a JSON object like
+
+  {"generation": 10, "since": 8, "variables": {...}, "removed": [...]}
+
+or a VariableSet which has 'since' and 'removed_key'. 'since' is missing
+if the changes are no longer known and all variables are exported
+instead.
+"""
+
+__author__ = 'Masato Taruishi'
+__copyright__ = 'Copyright (c) 2013, Masato Taruishi <taru0216@gmail.com>'
+
+
+from ips.proto.variables_pb2 import Variable, VariableSet
+
+import array
+import json
+
+
+# format -> content type
+FORMATS = {
+    'json': 'application/json',
+    'raw': 'text/plain',
+    'compact': 'application/x-varz-compact',
+    'proto': 'application/x-protobuf',
+}
+
+
+# formats chosen only by ?format=. Many clients accept text/plain
+# without asking for the raw format.
+_EXPLICIT_FORMATS = frozenset(['raw'])
+
+
+def GetFormatForAccept(accept):
+  """Returns the format for the specified Accept header.
+
+  None is returned if no format is acceptable. The raw format is used
+  only when it's requested explicitly.
+
+  >>> GetFormatForAccept('application/x-protobuf, application/json;q=0.5')
+  'proto'
+  >>> GetFormatForAccept('application/json;q=0.5, text/plain')
+  'json'
+  >>> GetFormatForAccept('text/plain')
+  >>> GetFormatForAccept('*/*')
+  """
+  types = []
+  for i, media_range in enumerate(accept.split(',')):
+    params = media_range.split(';')
+    q = 1.0
+    for param in params[1:]:
+      name, unused_sep, value = param.strip().partition('=')
+      if name == 'q':
+        try:
+          q = float(value)
+        except ValueError:
+          pass
+    types.append((-q, i, params[0].strip()))
+  for unused_q, unused_i, content_type in sorted(types):
+    for format, format_content_type in FORMATS.iteritems():
+      if (content_type == format_content_type and
+          not format in _EXPLICIT_FORMATS):
+        return format
+  return None
+
+
+class CompactMapVariable(object):
+  """Map variable which stores its rows in arrays.
+
+  A large map variable is expensive to build and to walk as a Variable
+  message, which has a message with repeated column names for each row.
+  This class stores each column as an array of indexes to the interned
+  column names, and the values as a typed array. The Variable message is
+  built only when it's needed, e.g. when the value attribute is
+  accessed or the variable is serialized, and is kept afterwards.
+
+  >>> var = CompactMapVariable(
+  ...     'network-rx-bytes', ['interface'], Variable.Value.Map.COUNTER,
+  ...     [('eth0', 100), ('eth1', 200)])
+  >>> list(var.GetRows())
+  [(('eth0',), 100), (('eth1',), 200)]
+  >>> [value.counter for value in var.value.map.value]
+  [100L, 200L]
+  >>> var == var.ToProto()
+  True
+  """
+
+  # map type -> (array typecode, or None for a list, converter)
+  _ARRAYS = {
+      Variable.Value.Map.GAUGE: ('d', float),
+      Variable.Value.Map.COUNTER: ('l', long),
+      Variable.Value.Map.STRING: (None, str),
+  }
+
+  def __init__(self, key, columns, type=Variable.Value.Map.GAUGE,
+               values=None):
+    self.key = key
+    self.type = Variable.MAP
+    self.map_type = type
+    self.columns = tuple(columns)
+    # interned column names and their indexes
+    self.names = []
+    self.name_indexes = {}
+    # indexes of the column names of each row, for each column
+    self.rows = [array.array('L') for column in self.columns]
+    typecode, self._convert = self._ARRAYS[type]
+    if typecode:
+      self.values = array.array(typecode)
+    else:
+      self.values = []
+    self.proto = None
+    if values:
+      self.Extend(values)
+
+  def Append(self, column_names, value):
+    """Appends a row of the column names and the value."""
+    for i, name in enumerate(column_names):
+      index = self.name_indexes.get(name)
+      if index is None:
+        index = self.name_indexes[name] = len(self.names)
+        self.names.append(name)
+      self.rows[i].append(index)
+    self.values.append(self._convert(value))
+    self.proto = None
+
+  def Extend(self, rows):
+    """Appends the rows of the column names followed by the value."""
+    # Converts the rows column by column, which is much faster than
+    # appending them one by one.
+    columns = zip(*rows)
+    name_indexes = self.name_indexes
+    for names in columns[:-1]:
+      for name in set(names):
+        if not name in name_indexes:
+          name_indexes[name] = len(self.names)
+          self.names.append(name)
+    for i, names in enumerate(columns[:-1]):
+      self.rows[i].extend(map(name_indexes.__getitem__, names))
+    self.values.extend(map(self._convert, columns[-1]))
+    self.proto = None
+
+  def __len__(self):
+    return len(self.values)
+
+  def GetRows(self):
+    """Yields (column names, value) of each row."""
+    names = self.names
+    for i, value in enumerate(self.values):
+      yield tuple(names[indexes[i]] for indexes in self.rows), value
+
+  def ToProto(self):
+    """Returns the variable as a Variable message."""
+    if self.proto is None:
+      proto = Variable()
+      proto.key = self.key
+      proto.type = Variable.MAP
+      proto.value.map.type = self.map_type
+      proto.value.map.columns.extend(self.columns)
+      type = _MAP_TYPES[self.map_type]
+      for column_names, val in self.GetRows():
+        value = proto.value.map.value.add()
+        value.column_names.extend(column_names)
+        setattr(value, type, val)
+      self.proto = proto
+    return self.proto
+
+  @property
+  def value(self):
+    return self.ToProto().value
+
+  def __eq__(self, other):
+    if isinstance(other, CompactMapVariable):
+      return (self.key == other.key and
+              self.map_type == other.map_type and
+              self.columns == other.columns and
+              list(self.GetRows()) == list(other.GetRows()))
+    return self.ToProto() == other
+
+  def __ne__(self, other):
+    return not self == other
+
+  def __str__(self):
+    return str(self.ToProto())
+
+
+def ToProto(var):
+  """Returns the variable as a Variable message."""
+  if isinstance(var, CompactMapVariable):
+    return var.ToProto()
+  return var
+
+
+def GetMapRows(var):
+  """Yields (column names, value) of each row of the map variable.
+
+  >>> var = CompactMapVariable('disk-usage', ['mounted'], values=[('/', 1)])
+  >>> list(GetMapRows(var)) == list(GetMapRows(var.ToProto()))
+  True
+  """
+  if isinstance(var, CompactMapVariable):
+    for row in var.GetRows():
+      yield row
+  else:
+    type = _GetMapValueType(var)
+    for value in var.value.map.value:
+      yield tuple(value.column_names), getattr(value, type)
+
+
+# map type -> name of the value field
+_MAP_TYPES = {
+    Variable.Value.Map.GAUGE: 'gauge',
+    Variable.Value.Map.COUNTER: 'counter',
+    Variable.Value.Map.STRING: 'string',
+}
+
+
+def _GetMapValueType(var):
+  if var.value.map.type == Variable.Value.Map.GAUGE:
+    return 'gauge'
+  if var.value.map.type == Variable.Value.Map.COUNTER:
+    return 'counter'
+  return 'string'
+
+
+def GetJsonValue(var):
+  """Returns the value of the variable as an object for JSON.
+
+  A map variable is converted to a dict which has 'columns' and
+  nested dicts of 'values' keyed by column names.
+
+  >>> var = Variable()
+  >>> var.key = 'network-rx-bytes'
+  >>> var.type = Variable.MAP
+  >>> var.value.map.type = Variable.Value.Map.COUNTER
+  >>> var.value.map.columns.append('interface')
+  >>> value = var.value.map.value.add()
+  >>> value.column_names.append('eth0')
+  >>> value.counter = 100
+  >>> GetJsonValue(var)
+  {'values': {u'eth0': {'counter': 100L}}, 'columns': [u'interface']}
+  """
+  if var.type == Variable.GAUGE:
+    return var.value.gauge
+  elif var.type == Variable.COUNTER:
+    return var.value.counter
+  elif var.type == Variable.STRING:
+    return var.value.string
+  elif isinstance(var, CompactMapVariable):
+    type = _MAP_TYPES[var.map_type]
+    values = {}
+    for column_names, value in var.GetRows():
+      node = values
+      for column in column_names:
+        node = node.setdefault(column, {})
+      node[type] = value
+    return {
+        'columns': list(var.columns),
+        'values': values}
+  elif var.type == Variable.MAP:
+    type = _GetMapValueType(var)
+    values = {}
+    for map_value in var.value.map.value:
+      node = values
+      for column in map_value.column_names:
+        node = node.setdefault(column, {})
+      node[type] = getattr(map_value, type)
+    return {
+        'columns': list(var.value.map.columns),
+        'values': values}
+
+
+def GetPlainValue(var):
+  """Returns the value of the variable for the raw format.
+
+  >>> var = Variable()
+  >>> var.key = 'network-rx-bytes'
+  >>> var.type = Variable.MAP
+  >>> var.value.map.type = Variable.Value.Map.COUNTER
+  >>> var.value.map.columns.append('interface')
+  >>> value = var.value.map.value.add()
+  >>> value.column_names.append('eth0')
+  >>> value.counter = 100
+  >>> GetPlainValue(var)
+  u'map:interface eth0:100'
+  """
+  if isinstance(var, CompactMapVariable):
+    if var.map_type == Variable.Value.Map.STRING:
+      value_format = ':%s'
+    else:
+      value_format = ':%d'
+    vals = [':'.join(column_names) + value_format % value
+            for column_names, value in var.GetRows()]
+    return 'map:' + ':'.join(var.columns) + ' %s' % ' '.join(vals)
+  if var.type == Variable.MAP:
+    columns = 'map:' + ':'.join(var.value.map.columns)
+    type = _GetMapValueType(var)
+    if type == 'string':
+      value_format = ':%s'
+    else:
+      value_format = ':%d'
+    vals = [
+        ':'.join(val.column_names) +
+        value_format % getattr(val, type) for val in var.value.map.value]
+    return columns + ' %s' % ' '.join(vals)
+  return GetJsonValue(var)
+
+
+def _SortByKey(variables):
+  return sorted(variables, key=lambda var: var.key)
+
+
+def EncodeJson(variables):
+  """Encodes the variables as a JSON object."""
+  varz = {}
+  for var in variables:
+    varz[var.key] = GetJsonValue(var)
+  return json.dumps(varz, indent=True, sort_keys=True)
+
+
+def EncodePlain(variables):
+  """Encodes the variables as '<key>: <value>' lines."""
+  lines = []
+  for var in _SortByKey(variables):
+    lines.append(u'%s: %s\n' % (var.key, GetPlainValue(var)))
+  return u''.join(lines).encode('utf-8')
+
+
+def EncodeCompact(variables):
+  """Encodes the variables as '<key> <JSON value>' lines.
+
+  >>> var = Variable()
+  >>> var.key = 'uptime'
+  >>> var.type = Variable.COUNTER
+  >>> var.value.counter = 10
+  >>> EncodeCompact([var])
+  'uptime 10\\n'
+  """
+  lines = []
+  for var in _SortByKey(variables):
+    lines.append('%s %s\n' % (
+        var.key.encode('utf-8'),
+        json.dumps(GetJsonValue(var), separators=(',', ':'), sort_keys=True)))
+  return ''.join(lines)
+
+
+def EncodeProto(variables, generation=None):
+  """Encodes the variables as a serialized VariableSet."""
+  variable_set = VariableSet()
+  for var in _SortByKey(variables):
+    variable_set.variable.add().CopyFrom(ToProto(var))
+  if generation is not None:
+    variable_set.generation = generation
+  return variable_set.SerializeToString()
+
+
+def Encode(format, variables, generation=None):
+  """Encodes the variables in the specified format."""
+  if format == 'proto':
+    return EncodeProto(variables, generation)
+  return {
+      'json': EncodeJson,
+      'raw': EncodePlain,
+      'compact': EncodeCompact,
+  }[format](variables)
+
+
+def EncodeDelta(format, variables, removed, generation, since=None):
+  """Encodes the variables changed since the generation.
+
+  since is None if the variables are a full snapshot.
+
+  >>> var = Variable()
+  >>> var.key = 'uptime'
+  >>> var.type = Variable.COUNTER
+  >>> var.value.counter = 10
+  >>> DecodeProtoDelta(EncodeDelta('proto', [var], ['cpu'], 3, 2)) == (
+  ...     json.loads(EncodeDelta('json', [var], ['cpu'], 3, 2)))
+  True
+  """
+  if format == 'proto':
+    variable_set = VariableSet()
+    for var in _SortByKey(variables):
+      variable_set.variable.add().CopyFrom(ToProto(var))
+    if generation is not None:
+      variable_set.generation = generation
+    if since is not None:
+      variable_set.since = since
+    variable_set.removed_key.extend(sorted(removed))
+    return variable_set.SerializeToString()
+  return json.dumps(GetJsonDelta(variables, removed, generation, since),
+                    indent=True, sort_keys=True)
+
+
+def GetJsonDelta(variables, removed, generation, since=None):
+  """Returns the variables changed since the generation as an object
+  for JSON."""
+  delta = {
+      'generation': generation,
+      'variables': dict((var.key, GetJsonValue(var)) for var in variables),
+      'removed': sorted(removed),
+  }
+  if since is not None:
+    delta['since'] = since
+  return delta
+
+
+def ParseColumnPredicates(predicates):
+  """Parses 'column=value' predicates to a dict of column to values.
+
+  >>> columns = ParseColumnPredicates(['target=web1', 'target=web2'])
+  >>> sorted(columns['target'])
+  ['web1', 'web2']
+  """
+  columns = {}
+  for predicate in predicates:
+    column, unused_sep, value = predicate.partition('=')
+    columns.setdefault(column, set()).add(value)
+  return columns
+
+
+def FilterMapValues(var, columns):
+  """Filters values of the map variable by column values.
+
+  columns is a dict of column to acceptable values. A copy of var which
+  has only the values matching all columns is returned, or None if
+  var doesn't have the columns.
+
+  >>> var = Variable()
+  >>> var.key = 'cpu'
+  >>> var.type = Variable.MAP
+  >>> var.value.map.columns.append('target')
+  >>> for target in ['web1', 'web2']:
+  ...   value = var.value.map.value.add()
+  ...   value.column_names.append(target)
+  >>> var = FilterMapValues(var, {'target': set(['web2'])})
+  >>> [list(value.column_names) for value in var.value.map.value]
+  [[u'web2']]
+  >>> FilterMapValues(var, {'interface': set(['eth0'])})
+  """
+  if var.type != Variable.MAP:
+    return None
+  if isinstance(var, CompactMapVariable):
+    return _FilterCompactMapValues(var, columns)
+  map_columns = list(var.value.map.columns)
+  indexes = []
+  for column, values in columns.iteritems():
+    if not column in map_columns:
+      return None
+    indexes.append((map_columns.index(column), values))
+  filtered = Variable()
+  filtered.key = var.key
+  filtered.type = var.type
+  filtered.value.map.type = var.value.map.type
+  filtered.value.map.columns.extend(map_columns)
+  for value in var.value.map.value:
+    for i, values in indexes:
+      if value.column_names[i] not in values:
+        break
+    else:
+      filtered.value.map.value.add().CopyFrom(value)
+  return filtered
+
+
+def _FilterCompactMapValues(var, columns):
+  indexes = []
+  for column, values in columns.iteritems():
+    if not column in var.columns:
+      return None
+    indexes.append((var.columns.index(column), values))
+  filtered = CompactMapVariable(var.key, var.columns, var.map_type)
+  for column_names, value in var.GetRows():
+    for i, values in indexes:
+      if column_names[i] not in values:
+        break
+    else:
+      filtered.Append(column_names, value)
+  return filtered
+
+
+def SelectVariables(variables, prefixes=None, regex=None, columns=None):
+  """Selects variables by key prefixes, key regex and map column values.
+
+  A variable is selected if its key starts with one of the prefixes and
+  matches the compiled regex. If columns is given, only map variables
+  which have all the columns are selected and their values are filtered
+  by FilterMapValues().
+
+  >>> import re
+  >>> variables = []
+  >>> for key in ['cpu-speed', 'cpu-utilization', 'uptime']:
+  ...   var = Variable()
+  ...   var.key = key
+  ...   variables.append(var)
+  >>> [var.key for var in SelectVariables(variables, prefixes=['cpu-'])]
+  [u'cpu-speed', u'cpu-utilization']
+  >>> [var.key for var in SelectVariables(variables, regex=re.compile('up'))]
+  [u'uptime']
+  """
+  for var in variables:
+    if prefixes and not [p for p in prefixes if var.key.startswith(p)]:
+      continue
+    if regex and not regex.search(var.key):
+      continue
+    if columns:
+      var = FilterMapValues(var, columns)
+      if not var:
+        continue
+    yield var
+
+
+def DecodeProto(data):
+  """Decodes a serialized VariableSet to the same object as JSON.
+
+  >>> var = Variable()
+  >>> var.key = 'uptime'
+  >>> var.type = Variable.COUNTER
+  >>> var.value.counter = 10
+  >>> DecodeProto(EncodeProto([var]))
+  {u'uptime': 10L}
+  """
+  variable_set = VariableSet()
+  variable_set.ParseFromString(data)
+  varz = {}
+  for var in variable_set.variable:
+    varz[var.key] = GetJsonValue(var)
+  return varz
+
+
+def DecodeProtoDelta(data):
+  """Decodes a serialized VariableSet to the same object as JSON delta."""
+  variable_set = VariableSet()
+  variable_set.ParseFromString(data)
+  delta = {
+      'generation': None,
+      'variables': {},
+      'removed': list(variable_set.removed_key),
+  }
+  if variable_set.HasField('generation'):
+    delta['generation'] = variable_set.generation
+  if variable_set.HasField('since'):
+    delta['since'] = variable_set.since
+  for var in variable_set.variable:
+    delta['variables'][var.key] = GetJsonValue(var)
+  return delta
+
+
+if __name__ == '__main__':
+  import doctest
+  doctest.testmod()
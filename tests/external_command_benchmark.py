@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013, Masato Taruishi <taru0216@gmail.com>
+
+"""Measures the throughput of ips.utils.ExternalCommand.
+
+This benchmark runs a command which writes a large output and reads
+it in each mode of ExternalCommand, then measures the latency to spawn
+a short command with a shell and with argv:
+
+ $ PYTHONPATH=build/lib.linux-x86_64-2.7 \
+     python tests/external_command_benchmark.py --megabytes=300
+"""
+
+__author__ = 'Masato Taruishi'
+__copyright__ = 'Copyright (c) 2013, Masato Taruishi <taru0216@gmail.com>'
+
+
+from tornado.options import define, options
+
+import ips.utils
+import time
+import tornado.options
+
+
+define('megabytes', default=300, type=int,
+       help='size of the output of the command', metavar='MB')
+define('spawns', default=500, type=int,
+       help='number of commands to spawn to measure the latency')
+
+
+def _Lines(cmd):
+  for line in ips.utils.ExternalCommand(cmd):
+    pass
+
+
+def _ByteLines(cmd):
+  for line in ips.utils.ExternalCommand(cmd).Lines():
+    pass
+
+
+def _Chunks(cmd):
+  for chunk in ips.utils.ExternalCommand(cmd).Chunks():
+    pass
+
+
+def _Call(cmd):
+  ips.utils.CallExternalCommand(cmd)
+
+
+def main():
+  tornado.options.parse_command_line()
+  size = options.megabytes * 1024 * 1024
+  # 100 bytes per line
+  cmd = "yes '%s' | head -c %d" % ('a' * 99, size)
+  for name, func in [('iterate (unicode lines)', _Lines),
+                     ('Lines() (byte lines)', _ByteLines),
+                     ('Chunks()', _Chunks),
+                     ('CallExternalCommand', _Call)]:
+    start = time.time()
+    func(cmd)
+    elapsed = time.time() - start
+    print '%-24s %8.1f MB/s' % (name, options.megabytes / elapsed)
+
+  for name, func, cmd in [
+      ('CallExternalCommand', ips.utils.CallExternalCommand, 'true'),
+      ('CallCommand', ips.utils.CallCommand, ['true'])]:
+    start = time.time()
+    for i in xrange(options.spawns):
+      func(cmd)
+    elapsed = time.time() - start
+    print '%-24s %8.3f ms/spawn' % (name, elapsed * 1000 / options.spawns)
+
+
+if __name__ == '__main__':
+  main()
@@ -5,15 +5,23 @@ __author__ = 'Masato Taruishi'
 __copyright__ = 'Copyright (c) 2013, Masato Taruishi <taru0216@gmail.com>'
 
 
+import cgroup_test
 import handlers_test
+import mon_test
+import procfs_test
 import sandbox_test
 import unittest
 import variable_factory_test
+import varz_test
 
 
 def all_suite():
   suite = unittest.TestSuite()
+  suite.addTests(cgroup_test.suite())
   suite.addTests(handlers_test.suite())
+  suite.addTests(mon_test.suite())
+  suite.addTests(procfs_test.suite())
   suite.addTests(sandbox_test.suite())
   suite.addTests(variable_factory_test.suite())
+  suite.addTests(varz_test.suite())
   return suite
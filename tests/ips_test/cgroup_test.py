@@ -0,0 +1,66 @@
+# Copyright (c) 2013, Masato Taruishi <taru0216@gmail.com>
+
+__author__ = 'Masato Taruishi'
+__copyright__ = 'Copyright (c) 2013, Masato Taruishi <taru0216@gmail.com>'
+
+
+import doctest
+import ips.cgroup
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class GetContainerStatisticsTest(unittest.TestCase):
+
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.root)
+
+  def _Write(self, path, data):
+    path = os.path.join(self.root, path)
+    if not os.path.exists(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+      f.write(data)
+
+  def test_should_read_v1_hierarchies(self):
+    for name in ['web1', 'web2']:
+      self._Write('blkio/lxc/%s/blkio.throttle.io_serviced' % name,
+                  '8:0 Total 3\nTotal 3\n')
+      self._Write('blkio/lxc/%s/blkio.throttle.io_service_bytes' % name,
+                  '8:0 Total 4096\nTotal 4096\n')
+      self._Write('cpuacct/lxc/%s/cpuacct.usage' % name, '5000000\n')
+      self._Write('memory/lxc/%s/memory.usage_in_bytes' % name, '1024\n')
+    stats = ips.cgroup.GetContainerStatistics(self.root)
+    self.assertEqual(['web1', 'web2'], sorted(stats))
+    self.assertEqual({'blkio-requests': 3,
+                      'blkio-bytes': 4096,
+                      'cpu-microseconds': 5000,
+                      'memory-bytes': 1024}, stats['web1'])
+
+  def test_should_read_v2_hierarchy(self):
+    self._Write('cgroup.controllers', 'cpu io memory pids\n')
+    self._Write('lxc.payload.web1/io.stat',
+                '8:0 rbytes=100 wbytes=50 rios=3 wios=2\n')
+    self._Write('lxc.payload.web1/cpu.stat', 'usage_usec 700\n')
+    self._Write('lxc.payload.web1/memory.current', '2048\n')
+    self._Write('lxc.payload.web1/pids.current', '7\n')
+    self._Write('lxc/web2/pids.current', '1\n')
+    stats = ips.cgroup.GetContainerStatistics(self.root)
+    self.assertEqual({'blkio-requests': 5,
+                      'blkio-bytes': 150,
+                      'cpu-microseconds': 700,
+                      'memory-bytes': 2048,
+                      'pids': 7}, stats['web1'])
+    self.assertEqual({'pids': 1}, stats['web2'])
+
+
+def suite():
+  suite = unittest.TestSuite()
+  suite.addTests(doctest.DocTestSuite(ips.cgroup))
+  suite.addTests(unittest.makeSuite(GetContainerStatisticsTest))
+  return suite
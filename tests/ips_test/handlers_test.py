@@ -10,12 +10,15 @@ import tornado.options
 import ips.handlers
 import ips.sandbox_service
 import ips.server
+import ips.varz
 import json
 import sys
+import tornado.httpclient
 import tornado.testing
 import tornado.web
 import traceback
 import unittest
+import zlib
 
 
 tornado.options.parse_command_line(args=[None])
@@ -73,6 +76,77 @@ class VarzTest(tornado.testing.AsyncHTTPTestCase):
     varz = json.loads(res.body)
     self.assertIn("process-cpu-seconds", varz)
 
+  def test_should_return_not_modified_for_same_etag(self):
+    self.http_client.fetch(self.get_url('/varz'), self.stop)
+    res = self.wait()
+    etag = res.headers['Etag']
+    self.http_client.fetch(self.get_url('/varz'), self.stop,
+                           headers={'If-None-Match': etag})
+    res = self.wait()
+    self.assertEqual(304, res.code)
+
+  def test_should_return_gzipped_varz(self):
+    self.http_client.fetch(self.get_url('/varz'), self.stop, use_gzip=False,
+                           headers={'Accept-Encoding': 'gzip'})
+    res = self.wait()
+    self.assertEqual('gzip', res.headers['Content-Encoding'])
+    varz = json.loads(zlib.decompress(res.body, 16 + zlib.MAX_WBITS))
+    self.assertIn("process-cpu-seconds", varz)
+
+  def test_should_return_varz_as_proto_for_accept_header(self):
+    self.http_client.fetch(self.get_url('/varz'), self.stop,
+                           headers={'Accept': 'application/x-protobuf'})
+    res = self.wait()
+    self.assertEqual('application/x-protobuf', res.headers['Content-Type'])
+    varz = ips.varz.DecodeProto(res.body)
+    self.assertIn("process-cpu-seconds", varz)
+
+  def test_should_return_varz_as_json_for_text_plain(self):
+    self.http_client.fetch(self.get_url('/varz'), self.stop,
+                           headers={'Accept': 'text/plain'})
+    res = self.wait()
+    varz = json.loads(res.body)
+    self.assertIn("process-cpu-seconds", varz)
+
+  def test_should_return_varz_as_compact(self):
+    self.http_client.fetch(self.get_url('/varz?format=compact'), self.stop)
+    res = self.wait()
+    keys = [line.split(' ', 1)[0] for line in res.body.splitlines()]
+    self.assertIn("process-cpu-seconds", keys)
+
+  def test_should_select_varz_by_prefix_and_regex(self):
+    self.http_client.fetch(self.get_url('/varz?prefix=process-'), self.stop)
+    res = self.wait()
+    varz = json.loads(res.body)
+    self.assertIn("process-cpu-seconds", varz)
+    self.assertNotIn("uptime", varz)
+
+    self.http_client.fetch(
+        self.get_url('/varz?prefix=process-&regex=cpu-s'), self.stop)
+    res = self.wait()
+    self.assertEqual(["process-cpu-seconds"], json.loads(res.body).keys())
+
+  def test_should_return_varz_changed_since_generation(self):
+    self.http_client.fetch(self.get_url('/varz?since=0'), self.stop)
+    res = self.wait()
+    snapshot = json.loads(res.body)
+    self.assertNotIn("since", snapshot)
+    self.assertIn("process-cpu-seconds", snapshot["variables"])
+
+    generation = snapshot["generation"]
+    self.http_client.fetch(
+        self.get_url('/varz?since=%d' % generation), self.stop,
+        headers={'Accept': 'application/x-protobuf'})
+    res = self.wait()
+    delta = ips.varz.DecodeProtoDelta(res.body)
+    self.assertEqual(generation, delta["since"])
+    self.assertEqual({}, delta["variables"])
+
+  def test_should_reject_bad_regex(self):
+    self.http_client.fetch(self.get_url('/varz?regex=%28'), self.stop)
+    res = self.wait()
+    self.assertEqual(400, res.code)
+
   def test_should_return_varz_as_raw(self):
     self.http_client.fetch(self.get_url('/varz?format=raw'), self.stop)
     res = self.wait()
@@ -127,6 +201,95 @@ class FormzTest(tornado.testing.AsyncHTTPTestCase):
     self.assertIn("textarea", res.body)
 
 
+class VarzWatchTest(tornado.testing.AsyncHTTPTestCase):
+
+  def get_app(self):
+    self.vars = ips.server.InitVariables()
+    return tornado.web.Application(
+        [(r'/varz/watch', ips.handlers.VarzWatchHandler, dict(vars=self.vars)),
+         (r'/varz/nowatch', ips.handlers.VarzWatchHandler,
+          dict(vars=self.vars, max_watchers=0))])
+
+  def test_should_push_changes_of_varz(self):
+    messages = []
+    buf = []
+    def OnChunk(chunk):
+      buf.append(chunk)
+      lines = ''.join(buf).split('\n')
+      buf[:] = lines[-1:]
+      for line in lines[:-1]:
+        messages.append(json.loads(line))
+        if len(messages) == 1:
+          self.vars.Update([self.vars.CreateStringVariable('watch', 'hello')])
+        else:
+          self.stop()
+    self.http_client.fetch(tornado.httpclient.HTTPRequest(
+        self.get_url('/varz/watch'), streaming_callback=OnChunk))
+    self.wait()
+    self.assertIn("process-cpu-seconds", messages[0]["variables"])
+    self.assertEqual(messages[0]["generation"], messages[1]["since"])
+    self.assertEqual("hello", messages[1]["variables"]["watch"])
+
+  def test_should_limit_watchers(self):
+    self.http_client.fetch(self.get_url('/varz/nowatch'), self.stop)
+    res = self.wait()
+    self.assertEqual(503, res.code)
+
+
+class VarzHistoryTest(tornado.testing.AsyncHTTPTestCase):
+
+  def get_app(self):
+    self.vars = ips.server.InitVariables()
+    return tornado.web.Application(
+        [(r'/varz/history', ips.handlers.VarzHistoryHandler,
+          dict(vars=self.vars))])
+
+  def test_should_return_history_of_variable(self):
+    for value in [1, 2]:
+      self.vars.Update([self.vars.CreateGaugeVariable('history', value)])
+    self.http_client.fetch(self.get_url('/varz/history?key=history'),
+                           self.stop)
+    res = self.wait()
+    self.assertEqual([1.0, 2.0], json.loads(res.body)["values"])
+
+  def test_should_return_not_found_for_unknown_variable(self):
+    self.http_client.fetch(self.get_url('/varz/history?key=unknown'),
+                           self.stop)
+    res = self.wait()
+    self.assertEqual(404, res.code)
+
+
+class DevzTest(tornado.testing.AsyncHTTPTestCase):
+
+  def get_app(self):
+    return tornado.web.Application(
+        [(r'/healthz', ips.handlers.HealthzHandler, dict(service='test')),
+         (r'/devz/(.*)', ips.handlers.DevzHandler)])
+
+  def test_should_return_output_of_shell(self):
+    self.http_client.fetch(self.get_url('/devz/sh?cmd=echo+hello'), self.stop)
+    res = self.wait()
+    self.assertIn("<pre>hello\n</pre>", res.body)
+
+  def test_should_return_exit_status_of_shell(self):
+    self.http_client.fetch(self.get_url('/devz/sh?cmd=exit+3'), self.stop)
+    res = self.wait()
+    self.assertIn("exited with an error: 3", res.body)
+
+  def test_should_not_block_other_requests_while_running_shell(self):
+    finished = []
+    def Done(res):
+      finished.append(res.request.url)
+      if len(finished) == 2:
+        self.stop()
+    shell_url = self.get_url('/devz/sh?cmd=sleep+1')
+    healthz_url = self.get_url('/healthz')
+    self.http_client.fetch(shell_url, Done)
+    self.http_client.fetch(healthz_url, Done)
+    self.wait()
+    self.assertEqual([healthz_url, shell_url], finished)
+
+
 def suite():
   suite = unittest.TestSuite()
   suite.addTests(unittest.makeSuite(HealthzTest))
@@ -134,4 +297,7 @@ def suite():
   suite.addTests(unittest.makeSuite(StatuszTest))
   suite.addTests(unittest.makeSuite(HelpzTest))
   suite.addTests(unittest.makeSuite(FormzTest))
+  suite.addTests(unittest.makeSuite(VarzWatchTest))
+  suite.addTests(unittest.makeSuite(VarzHistoryTest))
+  suite.addTests(unittest.makeSuite(DevzTest))
   return suite
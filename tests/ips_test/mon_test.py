@@ -0,0 +1,69 @@
+# Copyright (c) 2013, Masato Taruishi <taru0216@gmail.com>
+
+__author__ = 'Masato Taruishi'
+__copyright__ = 'Copyright (c) 2013, Masato Taruishi <taru0216@gmail.com>'
+
+
+import doctest
+import ips.mon
+import unittest
+
+
+class MetricRepositoryTest(unittest.TestCase):
+
+  def test_should_add_metrics_with_unicode_tags(self):
+    metrics = ips.mon.MetricRepository()
+    metrics.AddMetric(ips.mon.Metric('disk-usage', 1, [u'mounted=/', 'job=a']))
+    metrics.AddMetric(ips.mon.Metric('disk-size', 2, ['mounted=/', u'job=a']))
+    usage = metrics.GetMetricFromMetricName('disk-usage{job=a,mounted=/}')
+    self.assertEqual(1, usage.value)
+    self.assertIs(usage.tags,
+                  metrics.GetMetric('disk-size', ('job=a', 'mounted=/')).tags)
+    self.assertEqual(2, len(metrics.GetMetricsWithTag(u'mounted=/')))
+
+
+class EvalColumnsTest(unittest.TestCase):
+
+  RULES = [
+      '(setm (quote $r) (/ $a 0 2))',
+      '(setm (quote $r) (/ $a $b 2))',
+      '(setm (quote $r) (/ 8 $b 2))',
+  ]
+
+  def _Eval(self, rule, columns):
+    metrics = ips.mon.MetricRepository()
+    for job, a, b in [('x', 8, 0), ('y', 8, 4), ('z', 6, 0.0)]:
+      metrics.AddMetric(ips.mon.Metric('a', a, ['job=' + job]))
+      metrics.AddMetric(ips.mon.Metric('b', b, ['job=' + job]))
+    rule = ips.mon.SexpListFactory().Compile([rule])[0]
+    tag_list = [metric.tags for metric in metrics.GetMetrics('a')]
+    if columns:
+      rule.EvalColumns(metrics, tag_list)
+    else:
+      env = {'metrics': metrics, 'symtable': ips.mon.MetricEvaluator.SYMTABLE}
+      for tags in tag_list:
+        rule.Eval(env, tags)
+    return [metric.value for metric in metrics.GetMetrics('r')]
+
+  def _AssertSameAsEval(self):
+    for rule in self.RULES:
+      self.assertEqual(self._Eval(rule, False), self._Eval(rule, True), rule)
+
+  def test_should_stop_division_at_zero_as_eval(self):
+    self._AssertSameAsEval()
+
+  def test_should_stop_division_at_zero_as_eval_without_numpy(self):
+    numpy = ips.mon.numpy
+    ips.mon.numpy = None
+    try:
+      self._AssertSameAsEval()
+    finally:
+      ips.mon.numpy = numpy
+
+
+def suite():
+  suite = unittest.TestSuite()
+  suite.addTests(doctest.DocTestSuite(ips.mon))
+  suite.addTests(unittest.makeSuite(MetricRepositoryTest))
+  suite.addTests(unittest.makeSuite(EvalColumnsTest))
+  return suite
@@ -0,0 +1,149 @@
+# Copyright (c) 2013, Masato Taruishi <taru0216@gmail.com>
+
+__author__ = 'Masato Taruishi'
+__copyright__ = 'Copyright (c) 2013, Masato Taruishi <taru0216@gmail.com>'
+
+
+import doctest
+import ips.procfs
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+
+TCP = '''\
+  sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode
+   0: 00000000:0016 00000000:0000 0A 00000000:00000000 00:00000000 00000000     0        0 1 1 0000000000000000 100 0 0 10 0
+   1: 0100007F:0CEA 00000000:0000 0A 00000000:00000000 00:00000000 00000000   108        0 2 1 0000000000000000 100 0 0 10 0
+   2: 0200000A:0016 0100000A:D2F0 01 00000000:00000000 02:0008D5A5 00000000     0        0 3 4 0000000000000000 20 4 31 10 -1
+   3: 0200000A:0016 0100000A:D2F2 06 00000000:00000000 03:00000F5B 00000000     0        0 0 3 0000000000000000
+'''
+
+TCP6 = '''\
+  sl  local_address                         remote_address                        st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode
+   0: 00000000000000000000000000000000:0016 00000000000000000000000000000000:0000 0A 00000000:00000000 00:00000000 00000000     0        0 1 1 0000000000000000 100 0 0 10 0
+   1: 0000000000000000FFFF00000200000A:0016 0000000000000000FFFF00000100000A:D2F4 01 00000000:00000000 02:0008D5A5 00000000     0        0 2 4 0000000000000000 20 4 31 10 -1
+'''
+
+MEMINFO = '''\
+MemTotal:        2048000 kB
+MemFree:          512000 kB
+HugePages_Total:       0
+Hugepagesize:       2048 kB
+'''
+
+MOUNTINFO = '''\
+22 1 8:1 / / rw,relatime shared:1 - ext4 /dev/sda1 rw
+23 22 0:5 / /proc rw,nosuid shared:2 - proc proc rw
+24 22 8:2 / /mnt/with\\040space rw,relatime - ext4 /dev/sda2 rw
+25 22 8:2 / /mnt/with\\040space rw,relatime - ext4 /dev/sda2 rw
+'''
+
+
+class TcpStatesTest(unittest.TestCase):
+
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.root)
+
+  def _Write(self, name, data):
+    path = os.path.join(self.root, name)
+    with open(path, 'w') as f:
+      f.write(data)
+    return path
+
+  def test_should_count_states(self):
+    path = self._Write('tcp', TCP)
+    self.assertEqual({'LISTEN': 2, 'ESTABLISHED': 1, 'TIME_WAIT': 1},
+                     ips.procfs.CountTcpStates(path))
+
+  def test_should_count_states_across_chunks(self):
+    path = self._Write('tcp', TCP)
+    for chunk_size in [1, 7, 100, 151]:
+      self.assertEqual({'LISTEN': 2, 'ESTABLISHED': 1, 'TIME_WAIT': 1},
+                       ips.procfs.CountTcpStates(path, chunk_size))
+
+  def test_should_count_states_of_ipv6(self):
+    path = self._Write('tcp6', TCP6)
+    self.assertEqual({'LISTEN': 1, 'ESTABLISHED': 1},
+                     ips.procfs.CountTcpStates(path))
+
+
+class SockDiagTest(unittest.TestCase):
+
+  def _Message(self, type, payload=''):
+    return ips.procfs._NLMSGHDR.pack(
+        ips.procfs._NLMSGHDR.size + len(payload), type, 0, 1, 0) + payload
+
+  def _InetDiagMessage(self, state):
+    # inet_diag_msg: idiag_family, idiag_state and the rest.
+    return self._Message(ips.procfs.SOCK_DIAG_BY_FAMILY,
+                         struct.pack('=BB70x', 2, state))
+
+  def test_should_count_states_until_done(self):
+    counts = {}
+    buf = (self._InetDiagMessage(10) + self._InetDiagMessage(1) +
+           self._InetDiagMessage(10))
+    self.assertFalse(ips.procfs.ParseSockDiagMessages(buf, counts))
+    self.assertTrue(ips.procfs.ParseSockDiagMessages(
+        self._InetDiagMessage(6) + self._Message(ips.procfs.NLMSG_DONE),
+        counts))
+    self.assertEqual({10: 2, 1: 1, 6: 1}, counts)
+
+  def test_should_align_messages(self):
+    counts = {}
+    # a message of 18 bytes is padded to 20 bytes.
+    message = self._Message(ips.procfs.SOCK_DIAG_BY_FAMILY,
+                            struct.pack('=BB', 2, 10))
+    buf = message + '\0' * 2 + self._InetDiagMessage(1)
+    ips.procfs.ParseSockDiagMessages(buf, counts)
+    self.assertEqual({10: 1, 1: 1}, counts)
+
+  def test_should_raise_error(self):
+    self.assertRaises(OSError, ips.procfs.ParseSockDiagMessages,
+                      self._Message(ips.procfs.NLMSG_ERROR, '\0' * 4), {})
+
+
+class MemoryInfoTest(unittest.TestCase):
+
+  def test_should_return_bytes(self):
+    info = ips.procfs.ParseMemoryInfo(MEMINFO)
+    self.assertEqual(2048000 * 1024, info['MemTotal'])
+    self.assertEqual(512000 * 1024, info['MemFree'])
+    self.assertEqual(0, info['HugePages_Total'])
+    self.assertEqual(2048 * 1024, info['Hugepagesize'])
+
+
+class MountInfoTest(unittest.TestCase):
+
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.root)
+
+  def test_should_unescape_mount_points(self):
+    self.assertEqual(['/', '/proc', '/mnt/with space', '/mnt/with space'],
+                     ips.procfs.ParseMountInfo(MOUNTINFO))
+
+  def test_should_list_mount_point_once(self):
+    mounted = os.path.join(self.root, 'with space')
+    os.mkdir(mounted)
+    stats = ips.procfs.GetDiskStatistics(
+        [mounted, self.root, mounted, os.path.join(self.root, 'missing')])
+    self.assertEqual([self.root, mounted],
+                     [mount_point for mount_point, size, used in stats])
+
+
+def suite():
+  suite = unittest.TestSuite()
+  suite.addTests(doctest.DocTestSuite(ips.procfs))
+  suite.addTests(unittest.makeSuite(TcpStatesTest))
+  suite.addTests(unittest.makeSuite(SockDiagTest))
+  suite.addTests(unittest.makeSuite(MemoryInfoTest))
+  suite.addTests(unittest.makeSuite(MountInfoTest))
+  return suite
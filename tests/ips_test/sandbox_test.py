@@ -12,7 +12,7 @@ import unittest
 class FakeStub:
 
   Cmds = {
-      'lxc-info -n example': 'example',
+      'lxc-info -n example': 'Name: example\nState: RUNNING',
       'lxc-stop -r -n example': '',
       'lxc-stop -n example': '',
       'lxc-stop -k -n example': '',
@@ -41,7 +41,6 @@ class FakeStub:
       '/sbin/iptables -I OUTPUT -t nat -p tcp -d 192.168.1.254' +
           ' --dport 3 -jDNAT --to-destination 192.168.1.1': '',
       'update-alternatives --remove ips-sandbox_. /var/lib/lxc/example': '',
-      'lxc-info -n example | grep -i state: || true': 'state: RUNNING',
   }
 
   File = {
@@ -67,9 +66,12 @@ class FakeStub:
   def HostAddress(self):
     return '192.168.1.254'
 
-  def ExecCommand(self, cmd):
+  def ExecCommand(self, cmd, timeout=None):
     return self.__class__.Cmds[cmd]
 
+  def Exec(self, argv, timeout=None):
+    return self.__class__.Cmds[' '.join(argv)]
+
 
 ips.sandbox.Sandbox._stub = FakeStub()
 
@@ -0,0 +1,15 @@
+# Copyright (c) 2013, Masato Taruishi <taru0216@gmail.com>
+
+__author__ = 'Masato Taruishi'
+__copyright__ = 'Copyright (c) 2013, Masato Taruishi <taru0216@gmail.com>'
+
+
+import doctest
+import ips.varz
+import unittest
+
+
+def suite():
+  suite = unittest.TestSuite()
+  suite.addTests(doctest.DocTestSuite(ips.varz))
+  return suite